@@ -1,7 +1,9 @@
 from typing import List
 import pandas as pd
 import numpy as np
-from datetime import datetime
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta, timezone
+from dateutil import tz
 import matplotlib.pyplot as plt
 import pathlib
 import seaborn as sns
@@ -34,6 +36,12 @@ else:
 
 # Constants
 TRACE_BREAKDOWN = 'trace_breakdown.csv'
+# Columnar alternative with native timestamps (sb analyze_traces --output_format=parquet)
+TRACE_BREAKDOWN_PARQUET = 'trace_breakdown.parquet'
+# Parquet metadata whether trace_breakdown.csv contains local or UTC times (see breakdown_writer)
+CSV_TIME_METADATA = b'sb.csv_time'
+# Parquet metadata with the timezone of the analyzer for local times (see breakdown_writer)
+CSV_TIMEZONE_METADATA = b'sb.csv_timezone'
 
 date_cols = [
     't1',
@@ -87,9 +95,11 @@ duration_mappings = {
 # Import helper methods
 
 def find_execution_paths(data_path) -> List[pathlib.Path]:
-    "Returns a list of paths to log directories where 'trace_breakdown.csv' exists."
+    "Returns a list of paths to log directories where 'trace_breakdown.csv' or '.parquet' exists."
     # Execution log directories are in the datetime format 2021-04-30_01-09-33
-    return [p.parent for p in pathlib.Path(data_path).rglob(TRACE_BREAKDOWN)]
+    paths = [p.parent for p in pathlib.Path(data_path).rglob(TRACE_BREAKDOWN)]
+    paths += [p.parent for p in pathlib.Path(data_path).rglob(TRACE_BREAKDOWN_PARQUET)]
+    return list(dict.fromkeys(paths))
 
 
 def read_sb_app_config(execution):
@@ -113,12 +123,44 @@ def read_sb_app_config(execution):
 
 
 def read_trace_breakdown(execution) -> pd.DataFrame:
-    """Returns a pandas dataframe with the parsed trace_breakdown.csv"""
+    """Returns a pandas dataframe with the parsed trace_breakdown.parquet or trace_breakdown.csv.
+    Parquet timestamps are read natively (UTC) without string parsing and converted into the
+    same timezone-naive times as the csv dates, which are local times of the analyzer for AWS."""
+    parquet_path = pathlib.Path(execution) / TRACE_BREAKDOWN_PARQUET
+    if parquet_path.is_file():
+        table = pq.read_table(parquet_path)
+        trace_breakdown = table.to_pandas()
+        metadata = table.schema.metadata or {}
+        local_time = metadata.get(CSV_TIME_METADATA) == b'local'
+        csv_timezone = csv_timezone_of(metadata)
+        for col in date_cols:
+            if local_time:
+                trace_breakdown[col] = trace_breakdown[col].dt.tz_convert(csv_timezone) \
+                    .dt.tz_localize(None)
+            else:
+                trace_breakdown[col] = trace_breakdown[col].dt.tz_convert(None)
+        return trace_breakdown
     trace_breakdown_path = pathlib.Path(execution) / TRACE_BREAKDOWN
     trace_breakdown = pd.read_csv(trace_breakdown_path, parse_dates=date_cols)
     return trace_breakdown
 
 
+def csv_timezone_of(metadata):
+    """Returns the timezone of the local csv times in parquet metadata, which is an IANA name
+    (e.g., Europe/Zurich) or a UTC offset (e.g., +0100). Defaults to the local timezone
+    for breakdowns without timezone."""
+    name = metadata.get(CSV_TIMEZONE_METADATA, b'').decode()
+    if len(name) == 5 and name[0] in '+-' and name[1:].isdigit():
+        offset = timedelta(hours=int(name[1:3]), minutes=int(name[3:]))
+        return timezone(-offset if name[0] == '-' else offset)
+    csv_timezone = tz.gettz(name) if name else None
+    if csv_timezone is None:
+        if name:
+            logging.warning(f"Unknown timezone {name} of the trace breakdown. Using local time.")
+        return tz.tzlocal()
+    return csv_timezone
+
+
 def filter_traces_warm(trace_breakdown) -> pd.DataFrame:
     traces = trace_breakdown[(trace_breakdown["f1_cold_start"] == 0) & (trace_breakdown["f2_cold_start"] == 0)]
     return traces
@@ -0,0 +1,105 @@
+import logging
+import json
+import hashlib
+import os
+from pathlib import Path
+from more_itertools import chunked
+
+
+"""Number of bytes preceding the checkpoint offset that identify the analyzed part of traces.json.
+Detects a rewritten traces.json (e.g., a new download) that must be analyzed from scratch.
+"""
+FINGERPRINT_BYTES = 1024
+
+
+def read_line_chunks(file, chunk_size, offset=0, complete_lines=False):
+    """Yields chunks of lines from a binary file starting at the byte offset
+    together with the byte offset after each chunk.
+    Optionally stops before an incomplete last line (e.g., while a download is still writing)."""
+    # Files without checkpoint (e.g., zstd-compressed traces) might not support seeking
+    if offset > 0:
+        file.seek(offset)
+    for lines in chunked(file, chunk_size):
+        if complete_lines and not lines[-1].endswith(b'\n'):
+            lines = lines[:-1]
+            if len(lines) > 0:
+                yield lines, offset + sum(map(len, lines))
+            return
+        offset += sum(map(len, lines))
+        yield lines, offset
+
+
+class AnalysisCheckpoint:
+    """Records the progress of analyzing traces.json into trace_breakdown.csv
+    such that an incremental analysis only appends results of new traces and
+    resumes safely after an interruption.
+    The checkpoint is saved as trace_breakdown.checkpoint.json next to the breakdown file
+    after every chunk written by an incremental analysis and consists of:
+    * offset: bytes of traces.json analyzed
+    * breakdown_size: bytes of trace_breakdown.csv written for these traces
+    * num_traces: number of traces written
+    * fields: columns of trace_breakdown.csv
+    * fingerprint: hash of the traces.json bytes preceding the offset
+    """
+
+    def __init__(self, traces_file, breakdown_file, fields) -> None:
+        self.traces_file = Path(traces_file)
+        self.breakdown_file = Path(breakdown_file)
+        self.path = self.breakdown_file.with_name(f"{self.breakdown_file.stem}.checkpoint.json")
+        self.fields = list(fields)
+        self.offset = 0
+        self.num_traces = 0
+
+    def resume(self) -> bool:
+        """Restores the last checkpoint and truncates trace_breakdown.csv to its checkpointed size
+        discarding results written after the checkpoint (e.g., due to an interruption).
+        Returns False if no valid checkpoint exists and the analysis must start from scratch."""
+        if not self.path.is_file() or not self.breakdown_file.is_file():
+            return False
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if not self.is_valid(state):
+            logging.info(f"Outdated checkpoint {self.path.name}. Analyzing all traces.")
+            return False
+        os.truncate(self.breakdown_file, state['breakdown_size'])
+        self.offset = state['offset']
+        self.num_traces = state['num_traces']
+        logging.info(f"Resuming analysis after {self.num_traces} traces ({self.offset} bytes).")
+        return True
+
+    def is_valid(self, state) -> bool:
+        """Returns True if the checkpoint state matches the current traces.json and breakdown."""
+        if state['fields'] != self.fields:
+            return False
+        if state['offset'] > self.traces_file.stat().st_size:
+            return False
+        if state['breakdown_size'] > self.breakdown_file.stat().st_size:
+            return False
+        return state['fingerprint'] == self.fingerprint(state['offset'])
+
+    def save(self, offset, breakdown_size, num_traces) -> None:
+        """Atomically replaces the checkpoint after results have been flushed."""
+        self.offset = offset
+        self.num_traces = num_traces
+        state = {
+            'offset': offset,
+            'breakdown_size': breakdown_size,
+            'num_traces': num_traces,
+            'fields': self.fields,
+            'fingerprint': self.fingerprint(offset)
+        }
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        """Removes an outdated checkpoint (e.g., after a full analysis rewrote the breakdown)."""
+        if self.path.exists():
+            self.path.unlink()
+
+    def fingerprint(self, offset) -> str:
+        start = max(0, offset - FINGERPRINT_BYTES)
+        with open(self.traces_file, 'rb') as traces_json:
+            traces_json.seek(start)
+            return hashlib.sha1(traces_json.read(offset - start)).hexdigest()
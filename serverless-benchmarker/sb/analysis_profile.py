@@ -0,0 +1,120 @@
+import functools
+import heapq
+import json
+import os
+import time
+from pathlib import Path
+
+
+"""Number of slowest traces reported with their trace ids."""
+DEFAULT_NUM_OUTLIERS = 10
+
+"""Profile of the current process that instrumented phases report to.
+None disables profiling such that instrumented code only pays for a global lookup.
+Every worker process activates its own profile per chunk (see use_profile).
+"""
+active = None
+
+
+def use_profile(profile):
+    """Activates the given profile (or None) and returns the previously active profile."""
+    global active
+    previous = active
+    active = profile
+    return previous
+
+
+class AnalysisProfile:
+    """Cumulative wall time, CPU time, and number of calls per phase of a trace analysis
+    together with the slowest traces. Phases can be nested (e.g., longest_path within
+    add_global_stats within create_span_graph) and report inclusive times.
+    Profiles of multiple chunks or worker processes are combined via merge.
+    """
+
+    def __init__(self, num_outliers=DEFAULT_NUM_OUTLIERS) -> None:
+        self.num_outliers = num_outliers
+        # Phase name => [calls, wall seconds, cpu seconds]
+        self.phases = {}
+        # Min-heap of the (seconds, trace_id) of the slowest traces
+        self.outliers = []
+
+    def add(self, name, wall, cpu, calls=1) -> None:
+        stats = self.phases.get(name)
+        if stats is None:
+            self.phases[name] = [calls, wall, cpu]
+        else:
+            stats[0] += calls
+            stats[1] += wall
+            stats[2] += cpu
+
+    def add_trace(self, trace_id, seconds) -> None:
+        if len(self.outliers) < self.num_outliers:
+            heapq.heappush(self.outliers, (seconds, trace_id))
+        elif seconds > self.outliers[0][0]:
+            heapq.heapreplace(self.outliers, (seconds, trace_id))
+
+    def merge(self, other) -> None:
+        for name, (calls, wall, cpu) in other.phases.items():
+            self.add(name, wall, cpu, calls)
+        for seconds, trace_id in other.outliers:
+            self.add_trace(trace_id, seconds)
+
+    def report(self) -> dict:
+        """Returns the phases ordered by descending wall time and the slowest traces."""
+        phases = {}
+        for name, (calls, wall, cpu) in sorted(self.phases.items(), key=lambda p: -p[1][1]):
+            phases[name] = {
+                'calls': calls,
+                'wall_seconds': round(wall, 6),
+                'cpu_seconds': round(cpu, 6),
+                'wall_us_per_call': round(wall / calls * 1e6, 1) if calls > 0 else None
+            }
+        slowest_traces = [{'trace_id': trace_id, 'seconds': round(seconds, 6)}
+                          for seconds, trace_id in sorted(self.outliers, reverse=True)]
+        return {'phases': phases, 'slowest_traces': slowest_traces}
+
+    def save(self, path) -> None:
+        tmp_path = Path(path).with_suffix('.tmp')
+        with open(tmp_path, 'w') as profile_file:
+            json.dump(self.report(), profile_file, indent=2)
+        os.replace(tmp_path, path)
+
+
+class Phase:
+    """Context manager measuring a block as the given phase of the active profile."""
+
+    __slots__ = ('name', 'profile', 'wall', 'cpu')
+
+    def __init__(self, name) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.profile = active
+        if self.profile is not None:
+            self.wall = time.perf_counter()
+            self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.add(self.name, time.perf_counter() - self.wall,
+                             time.process_time() - self.cpu)
+        return False
+
+
+def profiled(func):
+    """Decorator measuring every call of a function as a phase named after the function."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = active
+        if profile is None:
+            return func(*args, **kwargs)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+    return wrapper
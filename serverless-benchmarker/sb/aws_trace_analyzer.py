@@ -1,12 +1,21 @@
 import logging
-import json
+import time
 from pathlib import Path
-import csv
+import math
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import networkx as nx
 from more_itertools import peekable
-import pandas as pd
 from pandas import json_normalize
+from sb.trace_storage import traces_file_of
+from sb.breakdown_writer import validate_output_format, breakdown_path, breakdown_schema, \
+    write_csv_breakdown, write_parquet_breakdown
+from sb.latency_sketch import LatencySketches, add_interval_latencies
+from sb.service_map import ServiceMap
+from sb.analysis_profile import AnalysisProfile, Phase, profiled, use_profile
+from sb import json_backend
 
 
 """
@@ -23,7 +32,14 @@ This margin is mainly used for the is_async_call heuristic.
 A 1ms offset captures ms-based rounding issues and appears sufficient
 based on analyzing millions of traces from AWS X-Ray.
 """
-TIMESTAMP_MARGIN = timedelta(microseconds=1001)
+TIMESTAMP_MARGIN_US = 1001
+TIMESTAMP_MARGIN = timedelta(microseconds=TIMESTAMP_MARGIN_US)
+
+"""The critical path analysis represents time as integer microseconds since epoch.
+XRay timestamps are float seconds with at most µs precision. Durations are only
+converted into timedelta objects when assigned as trace-level results.
+"""
+US_PER_SECOND = 1000000
 
 
 def t(epoch) -> datetime:
@@ -34,26 +50,151 @@ def ft(epoch) -> str:
     return t(epoch).strftime('%Y-%m-%d %H:%M:%S.%f')
 
 
+def epoch_us(epoch) -> int:
+    """Returns the float epoch seconds as integer microseconds.
+    Rounds the fractional part half-to-even exactly like datetime.fromtimestamp."""
+    frac, whole = math.modf(epoch)
+    return int(whole) * US_PER_SECOND + round(frac * US_PER_SECOND)
+
+
+def td(us) -> timedelta:
+    return timedelta(microseconds=us)
+
+
+def timediff_us(start_time, end_time) -> int:
+    return epoch_us(end_time) - epoch_us(start_time)
+
+
 def timediff(start_time, end_time) -> timedelta:
-    return t(end_time) - t(start_time)
+    return td(timediff_us(start_time, end_time))
+
+
+class SpanTree:
+    """Compact span graph of a single trace backed by parallel columns.
+    Each span (or trace segment in XRay terminology) is identified by its
+    integer index into the columns in order of first appearance.
+    Children of a span are stored as a contiguous range of the flat child_order list
+    sorted primarily by end time and secondarily by start time (see get_sorted_children).
+    The init_child and category columns are precomputed by index_spans.
+    Trace-level attributes are accessible via G.graph[METRIC_NAME] alike networkx graphs.
+    """
+
+    __slots__ = ('graph', 'ids', 'index', 'docs', 'parent', 'start_us', 'end_us',
+                 'origin', 'name', 'invocation_type', 'child_order', 'child_offsets',
+                 'init_child', 'category', '_children')
+
+    def __init__(self, **graph_attr) -> None:
+        self.graph = graph_attr
+        self.ids = []
+        self.index = {}
+        self.docs = []
+        self.parent = []
+        self.start_us = []
+        self.end_us = []
+        self.origin = []
+        self.name = []
+        self.invocation_type = []
+        self.child_order = []
+        self.child_offsets = [0]
+        self.init_child = []
+        self.category = []
+        # Unordered child lists during construction until sort_children()
+        self._children = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def node(self, id) -> int:
+        """Returns the index of the span with the given id.
+        Creates an empty span if the id is unknown (e.g., a missing parent)."""
+        i = self.index.get(id)
+        if i is None:
+            i = len(self.ids)
+            self.index[id] = i
+            self.ids.append(id)
+            self.docs.append(None)
+            self.parent.append(-1)
+            self.start_us.append(None)
+            self.end_us.append(None)
+            self.origin.append(None)
+            self.name.append(None)
+            self.invocation_type.append(None)
+            self._children.append([])
+        return i
+
+    def add_span(self, doc) -> int:
+        """Adds or completes the span of an XRay (sub)segment document and returns its index."""
+        i = self.node(doc['id'])
+        self.docs[i] = doc
+        self.start_us[i] = epoch_us(doc['start_time'])
+        self.end_us[i] = epoch_us(doc['end_time'])
+        self.origin[i] = doc.get('origin', None)
+        self.name[i] = doc.get('name', None)
+        return i
+
+    def add_edge(self, parent, child) -> None:
+        """Adds a causal relationship between two span indices.
+        The first added parent remains the parent of a span."""
+        if self.parent[child] == -1:
+            self.parent[child] = parent
+            self._children[parent].append(child)
+        elif child not in self._children[parent]:
+            self._children[parent].append(child)
+
+    def sort_children(self) -> None:
+        """Flattens the child lists into sorted child index ranges."""
+        child_order = []
+        child_offsets = [0]
+        for children in self._children:
+            if len(children) > 1:
+                children.sort(key=lambda c: (self.end_us[c], self.start_us[c]))
+            child_order.extend(children)
+            child_offsets.append(len(child_order))
+        self.child_order = child_order
+        self.child_offsets = child_offsets
+
+    def children(self, node) -> list:
+        return self.child_order[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def out_degree(self, node) -> int:
+        return self.child_offsets[node + 1] - self.child_offsets[node]
+
+    def to_networkx(self):
+        """Exports the span tree into a networkx graph for debugging and tests.
+        Node attributes follow the former span graph: doc and invocation_type."""
+        G = nx.DiGraph(**self.graph)
+        for i, id in enumerate(self.ids):
+            if self.docs[i] is None:
+                G.add_node(id)
+            else:
+                G.add_node(id, doc=self.docs[i], invocation_type=self.invocation_type[i])
+        for i, id in enumerate(self.ids):
+            for child in self.children(i):
+                G.add_edge(id, self.ids[child])
+        return G
 
 
-def create_span_graph(trace):
-    """Returns a Networkx graph representing a single trace where
+@profiled
+def create_span_graph(trace, segments=None):
+    """Returns a SpanTree representing a single trace where
     each node represents a span (or trace segment in XRay terminology) and
     each edge represents a casual relationship.
+    segments are the decoded segment documents if already parsed (see parse_trace_segments).
     """
     # Detect missing trace duration
     if 'Duration' not in trace:
         raise Exception('Missing trace duration.')
     # Parse double JSON-encoded XRay segements
-    segments = parse_trace_segments(trace)
+    if segments is None:
+        segments = parse_trace_segments(trace)
+    duration_us = epoch_us(trace['Duration'])
     graph_attr = {
         'trace_id': trace['Id'],
-        'duration': timedelta(seconds=trace['Duration']),
+        'duration': td(duration_us),
+        'duration_us': duration_us,
         'limit_exceeded': trace['LimitExceeded']
     }
-    G = nx.DiGraph(**graph_attr)
+    G = SpanTree(**graph_attr)
     for segment in segments:
         # Optionally skip inferred segments because they are duplicates of their parents
         # if 'inferred' in segment and segment['inferred']:
@@ -61,30 +202,52 @@ def create_span_graph(trace):
         # Trace is not completed and hence some end_time is missing
         if segment.get('in_progress', False):
             raise Exception(f"Segment {segment['id']} in progress.")
-        node_attr = {
-            'doc': segment,
-            'duration': duration(segment)
-        }
-        G.add_node(segment['id'], **node_attr)
+        node = G.add_span(segment)
         if 'parent_id' in segment:
             # Special case of missing parent: creates an empty parent node if
             # the segment for the given parent_id is missing.
-            G.add_edge(segment['parent_id'], segment['id'])
+            G.add_edge(G.node(segment['parent_id']), node)
         else:
             # Special case of missing root: the segment with the root might be missing.
             G.graph['start'] = segment['id']
-        add_subsegments_recursive(G, segment)
+        add_subsegments(G, segment, node)
 
+    G.sort_children()
+    index_spans(G)
     add_global_stats(G)
     return G
 
 
+@profiled
+def index_spans(G):
+    """Precomputes the Initialization child (i.e., cold start) and the latency category
+    of every span in a single top-down pass such that the breakdown only needs lookups."""
+    G.init_child = [-1] * len(G)
+    G.category = [None] * len(G)
+    stack = []
+    for node, parent in enumerate(G.parent):
+        if parent == -1:
+            if G.origin[node] is not None:
+                G.category[node] = category_for_origin(G.origin[node],
+                                                       G.graph.get('origin_categories'))
+            stack.append(node)
+    while stack:
+        node = stack.pop()
+        for child in G.children(node):
+            if G.init_child[node] == -1 and G.name[child] == 'Initialization':
+                G.init_child[node] = child
+            if G.parent[child] == node:
+                G.category[child] = span_category(G, child, node)
+                stack.append(child)
+    return G
+
+
 def parse_trace_segments(trace) -> list:
     return list(map(lambda s: parse_segment_json(s), trace['Segments']))
 
 
 def parse_segment_json(segment_wrapper):
-    return json.loads(segment_wrapper['Document'])
+    return json_backend.loads(segment_wrapper['Document'])
 
 
 def invocation_type(parent_doc, child_doc) -> str:
@@ -106,23 +269,33 @@ def is_async_call(parent_doc, child_doc) -> bool:
     can mitigate this issue.
     Caveat: This can result in negative time differences in a latency breakdown!
     """
-    return parent_doc['end_time'] - child_doc['end_time'] + TIMESTAMP_MARGIN.total_seconds() < 0
-
-
-def add_subsegments_recursive(G, segment):
-    if 'subsegments' in segment:
-        for subsegment in segment['subsegments']:
-            # Trace is not completed and hence some end_time is missing
-            if subsegment.get('in_progress', False):
-                raise Exception(f"Subsegment {subsegment['id']} in progress.")
-            attr = {
-                'doc': subsegment,
-                'duration': duration(subsegment),
-                'subsegment': True
-            }
-            G.add_node(subsegment['id'], **attr)
-            G.add_edge(segment['id'], subsegment['id'])
-            add_subsegments_recursive(G, subsegment)
+    return is_async_end(epoch_us(parent_doc['end_time']), epoch_us(child_doc['end_time']))
+
+
+def is_async_end(parent_end_us, child_end_us) -> bool:
+    """Implements is_async_call based on integer microsecond end times."""
+    return parent_end_us - child_end_us + TIMESTAMP_MARGIN_US < 0
+
+
+def add_subsegments(G, segment, node):
+    """Adds all nested subsegments of a segment in depth-first pre-order.
+    Uses an explicit stack of subsegment iterators to support arbitrarily deep nesting."""
+    if 'subsegments' not in segment:
+        return G
+    stack = [(node, iter(segment['subsegments']))]
+    while stack:
+        parent, subsegments = stack[-1]
+        subsegment = next(subsegments, None)
+        if subsegment is None:
+            stack.pop()
+            continue
+        # Trace is not completed and hence some end_time is missing
+        if subsegment.get('in_progress', False):
+            raise Exception(f"Subsegment {subsegment['id']} in progress.")
+        child = G.add_span(subsegment)
+        G.add_edge(parent, child)
+        if 'subsegments' in subsegment:
+            stack.append((child, iter(subsegment['subsegments'])))
     return G
 
 
@@ -130,15 +303,14 @@ def duration(segment):
     return timediff(segment['start_time'], segment['end_time'])
 
 
+@profiled
 def add_global_stats(G):
     """Enriches the span graph of a trace with additional metrics
     that can be accessed via G.graph[METRIC_NAME]."""
-    # id of earliest time (i.e., start of trace)
+    # index of earliest time (i.e., start of trace)
     start = None
-    start_time = None
-    # id of latest time (i.e., end of trace)
+    # index of latest time (i.e., end of trace)
     end = None
-    end_time = None
     # List of trace ids with a downstream failure
     errors = []
     # List of trace ids causing a failure
@@ -147,46 +319,45 @@ def add_global_stats(G):
     G.graph['url'] = None
     G.graph['services'] = []
     # Iterate over all nodes to calculate global trace metrics
-    for id, attr in G.nodes(data=True):
-        if not attr:
-            raise Exception(f"Node {id} has empty attributes.")
-        doc = attr['doc']
+    for node, doc in enumerate(G.docs):
+        if doc is None:
+            raise Exception(f"Node {G.ids[node]} has empty attributes.")
         # Guess invocation type (i.e., how this trace has been invoked by its parent)
         # This cannot be done during graph construction due potentially missing parent.
         # It would naturally better fit into edges but it is mostly used in the invoked nodes.
-        parent_id = next(G.predecessors(id), None)
-        if parent_id is not None:
-            parent_node = G.nodes[parent_id]
-            if parent_node:
-                parent_doc = parent_node['doc']
-                attr['invocation_type'] = invocation_type(parent_doc, doc)
+        parent = G.parent[node]
+        if parent != -1:
+            if G.docs[parent] is not None:
+                if is_async_end(G.end_us[parent], G.end_us[node]):
+                    G.invocation_type[node] = 'async'
+                else:
+                    G.invocation_type[node] = 'sync'
             else:
                 msg = (
                     f"Incomplete trace {G.graph['trace_id']} because"
-                    f" the parent node {parent_id} of node {id} is empty."
+                    f" the parent node {G.ids[parent]} of node {G.ids[node]} is empty."
                 )
                 raise Exception(msg)
         else:  # trace root
-            attr['invocation_type'] = 'client'
+            G.invocation_type[node] = 'client'
         # Identify trace start and end times
-        if start_time is None or doc['start_time'] < start_time:
-            start_time = doc['start_time']
-            start = id
-        if end_time is None or doc['end_time'] > end_time:
-            end_time = doc['end_time']
-            end = id
+        if start is None or G.start_us[node] < G.start_us[start]:
+            start = node
+        if end is None or G.end_us[node] > G.end_us[end]:
+            end = node
         # Identify relevant characteristics
-        if 'origin' in doc:
-            G.graph['services'].append(doc['origin'])
-            if doc['origin'] == 'AWS::ApiGateway::Stage':
+        origin = G.origin[node]
+        if origin is not None:
+            G.graph['services'].append(origin)
+            if origin == 'AWS::ApiGateway::Stage':
                 G.graph['url'] = doc['http']['request']['url']
         # Keep track of special cases
         if 'error' in doc and doc['error']:
-            errors.append(id)
+            errors.append(node)
         if 'fault' in doc and doc['fault']:
-            faults.append(id)
+            faults.append(node)
         if 'throttle' in doc and doc['throttle']:
-            throttles.append(id)
+            throttles.append(node)
 
     # Validate if root node exists
     if 'start' not in G.graph:
@@ -197,52 +368,55 @@ def add_global_stats(G):
         # G.graph['start_time'] = start_time
         # G.graph['incomplete'] = True
     # Validate logical against time-based start segment
-    if G.graph['start'] == start:
-        G.graph['start_time'] = start_time
+    if G.graph['start'] == G.ids[start]:
+        G.graph['start_time'] = G.docs[start]['start_time']
     else:
         msg = (
             f"Logical first trace segment {G.graph['start']}"
-            f" does not match the earliest time (sub)segment {start}."
+            f" does not match the earliest time (sub)segment {G.ids[start]}."
             ' Ensure that the trace is fully connected and there are no clock issues.'
         )
         raise Exception(msg)
     # Validate trace duration against calculated trace duration but allowing for small margin
-    if abs(G.graph['duration'] - timediff(start_time, end_time)) > TIMESTAMP_MARGIN:
+    trace_duration_us = G.end_us[end] - G.start_us[start]
+    if abs(G.graph['duration_us'] - trace_duration_us) > TIMESTAMP_MARGIN_US:
         msg = (
             f"Trace duration {G.graph['duration']}"
-            f" does not match the calculated trace duration {timediff(start_time, end_time)}"
+            f" does not match the calculated trace duration {td(trace_duration_us)}"
             ' based on start and end times.'
             ' Ensure that the trace is fully connected and there are no clock issues.'
         )
         raise Exception(msg)
 
     # Assign globals
-    G.graph['end'] = end
-    G.graph['end_time'] = end_time
+    G.graph['end'] = G.ids[end]
+    G.graph['end_time'] = G.docs[end]['end_time']
     G.graph['errors'] = len(errors)
     G.graph['faults'] = len(faults)
     G.graph['throttles'] = len(throttles)
 
     # Critical path
     G.graph['call_stack'] = call_stack(G, end)
-    G.graph['longest_path'] = longest_path(G, start)
+    G.graph['longest_path'] = [G.ids[n] for n in longest_path(G, start)]
     return G
 
 
 def call_stack(G, end):
-    """Returns an asynchronous call stack without the root"""
+    """Returns an asynchronous call stack of node indices without the root"""
     stack = []
     node = end
-    while node:
+    while node != -1:
         stack.append(node)
-        node = next(G.predecessors(node), None)
+        node = G.parent[node]
     # Could indicate missing connection
     # assert node == G.graph['start']
     return stack
 
 
+@profiled
 def longest_path(G, node):
-    """Returns the critical path (i.e., the longest path). Initialize with the id of the start node.
+    """Returns the critical path (i.e., the longest path) as list of node indices.
+    Initialize with the index of the start node.
     Implementation based on the paper qiu:20:
     * Url: https://www.usenix.org/conference/osdi20/presentation/qiu
     * Title: "FIRM: An Intelligent Fine-grained Resource Management Framework
@@ -254,87 +428,98 @@ def longest_path(G, node):
     https://gitlab.engr.illinois.edu/DEPEND/firm/-/blob/master/metrics/analysis/cpa-training-features.py#L111
     Their actual implementation uses a while loop instead of recursion and
     assumes ordered child_nodes.
+    Similarly, this implementation replaces recursion with an explicit stack of frames.
+    Every frame visits the sorted children of a node in order followed by a
+    conditional visit of the last returning child. A shared path list accumulates the
+    visited nodes such that path[-1] is always the last node added to the longest path.
     """
+    call_stack = G.graph['call_stack']
     path = []
-    path.append(node)
-    if G.out_degree(node) == 0:
-        return path
-    # Remove node from call stack if present
-    if len(G.graph['call_stack']) > 0 and G.graph['call_stack'][-1] == node:
-        G.graph['call_stack'].pop()
-    sorted_children = get_sorted_children(G, node)
-    last_returning_child = sorted_children[-1]
-    for child in sorted_children:
-        if happens_before(G, child, last_returning_child):
-            last_doc = G.nodes[path[-1]]['doc']
-            parent_doc = G.nodes[node]['doc']
-            # Only recurse into synchronous calls if there is not already
-            # a longer asynchronous call present
-            if last_doc['end_time'] <= parent_doc['end_time']:
-                path.extend(longest_path(G, child))
-    # Conditionally recurse into last_returning_child
-    parent_doc = G.nodes[node]['doc']
-    child_doc = G.nodes[last_returning_child]['doc']
-    if is_async_call(parent_doc, child_doc):
-        # Check against call stack for asynchronous calls by only following calls that are
-        # connected to the end node with the latest timestamp
-        if len(G.graph['call_stack']) > 0 and G.graph['call_stack'][-1] == last_returning_child:
-            path.extend(longest_path(G, last_returning_child))
-    else:
-        # Only recurse into synchronous calls if there is not already
-        # a longer asynchronous call present
-        last_doc = G.nodes[path[-1]]['doc']
-        if last_doc['end_time'] <= parent_doc['end_time']:
-            path.extend(longest_path(G, last_returning_child))
-
-    return path
+    # Frames of [node, position of the next child to visit]
+    frames = []
+    visit = node
+    while True:
+        if visit is not None:
+            path.append(visit)
+            if G.out_degree(visit) > 0:
+                # Remove node from call stack if present
+                if len(call_stack) > 0 and call_stack[-1] == visit:
+                    call_stack.pop()
+                frames.append([visit, 0])
+            visit = None
+        if not frames:
+            return path
+        frame = frames[-1]
+        node, position = frame
+        frame[1] += 1
+        sorted_children = get_sorted_children(G, node)
+        last_returning_child = sorted_children[-1]
+        if position < len(sorted_children):
+            child = sorted_children[position]
+            if happens_before(G, child, last_returning_child):
+                # Only recurse into synchronous calls if there is not already
+                # a longer asynchronous call present
+                if G.end_us[path[-1]] <= G.end_us[node]:
+                    visit = child
+        elif position == len(sorted_children):
+            # Conditionally recurse into last_returning_child
+            if is_async_end(G.end_us[node], G.end_us[last_returning_child]):
+                # Check against call stack for asynchronous calls by only following calls that are
+                # connected to the end node with the latest timestamp
+                if len(call_stack) > 0 and call_stack[-1] == last_returning_child:
+                    visit = last_returning_child
+            else:
+                # Only recurse into synchronous calls if there is not already
+                # a longer asynchronous call present
+                if G.end_us[path[-1]] <= G.end_us[node]:
+                    visit = last_returning_child
+        else:
+            frames.pop()
 
 
 def get_sorted_children(G, node):
-    """Returns a list of child ids sorted in ascending order
+    """Returns a list of child indices sorted in ascending order
     primarily by end_time and secondarily by start_time.
     The secondary sort key is necessary to resolve special cases where
     two consecutive children have the same end_time (i.e., duration = 0ms)
     but one happens earlier indicated by an earlier start_time.
     Example timeline: start1<end1=start2=end2
+    The order is established once by SpanTree.sort_children.
     """
-    succ_ids = G.successors(node)
-    sorted_ids = sorted(succ_ids, key=lambda id: (G.nodes[id]['doc']['end_time'], G.nodes[id]['doc']['start_time']))  # noqa: E501
-    return sorted_ids
+    return G.children(node)
 
 
 def happens_before(G, first, second):
     """Returns true if first happens before second in sequential order."""
-    first_doc = G.nodes[first]['doc']
-    second_doc = G.nodes[second]['doc']
-    return first_doc['end_time'] <= second_doc['start_time']
+    return G.end_us[first] <= G.start_us[second]
 
 
+@profiled
 def calculate_breakdown(G):
+    """Calculates the latency breakdown along the longest path.
+    Critical path entries represent start_time, end_time, and duration
+    as integer microseconds. Only the summed categories are converted into timedeltas."""
     # Initialize cold start counter, updated along the way
     G.graph['num_cold_starts'] = 0
-    longest_path = G.graph['longest_path']
+    longest_path = [G.index[id] for id in G.graph['longest_path']]
     peek_iter = peekable(longest_path)
     critical_path = []
-    for id in peek_iter:
-        node = G.nodes[id]
-        doc = G.nodes[id]['doc']
-        next_id = peek_iter.peek(None)
-        if next_id is not None:
-            next_node = G.nodes[next_id]
+    for node in peek_iter:
+        next_node = peek_iter.peek(None)
+        if next_node is not None:
             critical_path.extend(pair_path(G, peek_iter, node, next_node))
         else:
             # doc span itself
             critical_path.append({
-                'start_time': doc['start_time'],
-                'end_time': doc['end_time'],
-                'duration': timediff(doc['start_time'], doc['end_time']),
-                'resource': doc['id'],
+                'start_time': G.start_us[node],
+                'end_time': G.end_us[node],
+                'duration': G.end_us[node] - G.start_us[node],
+                'resource': G.ids[node],
                 'type': 'span',
-                'category': category_for_doc(G, doc)
+                'category': category_for_doc(G, node)
             })
             # potential sync transition back to parent
-            critical_path.extend(add_sync_return(G, doc))
+            critical_path.extend(add_sync_return(G, node))
 
             # OLD IMPL:
             # parent_doc_id = next(G.predecessors(id), None)
@@ -359,14 +544,14 @@ def calculate_breakdown(G):
     G.graph['longest_path_names'] = []
     G.graph['longest_path_details'] = []
     for n in longest_path:
-        doc = G.nodes[n]['doc']
+        doc = G.docs[n]
         G.graph['longest_path_details'].append(
             {'id': doc['id'],
              'name': doc['name'],
              'start_time': doc['start_time'],
              'end_time': doc['end_time'],
-             'origin': doc.get('origin', None),
-             'invocation_type': G.nodes[n].get('invocation_type', None)}
+             'origin': G.origin[n],
+             'invocation_type': G.invocation_type[n]}
         )
         G.graph['longest_path_names'].append(doc['name'])
         if 'resource_arn' in doc:
@@ -375,64 +560,62 @@ def calculate_breakdown(G):
             pass
     # List critical path:
     critical_path_details = []
-    curr_duration = timedelta()
-    start = G.graph['start_time']
-    G.graph['unclassified'] = timedelta()
+    curr_duration = 0
+    start = epoch_us(G.graph['start_time'])
+    categories = {'unclassified': 0}
     for e in critical_path:
-        if e['category'] in G.graph:
-            G.graph[e['category']] += e['duration']
-        else:
-            G.graph[e['category']] = e['duration']
-        critical_path_details.append(f"{e['duration']} {e['type']}:{e['category']} \t{e['resource']}:{G.nodes[e['resource']]['doc']['name'] if e['resource'] else ''} \t{e.get('source', '')}=>{e.get('target', '')}")  # noqa: E501
+        categories[e['category']] = categories.get(e['category'], 0) + e['duration']
+        critical_path_details.append(f"{td(e['duration'])} {e['type']}:{e['category']} \t{e['resource']}:{G.name[G.index[e['resource']]] if e['resource'] else ''} \t{e.get('source', '')}=>{e.get('target', '')}")  # noqa: E501
         # Validation
         curr_duration += e['duration']
-        assert curr_duration == timediff(start, e['end_time']), f"Summed duration {curr_duration} does not match difference to trace start_time."  # noqa: E501
+        assert curr_duration == e['end_time'] - start, f"Summed duration {td(curr_duration)} does not match difference to trace start_time."  # noqa: E501
+    # Convert category durations into timedeltas at the output edge
+    for category, category_duration in categories.items():
+        G.graph[category] = td(category_duration)
     G.graph['critical_path'] = critical_path
     G.graph['critical_path_details'] = critical_path_details
     # Checks
-    assert abs(G.graph['duration'] - curr_duration) < TIMESTAMP_MARGIN, f"Trace duration {G.graph['duration']} does not match latency breakdown {curr_duration} within margin {TIMESTAMP_MARGIN}."  # noqa: E501
+    assert abs(G.graph['duration_us'] - curr_duration) < TIMESTAMP_MARGIN_US, f"Trace duration {G.graph['duration']} does not match latency breakdown {td(curr_duration)} within margin {TIMESTAMP_MARGIN}."  # noqa: E501
     return G
 
 
-def add_sync_return(G, doc):
+def add_sync_return(G, node):
+    """Returns the synchronous returns from a node up to its
+    first ancestor that has been invoked asynchronously or the root."""
     critical_path = []
-    parent_doc_id = next(G.predecessors(doc['id']), None)
-    if parent_doc_id is not None:
-        parent_doc = G.nodes[parent_doc_id]['doc']
-        child = G.nodes[doc['id']]
-        if child['invocation_type'] == 'sync':
-            critical_path.append({
-                'start_time': doc['end_time'],
-                'end_time': parent_doc['end_time'],
-                'duration': timediff(doc['end_time'], parent_doc['end_time']),
-                'resource': parent_doc['id'],
-                'source': doc['id'],
-                'target': parent_doc['id'],
-                'type': 'sync-receive',
-                'category': category_for_doc(G, parent_doc)
-            })
-            critical_path.extend(add_sync_return(G, parent_doc))
+    parent = G.parent[node]
+    while parent != -1 and G.invocation_type[node] == 'sync':
+        critical_path.append({
+            'start_time': G.end_us[node],
+            'end_time': G.end_us[parent],
+            'duration': G.end_us[parent] - G.end_us[node],
+            'resource': G.ids[parent],
+            'source': G.ids[node],
+            'target': G.ids[parent],
+            'type': 'sync-receive',
+            'category': category_for_doc(G, parent)
+        })
+        node = parent
+        parent = G.parent[node]
     return critical_path
 
 
 def pair_path(G, peek_iter, node, next_node):
     """Returns the critical sub-path for a pair of two consecutive nodes (i.e., doc, next_doc)"""
-    doc = node['doc']
-    next_doc = next_node['doc']
     critical_path = []
-    if next_node['invocation_type'] == 'async':
+    if G.invocation_type[next_node] == 'async':
         # Adjust start if there is a different prior node in the longest path with a later end time
-        latest_start = doc['start_time']
+        latest_start = G.start_us[node]
         # Count non-overlapping part in parent and overlapping part in child
-        early_end = min(doc['end_time'], next_doc['start_time'])
+        early_end = min(G.end_us[node], G.start_us[next_node])
         # doc span itself till potential adjusted end
         critical_path.append({
             'start_time': latest_start,
             'end_time': early_end,
-            'duration': timediff(latest_start, early_end),
-            'resource': doc['id'],
+            'duration': early_end - latest_start,
+            'resource': G.ids[node],
             'type': 'span',
-            'category': category_for_doc(G, doc)
+            'category': category_for_doc(G, node)
         })
 
         # # TODO: check monotonically increasing time somewhere globally
@@ -443,115 +626,111 @@ def pair_path(G, peek_iter, node, next_node):
         # async doc transition to next_doc span
         critical_path.append({
             'start_time': early_end,
-            'end_time': next_doc['start_time'],
-            'duration': timediff(early_end, next_doc['start_time']),
+            'end_time': G.start_us[next_node],
+            'duration': G.start_us[next_node] - early_end,
             'resource': None,
-            'source': doc['id'],
-            'target': next_doc['id'],
+            'source': G.ids[node],
+            'target': G.ids[next_node],
             'type': 'async-send',
             'category': 'trigger'
         })
     # Handle special synchronous call into lambda function coldstart
-    elif is_cold_start_lambda_function(G, next_doc):
+    elif is_cold_start_lambda_function(G, next_node):
         G.graph['num_cold_starts'] += 1
         # This is a special case because the Initialization segment
         # cause by 'AWS:Lambda:Function' before its parent in the timeline.
-        init_doc_id = init_lambda_segment(G, next_doc)
-        init_doc = G.nodes[init_doc_id]['doc']
+        init_node = init_lambda_segment(G, next_node)
         # implicit container init
         critical_path.append({
-            'start_time': doc['start_time'],
-            'end_time': init_doc['start_time'],
-            'duration': timediff(doc['start_time'], init_doc['start_time']),
-            'resource': doc['id'],
+            'start_time': G.start_us[node],
+            'end_time': G.start_us[init_node],
+            'duration': G.start_us[init_node] - G.start_us[node],
+            'resource': G.ids[node],
             'type': 'span-parent',
             'category': 'container_initialization'
         })
         # runtime init span
         critical_path.append({
-            'start_time': init_doc['start_time'],
-            'end_time': init_doc['end_time'],
-            'duration': timediff(init_doc['start_time'], init_doc['end_time']),
-            'resource': init_doc['id'],
+            'start_time': G.start_us[init_node],
+            'end_time': G.end_us[init_node],
+            'duration': G.end_us[init_node] - G.start_us[init_node],
+            'resource': G.ids[init_node],
             'type': 'span',
             'category': 'runtime_initialization'
         })
         # transition from runtime init to lambda function span
         critical_path.append({
-            'start_time': init_doc['end_time'],
-            'end_time': next_doc['start_time'],
-            'duration': timediff(init_doc['end_time'], next_doc['start_time']),
-            'resource': doc['id'],
-            'source': init_doc['id'],
-            'target': next_doc['id'],
+            'start_time': G.end_us[init_node],
+            'end_time': G.start_us[next_node],
+            'duration': G.start_us[next_node] - G.end_us[init_node],
+            'resource': G.ids[node],
+            'source': G.ids[init_node],
+            'target': G.ids[next_node],
             'type': 'span-parent',
-            'category': category_for_doc(G, doc)
+            'category': category_for_doc(G, node)
         })
         # skip two next spans being handled here as special case
         _ = next(peek_iter)  # function_id
         _ = next(peek_iter, None)  # init_id
-        post_init_id = peek_iter.peek(None)
+        post_init = peek_iter.peek(None)
         # Handle lambda function and the span following initialization
-        if post_init_id is not None:
-            post_init = G.nodes[post_init_id]
+        if post_init is not None:
             critical_path.extend(pair_path(G, peek_iter, next_node, post_init))
         else:
             # TODO: generalize and extract this code into a method (almost same as below)
             # span itself
             critical_path.append({
-                'start_time': next_doc['start_time'],
-                'end_time': next_doc['end_time'],
-                'duration': timediff(next_doc['start_time'], next_doc['end_time']),
-                'resource': next_doc['id'],
+                'start_time': G.start_us[next_node],
+                'end_time': G.end_us[next_node],
+                'duration': G.end_us[next_node] - G.start_us[next_node],
+                'resource': G.ids[next_node],
                 'type': 'span',
-                'category': category_for_doc(G, next_doc)
+                'category': category_for_doc(G, next_node)
             })
             # b) time-based (alternative): current span end time <= end time of trace
-            current_doc = next_doc
-            # Follow predecessor of current_doc (i.e., parent)
-            parent_id = next(G.predecessors(current_doc['id']))
-            parent_doc = G.nodes[parent_id]['doc']
+            current = next_node
+            # Follow predecessor of current (i.e., parent)
+            parent = parent_index(G, current)
             # Ensure monotonically increasing time
-            while parent_doc['end_time'] >= current_doc['end_time']:
+            while G.end_us[parent] >= G.end_us[current]:
                 critical_path.append({
-                    'start_time': current_doc['end_time'],
-                    'end_time': parent_doc['end_time'],
-                    'duration': timediff(current_doc['end_time'], parent_doc['end_time']),
-                    'resource': parent_doc['id'],
-                    'source': current_doc['id'],
-                    'target': parent_doc['id'],
+                    'start_time': G.end_us[current],
+                    'end_time': G.end_us[parent],
+                    'duration': G.end_us[parent] - G.end_us[current],
+                    'resource': G.ids[parent],
+                    'source': G.ids[current],
+                    'target': G.ids[parent],
                     'type': 'sync-receive',
-                    'category': category_for_doc(G, parent_doc)
+                    'category': category_for_doc(G, parent)
                 })
-                current_doc = parent_doc
-                # Follow predecessor of current_doc (i.e., parent)
-                parent_id = next(G.predecessors(current_doc['id']), None)
-                if parent_id is None:  # Returned till root
+                current = parent
+                # Follow predecessor of current (i.e., parent)
+                parent = G.parent[current]
+                if parent == -1:  # Returned till root
                     break
-                parent_doc = G.nodes[parent_id]['doc']
     else:  # assuming regular synchronous call (impossible to determine 100%)
         # Drill in where current doc is parent and next_doc a synchronous invocation
-        if is_parent(G, doc['id'], next_doc['id']):
+        if is_parent(G, node, next_node):
             # sync doc transition into next_doc span
             critical_path.append({
-                'start_time': doc['start_time'],
-                'end_time': next_doc['start_time'],
-                'duration': timediff(doc['start_time'], next_doc['start_time']),
-                'resource': doc['id'],
-                'source': doc['id'],
-                'target': next_doc['id'],
+                'start_time': G.start_us[node],
+                'end_time': G.start_us[next_node],
+                'duration': G.start_us[next_node] - G.start_us[node],
+                'resource': G.ids[node],
+                'source': G.ids[node],
+                'target': G.ids[next_node],
                 'type': 'sync-send',
-                'category': category_for_doc(G, doc)
+                'category': category_for_doc(G, node)
             })
         else:
             # span itself
             critical_path.append({
-                'start_time': doc['start_time'],
-                'end_time': doc['end_time'],
-                'duration': timediff(doc['start_time'], doc['end_time']),
-                'resource': doc['id'],
+                'start_time': G.start_us[node],
+                'end_time': G.end_us[node],
+                'duration': G.end_us[node] - G.start_us[node],
+                'resource': G.ids[node],
                 'type': 'span',
-                'category': category_for_doc(G, doc)
+                'category': category_for_doc(G, node)
             })
             # Returning synchronous call
             # critical_path.extend(add_sync_return(G, doc))
@@ -575,117 +754,145 @@ def pair_path(G, peek_iter, node, next_node):
 
             # TODO: check whether we can re-use sync-return here?!
             # b) time-based (alternative): current span end time <= next_doc['start_time']
-            current_doc = doc
-            # Follow predecessor of current_doc (i.e., parent)
-            parent_id = next(G.predecessors(current_doc['id']))
-            parent_doc = G.nodes[parent_id]['doc']
-            while parent_doc['end_time'] <= next_doc['start_time']:
+            current = node
+            # Follow predecessor of current (i.e., parent)
+            parent = parent_index(G, current)
+            while G.end_us[parent] <= G.start_us[next_node]:
                 critical_path.append({
-                    'start_time': current_doc['end_time'],
-                    'end_time': parent_doc['end_time'],
-                    'duration': timediff(current_doc['end_time'], parent_doc['end_time']),
-                    'resource': parent_doc['id'],
-                    'source': current_doc['id'],
-                    'target': parent_doc['id'],
+                    'start_time': G.end_us[current],
+                    'end_time': G.end_us[parent],
+                    'duration': G.end_us[parent] - G.end_us[current],
+                    'resource': G.ids[parent],
+                    'source': G.ids[current],
+                    'target': G.ids[parent],
                     'type': 'sync-receive',
-                    'category': category_for_doc(G, parent_doc)
+                    'category': category_for_doc(G, parent)
                 })
-                current_doc = parent_doc
-                # Follow predecessor of current_doc (i.e., parent)
-                parent_id = next(G.predecessors(current_doc['id']))
-                parent_doc = G.nodes[parent_id]['doc']
+                current = parent
+                # Follow predecessor of current (i.e., parent)
+                parent = parent_index(G, current)
 
             # sync doc transition over and across to next_doc span via common parent
-            parent_id = next(G.predecessors(next_doc['id']))
-            parent_doc = G.nodes[parent_id]['doc']
+            parent = parent_index(G, next_node)
             critical_path.append({
-                'start_time': current_doc['end_time'],
-                'end_time': next_doc['start_time'],
-                'duration': timediff(current_doc['end_time'], next_doc['start_time']),
-                'resource': parent_id,
-                'source': current_doc['id'],
-                'target': next_doc['id'],
+                'start_time': G.end_us[current],
+                'end_time': G.start_us[next_node],
+                'duration': G.start_us[next_node] - G.end_us[current],
+                'resource': G.ids[parent],
+                'source': G.ids[current],
+                'target': G.ids[next_node],
                 'type': 'span-parent',
-                'category': category_for_doc(G, parent_doc)
+                'category': category_for_doc(G, parent)
             })
 
     return critical_path
 
 
-def is_parent(G, candiate_parent_id, node_id):
-    """Returns true if the candidate_parent_id is a predecessor
-    node of the given node_id and false otherwise."""
-    predecessors = G.predecessors(node_id)
-    parent = next(predecessors, None)
-    if parent is None:
-        return False
-    else:
-        return parent == candiate_parent_id
+def parent_index(G, node) -> int:
+    """Returns the parent index of a node and fails for a root node without parent."""
+    parent = G.parent[node]
+    if parent == -1:
+        raise Exception(f"Node {G.ids[node]} has no parent.")
+    return parent
 
 
-def is_cold_start_lambda_function(G, doc):
-    return 'origin' in doc and \
-        doc['origin'] == 'AWS::Lambda::Function' and \
-        init_lambda_segment(G, doc) is not None
+def is_parent(G, candiate_parent, node):
+    """Returns true if the candidate_parent is the predecessor
+    node of the given node and false otherwise."""
+    return G.parent[node] == candiate_parent
 
 
-# MAYBE: Could alternatively implement with lookahead of 3 elements
-def init_lambda_segment(G, lambda_function_doc):
-    """Returns the Initialization subsegment id of a lambda function or None if warm start."""
-    lambda_subsegments = G.successors(lambda_function_doc['id'])
-    init_subsegments = (s for s in lambda_subsegments if G.nodes[s]['doc']['name'] == 'Initialization')  # noqa: E501
-    return next(init_subsegments, None)
+def is_cold_start_lambda_function(G, node):
+    return G.origin[node] == 'AWS::Lambda::Function' and \
+        G.init_child[node] != -1
 
 
-def category_for_doc(G, doc) -> str:
-    if 'origin' in doc:
-        return category_for_origin(doc['origin'])
+def init_lambda_segment(G, lambda_function):
+    """Returns the Initialization subsegment index of a lambda function or None if warm start."""
+    init_node = G.init_child[lambda_function]
+    return init_node if init_node != -1 else None
 
-    parent_id = next(G.predecessors(doc['id']))
-    parent_doc = G.nodes[parent_id]['doc']
+
+def category_for_doc(G, node) -> str:
+    """Returns the precomputed latency category of the span at the given node index."""
+    category = G.category[node]
+    # Only spans below a logical root without origin remain uncategorized
+    while category is None:
+        node = parent_index(G, node)
+        category = G.category[node]
+    return category
+
+
+def span_category(G, node, parent) -> str:
+    """Returns the latency category of a span given the already categorized parent span."""
+    origin = G.origin[node]
+    if origin is not None:
+        return category_for_origin(origin, G.graph.get('origin_categories'))
 
     # special case for AWS::Lambda::Function
     # special Lambda cases
-    if 'origin' in parent_doc:
-        if parent_doc['origin'] == 'AWS::Lambda::Function':
-            lambda_mappings = {
-                'Overhead': 'overhead',
-                'Invocation': 'computation',
-                'Initialization': 'runtime_initialization',
-                # AWS::Lambda
-                'Dwell Time': 'queing'
-            }
-            return lambda_mappings.get(doc['name'], 'unclassified')
-        if parent_doc['origin'] == 'AWS::Lambda' and doc['name'] == 'Dwell Time':
-            return 'queing'
+    parent_origin = G.origin[parent]
+    if parent_origin == 'AWS::Lambda::Function':
+        lambda_mappings = {
+            'Overhead': 'overhead',
+            'Invocation': 'computation',
+            'Initialization': 'runtime_initialization',
+            # AWS::Lambda
+            'Dwell Time': 'queing'
+        }
+        return lambda_mappings.get(G.name[node], 'unclassified')
+    if parent_origin == 'AWS::Lambda' and G.name[node] == 'Dwell Time':
+        return 'queing'
 
     # Use origin mapping of parent assuming that every valid trace segment has an origin field.
-    return category_for_doc(G, parent_doc)
-
-
-def category_for_origin(origin) -> str:
-    # List of AWS resource types:
-    # https://docs.aws.amazon.com/config/latest/developerguide/resource-config-reference.html
-    category_mappings = {
-        # Triggers
-        'AWS::ApiGateway::Stage': 'orchestration',
-        'AWS::StepFunctions::StateMachine': 'orchestration',
-        'AWS::stepfunctions': 'orchestration',
-        'AWS::STEPFUNCTIONS': 'orchestration',
-        # AWS Lambda
-        'AWS::Lambda': 'orchestration',
-        'AWS::Lambda::Function': 'computation',
-        # External services
-        'AWS::S3::Bucket': 'external_service',
-        'AWS::S3': 'external_service',
-        'AWS::DynamoDB::Table': 'external_service',
-        'AWS::SQS::Queue': 'external_service',
-        'AWS::SNS': 'external_service',
-        'Database::SQL': 'external_service',
-        'AWS::Kinesis': 'external_service',
-        'AWS::rekognition': 'external_service'
-    }
-    return category_mappings.get(origin, 'unclassified')
+    return G.category[parent]
+
+
+"""Latency category of spans by origin.
+List of AWS resource types:
+https://docs.aws.amazon.com/config/latest/developerguide/resource-config-reference.html
+Span trees of other providers define their own mapping as origin_categories trace attribute
+(e.g., sb.azure_span_tree).
+"""
+ORIGIN_CATEGORIES = {
+    # Triggers
+    'AWS::ApiGateway::Stage': 'orchestration',
+    'AWS::StepFunctions::StateMachine': 'orchestration',
+    'AWS::stepfunctions': 'orchestration',
+    'AWS::STEPFUNCTIONS': 'orchestration',
+    # AWS Lambda
+    'AWS::Lambda': 'orchestration',
+    'AWS::Lambda::Function': 'computation',
+    # External services
+    'AWS::S3::Bucket': 'external_service',
+    'AWS::S3': 'external_service',
+    'AWS::DynamoDB::Table': 'external_service',
+    'AWS::SQS::Queue': 'external_service',
+    'AWS::SNS': 'external_service',
+    'Database::SQL': 'external_service',
+    'AWS::Kinesis': 'external_service',
+    'AWS::rekognition': 'external_service'
+}
+
+
+def category_for_origin(origin, origin_categories=None) -> str:
+    if origin_categories is None:
+        origin_categories = ORIGIN_CATEGORIES
+    return origin_categories.get(origin, 'unclassified')
+
+
+"""Latency categories of the critical path breakdown."""
+CATEGORIES = [
+    'orchestration',
+    'trigger',
+    'container_initialization',
+    'runtime_initialization',
+    'computation',
+    'queing',
+    'overhead',
+    'external_service',
+    'unclassified'
+]
 
 
 CSV_FIELDS = [
@@ -699,18 +906,145 @@ CSV_FIELDS = [
     'throttles',
     'faults',
     'services',
-    'longest_path_names',
-    # categories:
-    'orchestration',
-    'trigger',
-    'container_initialization',
-    'runtime_initialization',
-    'computation',
-    'queing',
-    'overhead',
-    'external_service',
-    'unclassified'
-]
+    'longest_path_names'
+] + CATEGORIES
+
+
+"""Number of traces.json lines analyzed as one unit of work and written per CSV chunk.
+Bounds the memory of AwsTraceAnalyzer.analyze_traces independent of the file size.
+"""
+DEFAULT_CHUNK_SIZE = 1000
+
+
+"""Declarative rules extracting timestamps of the thumbnail app into trace_breakdown.csv.
+Each output column maps to a rule with a path of span matchers and a value:
+* path: list of matchers by origin and/or name. The first matcher applies to the
+  trace segments and every further matcher to the direct subsegments of the previous match.
+* value: start_time or end_time of the matched span, or exists (1 if any span matches else 0).
+The last matching span in document order determines the value of a column.
+Benchmarks can define their own rules under `trace_timestamps` in their BENCHMARK_CONFIG.
+"""
+THUMBNAIL_TIMESTAMP_RULES = {
+    't1': {'path': [{'origin': 'AWS::ApiGateway::Stage'}], 'value': 'start_time'},
+    't2': {'path': [{'origin': 'AWS::Lambda', 'name': 'thumbnail-upload'}], 'value': 'start_time'},
+    't3': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-upload'},
+                    {'name': 'Invocation'},
+                    {'name': 'Upload Preparation'}], 'value': 'start_time'},
+    't4': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-upload'},
+                    {'name': 'Invocation'},
+                    {'name': 'Upload S3 PUT Operation'}], 'value': 'start_time'},
+    't5': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-upload'},
+                    {'name': 'Invocation'},
+                    {'name': 'Upload S3 PUT Operation'},
+                    {'name': 'S3'}], 'value': 'start_time'},
+    't6': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-upload'},
+                    {'name': 'Invocation'},
+                    {'name': 'Upload S3 PUT Operation'},
+                    {'name': 'S3'}], 'value': 'end_time'},
+    't7': {'path': [{'origin': 'AWS::Lambda', 'name': 'thumbnail-create-thumbnail'}],
+           'value': 'start_time'},
+    't8': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-create-thumbnail'},
+                    {'name': 'Invocation'},
+                    {'name': 'CreateThumbnail Read Operation'}], 'value': 'start_time'},
+    't9': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-create-thumbnail'},
+                    {'name': 'Invocation'},
+                    {'name': 'CreateThumbnail Read Operation'},
+                    {'name': 'S3'}], 'value': 'start_time'},
+    't10': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-create-thumbnail'},
+                     {'name': 'Invocation'},
+                     {'name': 'CreateThumbnail Read Operation'},
+                     {'name': 'S3'}], 'value': 'end_time'},
+    't11': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-create-thumbnail'},
+                     {'name': 'Invocation'},
+                     {'name': 'CreateThumbnail S3 PUT Operation'}], 'value': 'start_time'},
+    't12': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-create-thumbnail'},
+                     {'name': 'Invocation'},
+                     {'name': 'CreateThumbnail S3 PUT Operation'},
+                     {'name': 'S3'}], 'value': 'start_time'},
+    't13': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-create-thumbnail'},
+                     {'name': 'Invocation'},
+                     {'name': 'CreateThumbnail S3 PUT Operation'},
+                     {'name': 'S3'}], 'value': 'end_time'},
+    'f1_cold_start': {'path': [{'origin': 'AWS::Lambda::Function', 'name': 'thumbnail-upload'},
+                               {'name': 'Initialization'}], 'value': 'exists'},
+    'f2_cold_start': {'path': [{'origin': 'AWS::Lambda::Function',
+                                'name': 'thumbnail-create-thumbnail'},
+                               {'name': 'Initialization'}], 'value': 'exists'}
+}
+
+TIMESTAMP_RULE_VALUES = ['start_time', 'end_time', 'exists']
+
+BREAKDOWN_FIELDS = ['trace_id'] + list(THUMBNAIL_TIMESTAMP_RULES)
+
+
+def compile_timestamp_rules(rules) -> dict:
+    """Compiles timestamp rules into a trie of lookup tables where every state maps
+    (origin, name) keys of matching spans to the next state. A None key part matches any
+    origin or name. Each state lists the (column, value) pairs extracted from its matches."""
+    root = {'next': {}, 'values': []}
+    for column, rule in rules.items():
+        path = rule.get('path') or []
+        value = rule.get('value', 'start_time')
+        if len(path) == 0:
+            raise Exception(f"Timestamp rule {column} has an empty path.")
+        if value not in TIMESTAMP_RULE_VALUES:
+            raise Exception(f"Timestamp rule {column} has an unsupported value {value}.")
+        state = root
+        for matcher in path:
+            key = (matcher.get('origin'), matcher.get('name'))
+            state = state['next'].setdefault(key, {'next': {}, 'values': []})
+        state['values'].append((column, value))
+    return root
+
+
+def matching_states(state, doc) -> list:
+    """Returns the next states of all matchers in a compiled state that match the span doc."""
+    origin = doc.get('origin')
+    name = doc.get('name')
+    lookup = state['next']
+    states = []
+    for key in dict.fromkeys([(origin, name), (origin, None), (None, name), (None, None)]):
+        next_state = lookup.get(key)
+        if next_state is not None:
+            states.append(next_state)
+    return states
+
+
+@profiled
+def extract_timestamps(docs, compiled_rules) -> dict:
+    """Applies compiled timestamp rules in a single depth-first walk over the decoded segment
+    documents of a trace (see parse_trace_segments).
+    Only descends into subsegments of spans that match a rule prefix.
+    Returns the raw extracted values by column."""
+    values = {}
+    stack = [(compiled_rules, iter(docs))]
+    while stack:
+        state, docs = stack[-1]
+        doc = next(docs, None)
+        if doc is None:
+            stack.pop()
+            continue
+        # Reverse order such that the first matching state is walked first
+        for next_state in reversed(matching_states(state, doc)):
+            for (column, value) in next_state['values']:
+                values[column] = 1 if value == 'exists' else doc.get(value)
+            if next_state['next'] and 'subsegments' in doc:
+                stack.append((next_state, iter(doc['subsegments'])))
+    return values
+
+
+def add_category_latencies(sketches, G) -> None:
+    """Adds the critical path latency per category of a span graph to sketches.
+    Skips traces whose latency breakdown fails."""
+    try:
+        G = calculate_breakdown(G)
+    except Exception as e:
+        logging.debug(f"Skip critical path latencies of trace {G.graph['trace_id']}. {e}")
+        return
+    for category in CATEGORIES:
+        duration = G.graph.get(category)
+        if duration is not None:
+            sketches.add('categories', category, duration / timedelta(milliseconds=1))
 
 
 def extract_trace_breakdown(trace, fields=CSV_FIELDS):
@@ -728,8 +1062,45 @@ class AwsTraceAnalyzer:
     2) Saves a log of invalid trace into invalid_traces.csv
     """
 
-    def __init__(self, log_path) -> None:
+    def __init__(self, log_path, workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                 timestamp_rules=None, incremental=False, output_format='csv',
+                 sketches=False, service_map=False, profile=False) -> None:
+        """
+        Args:
+            log_path: Path to a traces.json file.
+            workers: Number of worker processes analyzing chunks in parallel.
+                None uses all available CPUs.
+            chunk_size: Number of traces analyzed and written per chunk.
+            timestamp_rules: Timestamp rules by output column (see THUMBNAIL_TIMESTAMP_RULES).
+                Defaults to the rules of the thumbnail app.
+            incremental: Resumes from the checkpoint of a previous analysis and
+                only appends the results of traces added since then.
+            output_format: csv or parquet (see OUTPUT_FORMATS).
+            sketches: Saves quantile sketches of the latencies per critical path category
+                and per timestamp interval into trace_breakdown.sketches.json.
+            service_map: Saves the calls between services aggregated across all valid traces
+                into service_map.json (see ServiceMap).
+            profile: Saves the cumulative time per analysis phase and the slowest traces
+                into trace_breakdown.profile.json (see AnalysisProfile).
+        """
         self.log_path = log_path
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timestamp_rules = timestamp_rules or THUMBNAIL_TIMESTAMP_RULES
+        self.compiled_rules = compile_timestamp_rules(self.timestamp_rules)
+        self.fields = ['trace_id'] + list(self.timestamp_rules)
+        self.timestamp_fields = [column for column, rule in self.timestamp_rules.items()
+                                 if rule.get('value') != 'exists']
+        self.incremental = incremental
+        validate_output_format(output_format, incremental)
+        self.output_format = output_format
+        if sketches and incremental:
+            raise Exception('Latency sketches are not supported for incremental analysis.')
+        self.sketches = sketches
+        if service_map and incremental:
+            raise Exception('Service maps are not supported for incremental analysis.')
+        self.service_map = service_map
+        self.profile = profile
 
     # def analyze_traces(self):
     #     file = Path(self.log_path)
@@ -765,156 +1136,159 @@ class AwsTraceAnalyzer:
     #         logging.warning(f"Detected {num_invalid_traces} ({invalid_rate}%) invalid traces. Written to {invalid_file.name}.")  # noqa: E501
 
     def analyze_traces(self):
+        """Streams traces.json in chunks of lines and writes the results of each chunk
+        into trace_breakdown.csv (or .parquet) before reading further. Chunks are optionally
+        analyzed in parallel by a process pool while preserving the order of traces.json."""
         file = Path(self.log_path)
-        breakdown_file = file.parent / 'trace_breakdown.csv'
-        traces_file = file.parent / 'traces.json'
-
-        # Clear traces data
-        open(breakdown_file, 'w').close()
-
-        # Using readline()
-        file1 = open(traces_file, 'r')
-        count = 0
-
-        results = []
-        while True:
-            # Get next line from file
-            line = file1.readline()
-
-            # if line is empty
-            # end of file is reached
-            if not line:
-                break
-
-            data = json.loads(line)
-            result = self.analyze_trace(data['Segments'], data['Id'])
-            results.append(result)
-            count += 1
-
-        result_df = pd.DataFrame(results)
-        result_df.to_csv(breakdown_file, sep=',', index=False)
-
-        file1.close()
-
-        num_valid_traces = count
+        traces_file = traces_file_of(file)
+        breakdown_file = breakdown_path(traces_file, self.output_format)
+
+        latency_sketches = LatencySketches()
+        service_map = ServiceMap()
+        profile = AnalysisProfile() if self.profile else None
+
+        def map_chunks(line_chunks):
+            for (results, sketches, chunk_service_map, chunk_profile), offset in \
+                    self.map_chunks(line_chunks):
+                if sketches is not None:
+                    latency_sketches.merge(sketches)
+                if chunk_service_map is not None:
+                    service_map.merge(chunk_service_map)
+                if chunk_profile is not None:
+                    profile.merge(chunk_profile)
+                yield results, offset
+
+        # Measures writing the breakdown in this process
+        previous_profile = use_profile(profile)
+        try:
+            with Phase('analyze_traces'):
+                if self.output_format == 'parquet':
+                    schema = breakdown_schema(self.fields, self.timestamp_fields,
+                                              local_csv_time=True)
+                    num_valid_traces = write_parquet_breakdown(traces_file, schema,
+                                                               map_chunks, self.chunk_size)
+                else:
+                    num_valid_traces = write_csv_breakdown(traces_file, self.fields, map_chunks,
+                                                           self.chunk_size, self.incremental)
+        finally:
+            use_profile(previous_profile)
 
         logging.info(f"Analyzed {num_valid_traces} valid traces. Written to {breakdown_file.name}.")
+        if self.sketches:
+            sketch_file = traces_file.parent / 'trace_breakdown.sketches.json'
+            latency_sketches.save(sketch_file)
+            logging.info(f"Saved latency sketches to {sketch_file.name}.")
+        if self.service_map:
+            service_map_file = traces_file.parent / 'service_map.json'
+            service_map.save(service_map_file)
+            logging.info(f"Saved service map of {service_map.num_traces} traces"
+                         f" to {service_map_file.name}.")
+        if self.profile:
+            profile_file = breakdown_file.with_name('trace_breakdown.profile.json')
+            profile.save(profile_file)
+            logging.info(f"Saved analysis profile to {profile_file.name}.")
+
+    def map_chunks(self, line_chunks):
+        """Yields the results of analyze_chunk for each (lines, offset) chunk in input order
+        together with the offset after the chunk.
+        With multiple workers, at most two chunks per worker are pending at any time
+        such that memory stays bounded independent of the traces.json size."""
+        workers = self.workers or os.cpu_count()
+        if workers <= 1:
+            for lines, offset in line_chunks:
+                yield self.analyze_chunk(lines), offset
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for lines, offset in line_chunks:
+                pending.append((executor.submit(self.analyze_chunk, lines), offset))
+                if len(pending) >= 2 * workers:
+                    future, offset = pending.popleft()
+                    yield future.result(), offset
+            while pending:
+                future, offset = pending.popleft()
+                yield future.result(), offset
+
+    def analyze_lines(self, lines) -> list:
+        """Returns a list of trace summaries for a chunk of traces.json lines."""
+        return self.analyze_chunk(lines)[0]
+
+    def analyze_chunk(self, lines):
+        """Returns a list of trace summaries for a chunk of traces.json lines
+        together with the latency sketches, the service map, and the analysis profile
+        of these traces (None if disabled).
+        The segments of a trace are decoded once for both the timestamps and the span graph,
+        which is only created if needed."""
+        results = []
+        sketches = LatencySketches() if self.sketches else None
+        service_map = ServiceMap() if self.service_map else None
+        profile = AnalysisProfile() if self.profile else None
+        previous_profile = use_profile(profile)
+        try:
+            for line in lines:
+                # Skip blank lines (e.g., trailing newline)
+                if not line.strip():
+                    continue
+                start = time.perf_counter()
+                with Phase('decode'):
+                    data = json_backend.loads(line)
+                    docs = parse_trace_segments(data)
+                values = extract_timestamps(docs, self.compiled_rules)
+                results.append(self.breakdown_row(data['Id'], values))
+                if sketches is not None or service_map is not None:
+                    G = self.span_graph(data, docs)
+                    if sketches is not None:
+                        self.add_latencies(sketches, G, values)
+                    if service_map is not None and G is not None:
+                        service_map.add_trace(G)
+                if profile is not None:
+                    profile.add_trace(data['Id'], time.perf_counter() - start)
+        finally:
+            use_profile(previous_profile)
+        return results, sketches, service_map, profile
+
+    def span_graph(self, trace, docs=None):
+        """Returns the span graph of a trace (optionally with its decoded segment docs)
+        or None if the trace is invalid."""
+        try:
+            return create_span_graph(trace, docs)
+        except Exception as e:
+            logging.debug(f"Skip span graph of invalid trace {trace.get('Id')}. {e}")
+            return None
+
+    def add_latencies(self, sketches, G, values):
+        """Adds the timestamp intervals and the critical path categories of a trace to sketches.
+        Invalid traces (i.e., without span graph G) only contribute timestamp intervals."""
+        timestamps_us = {}
+        for column in self.timestamp_fields:
+            value = values.get(column)
+            timestamps_us[column] = epoch_us(value) if value is not None else None
+        add_interval_latencies(sketches, timestamps_us)
+        if G is not None:
+            add_category_latencies(sketches, G)
 
     def time_diff_in_ms(self, start_time, end_time):
         return int((end_time - start_time) * 1000)
 
-    def analyze_trace(self, input_json, id):
-        # Json string to json
-        df = pd.DataFrame(input_json)
-        doc_list = df['Document'].tolist()
-        # Extract interesting timestamp
-        t1 = None
-        t2 = None
-        t3 = None
-        t4 = None
-        t5 = None
-        t6 = None
-        t7 = None
-        t8 = None
-        t9 = None
-        t10 = None
-        t11 = None
-        t12 = None
-        t13 = None
-        f1_cold_start = 0
-        f2_cold_start = 0
-        for d in doc_list:
-            js = json.loads(d)
-
-            if js['origin'] == "AWS::ApiGateway::Stage":
-                t1 = js['start_time']
-
-            if js['origin'] == "AWS::Lambda" and js['name'] == "thumbnail-upload":
-                t2 = js['start_time']
-
-            if js['origin'] == "AWS::Lambda" and js['name'] == "thumbnail-create-thumbnail":
-                t7 = js['start_time']
-
-            if js['origin'] == "AWS::Lambda::Function" and js['name'] == "thumbnail-upload":
-                f_subgements_dump = json.dumps(js['subsegments'])
-                f_subgements = json.loads(f_subgements_dump)
-                for s in f_subgements:
-                    if s['name'] == "Initialization":
-                        f1_cold_start = 1
-                    if s['name'] == "Invocation":
-                        invocation_subgements_dump = json.dumps(s['subsegments'])
-                        invocation_subgements = json.loads(invocation_subgements_dump)
-                        for ss in invocation_subgements:
-                            if ss['name'] == "Upload Preparation":
-                                t3 = ss['start_time']
-                            if ss['name'] == "Upload S3 PUT Operation":
-                                t4 = ss['start_time']
-                                s3_subgements_dump = json.dumps(ss['subsegments'])
-                                s3_subgements = json.loads(s3_subgements_dump)
-                                for sss in s3_subgements:
-                                    if sss['name'] == "S3":
-                                        t5 = sss['start_time']
-                                        t6 = sss['end_time']
-
-            if js['origin'] == "AWS::Lambda::Function" and js['name'] == "thumbnail-create-thumbnail":
-                f_subgements_dump = json.dumps(js['subsegments'])
-                f_subgements = json.loads(f_subgements_dump)
-                for s in f_subgements:
-                    if s['name'] == "Initialization":
-                        f2_cold_start = 1
-                    if s['name'] == "Invocation":
-                        invocation_subgements_dump = json.dumps(s['subsegments'])
-                        invocation_subgements = json.loads(invocation_subgements_dump)
-                        for ss in invocation_subgements:
-                            if ss['name'] == "CreateThumbnail Read Operation":
-                                t8 = ss['start_time']
-                                s3_subgements_dump = json.dumps(ss['subsegments'])
-                                s3_subgements = json.loads(s3_subgements_dump)
-                                for sss in s3_subgements:
-                                    if sss['name'] == "S3":
-                                        t9 = sss['start_time']
-                                        t10 = sss['end_time']
-
-                            if ss['name'] == "CreateThumbnail S3 PUT Operation":
-                                t11 = ss['start_time']
-                                s3_subgements_dump = json.dumps(ss['subsegments'])
-                                s3_subgements = json.loads(s3_subgements_dump)
-                                for sss in s3_subgements:
-                                    if sss['name'] == "S3":
-                                        t12 = sss['start_time']
-                                        t13 = sss['end_time']
-
-        # print(f'id: {id}') 
-        # print(f"t2: {ft(t2)}")
-        # print(f"t3: {ft(t3)}")
-        # print(f"t4: {ft(t4)}")
-        # print(f"t5: {ft(t5)}")
-        # print(f"t6: {ft(t6)}")
-        # print(f"t7: {ft(t7)}")
-        # print(f"t8: {ft(t8)}")
-        # print(f't9: {ft(t9)}')
-        # print(f't10: {ft(t10)}')
-        # print(f't11: {ft(t11)}')
-        # print(f't12: {ft(t12)}')
-        # print(f't13: {ft(t13)}')
-
-        output = {
-            'trace_id': id,
-            't1': ft(t1),
-            't2': ft(t2),
-            't3': ft(t3),
-            't4': ft(t4),
-            't5': ft(t5),
-            't6': ft(t6),
-            't7': ft(t7),
-            't8': ft(t8),
-            't9': ft(t9),
-            't10': ft(t10),
-            't11': ft(t11),
-            't12': ft(t12),
-            't13': ft(t13),
-            'f1_cold_start': f1_cold_start,
-            'f2_cold_start': f2_cold_start
-        }
-
+    def format_timestamp(self, epoch):
+        if self.output_format == 'parquet':
+            return epoch_us(epoch)
+        return ft(epoch)
+
+    def analyze_trace(self, segments, id):
+        """Returns the timestamps and cold start flags of a trace according to the timestamp rules.
+        Timestamps are formatted strings for csv and µs since epoch for parquet.
+        Timestamps of unmatched rules remain empty."""
+        values = extract_timestamps(map(parse_segment_json, segments), self.compiled_rules)
+        return self.breakdown_row(id, values)
+
+    def breakdown_row(self, id, values):
+        """Returns the output row for the extracted values of timestamp rules."""
+        output = {'trace_id': id}
+        for column, rule in self.timestamp_rules.items():
+            value = values.get(column)
+            if rule.get('value') == 'exists':
+                output[column] = value or 0
+            else:
+                output[column] = self.format_timestamp(value) if value is not None else None
         return output
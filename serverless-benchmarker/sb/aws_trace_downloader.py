@@ -1,7 +1,36 @@
+import csv
 import logging
 import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import chain
+from datetime import timedelta
 import boto3
 from botocore.config import Config
+from sb.trace_cache import TraceCache
+from sb.trace_storage import validate_compression, traces_file_name, find_traces_file, \
+    open_traces
+
+
+"""Maximum number of trace ids per BatchGetTraces request."""
+BATCH_SIZE = 5
+
+"""Initial and maximum BatchGetTraces requests per second across all workers.
+The rate adapts to the actual account quota upon throttling (see AdaptiveRateLimiter)."""
+DEFAULT_RATE = 5
+MAX_RATE = 50
+
+"""Attempts per batch before its trace ids are reported as unprocessed due to throttling."""
+MAX_ATTEMPTS = 8
+
+"""Trace summary windows shorter than twice this duration are not split any further."""
+MIN_WINDOW = timedelta(seconds=10)
+
+THROTTLING_ERROR_CODES = ['ThrottlingException', 'ThrottledException',
+                          'TooManyRequestsException', 'RequestLimitExceeded']
 
 
 class AwsTraceDownloader:
@@ -11,8 +40,31 @@ class AwsTraceDownloader:
     https://docs.aws.amazon.com/xray/latest/devguide/xray-api-gettingdata.html
     """
 
-    def __init__(self, spec) -> None:
+    def __init__(self, spec, workers=1, k6_trace_ids=False, cache=False,
+                 compression=None) -> None:
+        """
+        Args:
+            spec: Benchmark spec of the invocation.
+            workers: Number of threads paging trace summaries of sub-windows and retrieving
+                trace batches concurrently within adaptive rate limits
+                (see sharded_trace_summaries and retrieve_traces).
+            k6_trace_ids: Retrieves the traces whose ids the k6 workload tagged as xray_header
+                in k6_metrics.csv (see read_k6_trace_ids) instead of discovering trace ids
+                via trace summaries of the invocation time window.
+            cache: Keeps all traces in a TraceCache shared across runs such that repeated
+                downloads (e.g., after failures or with an existing traces.json) only retrieve
+                missing traces. True uses DEFAULT_CACHE_DIR and a path a custom directory.
+            compression: Compresses traces.json while downloading (e.g., gzip into
+                traces.json.gz, see trace_storage) or None for a plain traces.json.
+        """
+        validate_compression(compression)
         self.spec = spec
+        self.workers = workers
+        self.k6_trace_ids = k6_trace_ids
+        self.compression = compression
+        self.cache = None
+        if cache:
+            self.cache = TraceCache() if cache is True else TraceCache(cache)
         # Configure AWS XRay client
         region = self.spec['region']
         my_config = Config(
@@ -23,80 +75,371 @@ class AwsTraceDownloader:
     def get_traces(self):
         """Retrieves X-Ray traces from the last invocation:
         1. saves all trace ids in a trace_ids.txt
-        2. saves all actual trace data in traces.json
+        2. saves all actual trace data in traces.json (optionally compressed)
         3. saves unprocessed trace ids in unprocessed_trace_ids.txt
+        The first two steps are pipelined: traces are retrieved as soon as
+        their trace ids arrive from the trace summaries (see prefetch_trace_ids)
+        or from k6_metrics.csv with k6_trace_ids.
+        With a cache, an existing traces.json is cached and rewritten, previously unprocessed
+        trace ids are retried, and only traces missing in the cache are retrieved.
         """
         start, end = self.spec.event_log.get_invoke_timespan()
         log_path = self.spec.logs_directory()
         trace_ids_file = log_path.joinpath('trace_ids.txt')
-        trace_file = log_path.joinpath('traces.json')
-        if trace_file.exists():
-            logging.error(f"Traces already exist under {trace_file} for this \
+        trace_file = log_path.joinpath(traces_file_name(self.compression))
+        unprocessed_ids_file = log_path.joinpath('unprocessed_trace_ids.txt')
+        existing_trace_file = find_traces_file(log_path)
+        if existing_trace_file.exists():
+            if self.cache is None:
+                logging.error(f"Traces already exist under {existing_trace_file} for this \
 invocation starting time. Aborting.")
-            return None
-
-        trace_ids = self.retrieve_trace_ids(start, end, trace_ids_file)
+                return None
+            num_cached = self.cache.add_traces_file(existing_trace_file)
+            logging.info(f"Cached {num_cached} existing traces of {existing_trace_file}.")
+            if existing_trace_file != trace_file:
+                existing_trace_file.unlink()
 
-        # Remove potential duplicates because boto3 BatchGetTraces fails if
-        # a chunk contains duplicate trace IDs, which can be common with 10000s of trace ids.
-        unique_trace_ids = list(set(trace_ids))
-        num_duplicate_ids = len(trace_ids) - len(unique_trace_ids)
-        logging.info(f"Removed {num_duplicate_ids} duplicate trace ids.")
-
-        unprocessed_ids = self.retrieve_traces(unique_trace_ids, trace_file)
+        if self.k6_trace_ids:
+            trace_ids = self.read_k6_trace_ids(self.spec.workload_log_file(), trace_ids_file)
+        else:
+            trace_ids = self.prefetch_trace_ids(start, end, trace_ids_file, self.workers)
+        if self.cache is not None and unprocessed_ids_file.exists():
+            trace_ids = chain(trace_ids, read_trace_ids(unprocessed_ids_file))
+        batcher = TraceIdBatcher(cache=self.cache)
+        unprocessed_ids = self.retrieve_traces(trace_ids, trace_file, self.workers,
+                                               batcher=batcher, cache=self.cache)
+        logging.info(f"Removed {batcher.num_duplicates} duplicate trace ids.")
+        if self.cache is not None:
+            logging.info(f"Reused {len(batcher.cached_ids)} cached traces.")
         # Check and log for potential unprocessed trace ids
         if unprocessed_ids:
             logging.warning(f"Found {len(unprocessed_ids)} unprocessed trace ids.")
-            unprocessed_ids_file = log_path.joinpath('unprocessed_trace_ids.txt')
             with open(unprocessed_ids_file, 'w') as f:
                 for id in unprocessed_ids:
                     f.write("%s\n" % id)
+        elif unprocessed_ids_file.exists():
+            unprocessed_ids_file.unlink()
 
         # Inform user
-        logging.info(f"Downloaded {len(trace_ids)} traces for invocations between \
+        logging.info(f"Downloaded {batcher.num_unique} traces for invocations between \
 {start} and {end} into {log_path}.")
 
     def retrieve_trace_ids(self, start, end, trace_ids_file):
         """Retrieve and save trace ids from X-Ray.
         Returns a list of trace ids."""
-        # Configure trace summaries (ts) iterator using pagination
-        paginator = self.client.get_paginator('get_trace_summaries')
-        ts_iter = paginator.paginate(StartTime=start, EndTime=end)
+        trace_ids = []
+        for page_trace_ids in self.trace_id_pages(start, end, trace_ids_file):
+            trace_ids.extend(page_trace_ids)
+        return trace_ids
+
+    def trace_id_pages(self, start, end, trace_ids_file, workers=1):
+        """Yields the trace ids of every trace summary page and saves them to trace_ids_file.
+        With multiple workers, sub-windows are paged concurrently (see sharded_trace_summaries)
+        and trace ids at window boundaries might be duplicated."""
+        if workers <= 1:
+            # Configure trace summaries (ts) iterator using pagination
+            paginator = self.client.get_paginator('get_trace_summaries')
+            ts_iter = paginator.paginate(StartTime=start, EndTime=end)
+        else:
+            ts_iter = self.sharded_trace_summaries(start, end, workers)
 
         # Save trace ids to file
-        trace_ids = []
         with open(trace_ids_file, 'w') as f:
             for trace_summary in ts_iter:
                 batch_trace_ids = extract_trace_ids(trace_summary)
-                trace_ids.extend(batch_trace_ids)
                 for trace_id in batch_trace_ids:
                     f.write(f"{trace_id}\n")
-        return trace_ids
+                # Make trace ids in the file visible before retrieving their traces
+                f.flush()
+                yield batch_trace_ids
+
+    def sharded_trace_summaries(self, start, end, workers, rate_limiter=None):
+        """Yields the trace summary pages of the time window from start to end split into
+        sub-windows that are paged concurrently within a shared rate_limiter.
+        The window is initially split into one sub-window per worker and dense sub-windows
+        (i.e., with more than one page) are split further (see trace_summary_window)
+        such that the sub-window size adapts to the page density."""
+        rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(self.trace_summary_window, window, rate_limiter)
+                       for window in split_window(start, end, workers)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pages, windows = future.result()
+                    for window in windows:
+                        pending.add(executor.submit(self.trace_summary_window, window,
+                                                    rate_limiter))
+                    yield from pages
+
+    def trace_summary_window(self, window, rate_limiter):
+        """Returns the trace summary pages of a (start, end) window and the windows left to page.
+        A window with more pages than its first page is split into halves after the first page
+        unless shorter than 2 * MIN_WINDOW. Throttled windows are paged again from the start."""
+        start, end = window
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            pages = []
+            paginator = self.client.get_paginator('get_trace_summaries')
+            ts_iter = iter(paginator.paginate(StartTime=start, EndTime=end))
+            try:
+                # Only pages with a NextToken are followed by another request
+                while not pages or pages[-1].get('NextToken'):
+                    rate_limiter.acquire()
+                    page = next(ts_iter, None)
+                    if page is None:
+                        break
+                    rate_limiter.succeeded()
+                    pages.append(page)
+                    # Split dense windows into halves after their first page
+                    dense = len(pages) == 1 and page.get('NextToken')
+                    if dense and end - start >= 2 * MIN_WINDOW:
+                        return pages, split_window(start, end, 2)
+                return pages, []
+            except Exception as e:
+                if not is_throttling_error(e) or attempt == MAX_ATTEMPTS:
+                    raise
+                rate_limiter.throttled()
+                logging.debug('Throttled GetTraceSummaries.'
+                              f" Reduced rate to {rate_limiter.rate}/s.")
+
+    def read_k6_trace_ids(self, k6_metrics_file, trace_ids_file):
+        """Yields the trace ids of all requests in k6_metrics.csv and saves them to trace_ids_file.
+        The k6 workload must tag every request with its X-Ray header
+        (e.g., xray_header=Root=1-61d6b8a7-91ec5752c45d80fc8fa85c5c)."""
+        if not k6_metrics_file.exists():
+            raise Exception(f"Missing {k6_metrics_file} with the trace ids of the k6 workload.")
+        num_trace_ids = 0
+        with open(k6_metrics_file, newline='') as k6_metrics, open(trace_ids_file, 'w') as f:
+            for row in csv.DictReader(k6_metrics):
+                # Every request has a single http_reqs metric
+                if row['metric_name'] != 'http_reqs':
+                    continue
+                trace_id = xray_trace_id(row.get('extra_tags') or '')
+                if trace_id is not None:
+                    f.write(f"{trace_id}\n")
+                    num_trace_ids += 1
+                    yield trace_id
+        if num_trace_ids == 0:
+            logging.warning(f"Found no xray_header tags in {k6_metrics_file}.")
+
+    def prefetch_trace_ids(self, start, end, trace_ids_file, workers=1):
+        """Yields trace ids while a background thread pages through the trace summaries
+        (see trace_id_pages) such that fetching summaries overlaps with retrieving traces.
+        Errors of the background thread are raised to the consumer."""
+        pages = queue.Queue()
+
+        def produce():
+            try:
+                for page_trace_ids in self.trace_id_pages(start, end, trace_ids_file, workers):
+                    pages.put(page_trace_ids)
+            except Exception as e:
+                pages.put(e)
+            finally:
+                pages.put(None)
+
+        threading.Thread(target=produce, name='trace-summaries', daemon=True).start()
+        while True:
+            page = pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
 
-    def retrieve_traces(self, unique_trace_ids, trace_file):
+    def retrieve_traces(self, trace_ids, trace_file, workers=1, rate_limiter=None,
+                        batcher=None, cache=None):
         """Retrieve and save full trace details in chunks from X-Ray.
         Returns a list of unprocessed trace ids.
+        trace_ids can be any iterable (e.g., prefetch_trace_ids) and duplicates are skipped
+        as they arrive by the batcher (defaults to a new TraceIdBatcher).
+        With multiple workers, chunks are retrieved concurrently by a thread pool within
+        a shared rate_limiter (defaults to an AdaptiveRateLimiter) while this thread remains
+        the single writer of traces.json in the order of the trace ids.
+        With a cache, retrieved traces are cached and the traces of trace ids that the batcher
+        found in the cache are appended to traces.json without retrieving them.
         Output format: Every line contains a single JSON-formatted trace.
+        The trace_file is compressed by its extension (see open_traces).
         Example output of a single trace (partial data):
         {"Id": "1-60be2454-2cb82d1221d24201751ea2e3", "Duration": 9.315, "LimitExceeded": false, "Segments": [{"Id": "050793ca38bd8ff2", "Document": "{\"id\":\"050793ca38bd8ff2\",..."}]}  # noqa: E501
         """
         unprocessed_ids = []
-        with open(trace_file, 'w') as f:
-            for trace_ids_batch in chunks(unique_trace_ids, 5):
-                paginator = self.client.get_paginator('batch_get_traces')
-                trace_iterator = paginator.paginate(TraceIds=trace_ids_batch)
-                for trace_batch in trace_iterator:
-                    unprocessed_ids.extend(trace_batch['UnprocessedTraceIds'])
-                    for trace in trace_batch['Traces']:
-                        f.write(json.dumps(trace) + '\n')
+        batcher = batcher or TraceIdBatcher(cache=cache)
+        batches = batcher.batches(trace_ids)
+        with open_traces(trace_file, 'w') as f:
+            for traces, batch_unprocessed_ids in self.map_batches(batches, workers, rate_limiter):
+                unprocessed_ids.extend(batch_unprocessed_ids)
+                for trace in traces:
+                    line = json.dumps(trace)
+                    f.write(line + '\n')
+                    if cache is not None:
+                        cache.put(trace['Id'], line)
+            if cache is not None:
+                for trace_id in batcher.cached_ids:
+                    f.write(cache.get(trace_id) + '\n')
         return unprocessed_ids
 
+    def map_batches(self, batches, workers=1, rate_limiter=None):
+        """Yields the traces and unprocessed trace ids of each batch in input order.
+        At most two batches per worker are pending such that memory stays bounded."""
+        if workers <= 1:
+            for trace_ids in batches:
+                yield self.retrieve_batch(trace_ids)
+            return
+        rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for trace_ids in batches:
+                pending.append(executor.submit(self.retrieve_throttled_batch, trace_ids,
+                                               rate_limiter))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def retrieve_batch(self, trace_ids, rate_limiter=None):
+        """Returns the traces and unprocessed trace ids of a BatchGetTraces request.
+        With a rate_limiter, every page request is acquired within the rate limit."""
+        traces = []
+        unprocessed_ids = []
+        paginator = self.client.get_paginator('batch_get_traces')
+        trace_batches = iter(paginator.paginate(TraceIds=trace_ids))
+        next_token = True
+        # Only pages with a NextToken are followed by another request
+        while next_token:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            trace_batch = next(trace_batches, None)
+            if trace_batch is None:
+                break
+            unprocessed_ids.extend(trace_batch['UnprocessedTraceIds'])
+            traces.extend(trace_batch['Traces'])
+            next_token = trace_batch.get('NextToken')
+        return traces, unprocessed_ids
+
+    def retrieve_throttled_batch(self, trace_ids, rate_limiter):
+        """Retrieves a batch within the rate limit and retries throttled requests.
+        Reports all trace ids of the batch as unprocessed after MAX_ATTEMPTS."""
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                result = self.retrieve_batch(trace_ids, rate_limiter)
+            except Exception as e:
+                if not is_throttling_error(e):
+                    raise
+                rate_limiter.throttled()
+                logging.debug(f"Throttled BatchGetTraces. Reduced rate to {rate_limiter.rate}/s.")
+                continue
+            rate_limiter.succeeded()
+            return result
+        logging.warning(f"Giving up on throttled trace ids {trace_ids}.")
+        return [], list(trace_ids)
+
+
+def split_window(start, end, n) -> list:
+    """Splits the time window from start to end into n consecutive (start, end) windows."""
+    size = (end - start) / n
+    windows = [(start + i * size, start + (i + 1) * size) for i in range(n)]
+    windows[-1] = (windows[-1][0], end)
+    return windows
+
+
+def xray_trace_id(extra_tags):
+    """Returns the root trace id of the xray_header in k6 extra_tags (i.e., key=value pairs
+    separated by &) or None if missing. Example: xray_header=Root=1-61d6b8a7-91ec...;Sampled=1"""
+    for tag in extra_tags.split('&'):
+        key, _, header = tag.partition('=')
+        if key != 'xray_header':
+            continue
+        for field in header.split(';'):
+            name, _, value = field.strip().partition('=')
+            if name == 'Root':
+                return value
+    return None
+
+
+def read_trace_ids(trace_ids_file):
+    """Yields the non-empty lines of a trace ids file (e.g., unprocessed_trace_ids.txt)."""
+    with open(trace_ids_file) as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
 
 def extract_trace_ids(trace_summaries):
     return [trace['Id'] for trace in trace_summaries['TraceSummaries']]
 
 
-# Source: https://stackoverflow.com/a/312464/6875981
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    return [lst[i:i + n] for i in range(0, len(lst), n)]
+class TraceIdBatcher:
+    """Groups a stream of trace ids into BatchGetTraces chunks of unique trace ids.
+    Removes duplicates incrementally because BatchGetTraces fails if a chunk contains
+    duplicate trace ids, which can be common with 10000s of trace ids.
+    Unique trace ids found in an optional cache are collected in cached_ids instead."""
+
+    def __init__(self, size=BATCH_SIZE, cache=None) -> None:
+        self.size = size
+        self.cache = cache
+        self.seen = set()
+        self.num_duplicates = 0
+        self.cached_ids = []
+
+    @property
+    def num_unique(self) -> int:
+        return len(self.seen)
+
+    def batches(self, trace_ids):
+        batch = []
+        for trace_id in trace_ids:
+            if trace_id in self.seen:
+                self.num_duplicates += 1
+                continue
+            self.seen.add(trace_id)
+            if self.cache is not None and trace_id in self.cache:
+                self.cached_ids.append(trace_id)
+                continue
+            batch.append(trace_id)
+            if len(batch) == self.size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def is_throttling_error(e) -> bool:
+    """Returns true for botocore ClientErrors caused by exceeding an API rate limit."""
+    response = getattr(e, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class AdaptiveRateLimiter:
+    """Thread-safe client-side rate limit of requests per second that adapts to throttling
+    alike TCP congestion control (AIMD): every successful request additively increases
+    the rate up to max_rate and every throttled request multiplicatively decreases it.
+    Requests are spaced evenly by reserving the next free time slot in acquire."""
+
+    def __init__(self, rate=DEFAULT_RATE, max_rate=MAX_RATE, min_rate=0.5, increase=0.1,
+                 decrease=0.5, clock=time.monotonic, sleep=time.sleep) -> None:
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.sleep = sleep
+        self.next_time = None
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until the next request is allowed."""
+        with self.lock:
+            now = self.clock()
+            slot = now if self.next_time is None else max(self.next_time, now)
+            self.next_time = slot + 1 / self.rate
+        if slot > now:
+            self.sleep(slot - now)
+
+    def succeeded(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
@@ -1,6 +1,7 @@
 import json
 from pathlib import Path
 import shutil
+from sb.trace_storage import open_traces, COMPRESSIONS
 
 
 def migrate_traces(traces_path, replace=False):
@@ -12,10 +13,13 @@ def migrate_traces(traces_path, replace=False):
     After:
     {"Id": "1-60be2454-2cb82d1221d24201751ea2e3", ... }
     {"Id": "1-60be244d-29f4c8461b7effa2caaa0848", ... }
+    Compressed traces (e.g., traces.json.gz) are migrated into the same compression.
     """
-    with open(traces_path) as traces_file:
-        new_traces_path = Path(traces_path).parent / 'traces_v2.json'
-        with open(new_traces_path, 'w') as new_traces_file:
+    traces_path = Path(traces_path)
+    extension = traces_path.suffix if traces_path.suffix in COMPRESSIONS.values() else ''
+    with open_traces(traces_path) as traces_file:
+        new_traces_path = traces_path.parent / f"traces_v2.json{extension}"
+        with open_traces(new_traces_path, 'w') as new_traces_file:
             # NOTE: Loading potentially large (GBs) file into memory
             traces = json.load(traces_file)
             for trace in traces.values():
@@ -0,0 +1,147 @@
+from datetime import timedelta
+from sb.aws_trace_analyzer import SpanTree, US_PER_SECOND, index_spans, add_global_stats
+from sb.analysis_profile import profiled
+from sb.timestamps import parse_us, duration_us
+
+
+"""
+Builds span trees of Application Insights traces for the critical path analysis of the
+AWS trace analyzer (i.e., longest_path and calculate_breakdown). Requests (i.e., function
+invocations) and dependencies (i.e., calls to other services) are spans with a start timestamp
+and a duration in ms. Their operation_ParentId refers to the id of the calling span.
+Invocations triggered by the traced operation (e.g., blob triggers) start a new operation
+that only refers to the trace id in its customDimensions (e.g., the TriggerReason).
+Other records (e.g., trace logs or custom events) have no duration and are ignored.
+Useful resources in the Application Insights docs:
+* Data model: https://docs.microsoft.com/en-us/azure/azure-monitor/app/data-model
+* Correlation: https://docs.microsoft.com/en-us/azure/azure-monitor/app/correlation
+"""
+SPAN_ITEM_TYPES = ['request', 'dependency']
+
+"""XRay-like origin of requests, which map to the computation category."""
+REQUEST_ORIGIN = 'Azure::Function'
+
+"""XRay-like origins of dependencies by their type."""
+DEPENDENCY_ORIGINS = {
+    'Azure blob': 'Azure::Storage::Blob',
+    'Azure table': 'Azure::Storage::Table',
+    'Azure queue': 'Azure::Storage::Queue',
+    'Azure Service Bus': 'Azure::ServiceBus',
+    'Azure Event Hubs': 'Azure::EventHubs',
+    'Azure DocumentDB': 'Azure::CosmosDB',
+    'SQL': 'Azure::SQL',
+    'HTTP': 'Azure::HTTP'
+}
+DEFAULT_DEPENDENCY_ORIGIN = 'Azure::Dependency'
+
+"""Latency category of spans by origin (see category_for_origin): functions compute and
+all dependencies are external services."""
+ORIGIN_CATEGORIES = {REQUEST_ORIGIN: 'computation', DEFAULT_DEPENDENCY_ORIGIN: 'external_service'}
+ORIGIN_CATEGORIES.update({origin: 'external_service' for origin in DEPENDENCY_ORIGINS.values()})
+
+
+def span_origin(record) -> str:
+    if record['itemType'] == 'request':
+        return REQUEST_ORIGIN
+    return DEPENDENCY_ORIGINS.get(record.get('type'), DEFAULT_DEPENDENCY_ORIGIN)
+
+
+def span_doc(record) -> dict:
+    """Returns an XRay-like segment document of an Application Insights span record
+    with start_time and end_time in float seconds since epoch."""
+    start_us = parse_us(record['timestamp'])
+    end_us = start_us + duration_us(record['duration'])
+    doc = {
+        'id': record['id'],
+        'name': record.get('name'),
+        'origin': span_origin(record),
+        'start_time': start_us / US_PER_SECOND,
+        'end_time': end_us / US_PER_SECOND
+    }
+    if record.get('success') in (False, 'False'):
+        doc['fault'] = True
+    return doc
+
+
+def is_triggered(record, trace_id) -> bool:
+    """Returns whether a record is the request of an invocation triggered by the traced operation,
+    which belongs to another operation and refers to the trace id in its customDimensions
+    (see split_records of the AzureTraceDownloader)."""
+    return record['itemType'] == 'request' and record.get('operation_Id') != trace_id and \
+        trace_id in str(record.get('customDimensions'))
+
+
+@profiled
+def create_span_graph(records, trace_id):
+    """Returns a SpanTree of the Application Insights records of a single trace
+    ready for calculate_breakdown. The parent of every span is looked up in an index of
+    span ids via its operation_ParentId in linear time. Triggered invocations without parent span
+    are linked to their trigger within the traced operation (see trigger_of).
+    Raises an exception unless all spans are reachable from a single root span
+    (e.g., due to missing or cyclic parents)."""
+    spans = []
+    for record in records:
+        if record.get('itemType') in SPAN_ITEM_TYPES and record.get('duration') is not None:
+            spans.append((span_doc(record), record))
+    if not spans:
+        raise Exception(f"Trace {trace_id} has no spans.")
+    G = SpanTree(trace_id=trace_id, limit_exceeded=False, origin_categories=ORIGIN_CATEGORIES)
+    # Index all spans first because children might precede their parents
+    nodes = [G.add_span(doc) for doc, _ in spans]
+    roots = []
+    triggered = []
+    for node, (_, record) in zip(nodes, spans):
+        parent = G.index.get(record.get('operation_ParentId'))
+        if parent is not None and parent != node:
+            G.add_edge(parent, node)
+        elif is_triggered(record, trace_id):
+            triggered.append(node)
+        else:
+            roots.append(node)
+    if triggered:
+        # Triggers are dependencies of the traced operation
+        operation_dependency = ('dependency', trace_id)
+        dependencies = [node for node, (_, record) in zip(nodes, spans)
+                        if (record['itemType'], record.get('operation_Id')) == operation_dependency]
+        for node in triggered:
+            trigger = trigger_of(G, node, dependencies)
+            if trigger is None:
+                roots.append(node)
+            else:
+                G.add_edge(trigger, node)
+    if len(roots) != 1:
+        raise Exception(f"Trace {trace_id} has {len(roots)} root spans.")
+    G.sort_children()
+    num_unreachable = len(G) - num_reachable(G, roots[0])
+    if num_unreachable > 0:
+        raise Exception(f"Trace {trace_id} has {num_unreachable} spans unreachable from its"
+                        ' root span. Ensure that operation_ParentId links do not form cycles.')
+    G.graph['start'] = G.ids[roots[0]]
+    G.graph['duration_us'] = max(G.end_us) - min(G.start_us)
+    G.graph['duration'] = timedelta(microseconds=G.graph['duration_us'])
+    index_spans(G)
+    add_global_stats(G)
+    return G
+
+
+def trigger_of(G, node, dependencies):
+    """Returns the dependency of the traced operation (e.g., a blob upload) that triggered an
+    invocation, which is the latest one ending before the invocation starts, or None.
+    Other triggered invocations are never triggers such that parallel ones are not chained."""
+    trigger = None
+    for dependency in dependencies:
+        if G.end_us[dependency] <= G.start_us[node] and \
+                (trigger is None or G.end_us[dependency] > G.end_us[trigger]):
+            trigger = dependency
+    return trigger
+
+
+def num_reachable(G, root) -> int:
+    """Returns the number of spans in the tree below (and including) the root span."""
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(child for child in G.children(node) if G.parent[child] == node)
+    return count
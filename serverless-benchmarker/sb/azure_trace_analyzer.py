@@ -1,19 +1,138 @@
 import logging
-import json
+import time
+from datetime import timedelta
 from os import stat
-import pandas as pd
-import datetime
 from pathlib import Path
+import pandas as pd
 from pandas.core.indexes.base import ensure_index
+from sb.trace_storage import traces_file_of
+from sb.breakdown_writer import validate_output_format, breakdown_path, breakdown_schema, \
+    write_csv_breakdown, write_parquet_breakdown
+from sb.latency_sketch import LatencySketches, add_interval_latencies
+from sb.aws_trace_analyzer import calculate_breakdown, CATEGORIES
+from sb.azure_span_tree import create_span_graph
+from sb.analysis_profile import AnalysisProfile, Phase, profiled, use_profile
+from sb.timestamps import EPOCH, ONE_US, ISO_FORMAT, ISO_FORMAT_NO_FRACTION, OUTPUT_FORMAT, \
+    parse_us, duration_us, format_us
+from sb import json_backend
+
+
+"""Number of traces.json lines analyzed and written per chunk (i.e., between checkpoints)."""
+DEFAULT_CHUNK_SIZE = 1000
+
+
+BREAKDOWN_FIELDS = [
+    'trace_id',
+    't1',
+    't2',
+    't3',
+    't4',
+    't5',
+    't6',
+    't7',
+    't8',
+    't9',
+    't10',
+    't11',
+    't12',
+    't13',
+    'f1_cold_start',
+    'f2_cold_start'
+]
+
+TIMESTAMP_FIELDS = [f"t{i}" for i in range(1, 14)]
+
+"""Rules matching the Application Insights records of the thumbnail app.
+Each rule is a list of (field, operator, value) conditions where the operator is
+== (equality) or contains (substring of a string field). The first record in document order
+that matches all conditions of a rule determines its timestamp.
+"""
+RECORD_RULES = {
+    't1': [('itemType', '==', 'request'), ('name', 'contains', 'POST')],
+    't2': [('itemType', '==', 'request'), ('name', '==', 'Upload')],
+    't3': [('name', '==', 'Upload function execution')],
+    't4': [('itemType', '==', 'trace'), ('message', 'contains', 'Upload Blob Operation Starts')],
+    't5': [('name', '==', 'PUT thumbnaistore'), ('operation_Name', '==', 'Upload'),
+           ('resultCode', '==', '201')],
+    't7': [('itemType', '==', 'request'), ('name', '==', 'Create-Thumbnail')],
+    't8': [('name', '==', 'CreateThumbnail execution')],
+    't9': [('name', '==', 'GET thumbnaistore'), ('operation_Name', '==', 'Create-Thumbnail')],
+    't11': [('itemType', '==', 'trace'),
+            ('message', 'contains', 'CreateThumbnail PUT Operation Starts')],
+    't12': [('name', '==', 'PUT thumbnaistore'), ('operation_Name', '==', 'Create-Thumbnail'),
+            ('resultCode', '==', '201')],
+    'host_initialization': [('itemType', '==', 'trace'),
+                            ('customDimensions', 'contains', 'Host initialization')]
+}
+
+"""Rules that might not match (i.e., host initialization only happens upon cold starts)."""
+OPTIONAL_RULES = ['host_initialization']
+
+"""End timestamps derived from the timestamp and duration in ms of the record of a rule.
+All timestamps are µs since epoch during the analysis (see sb.timestamps)."""
+END_TIMESTAMPS = {'t6': 't5', 't10': 't9', 't13': 't12'}
+
+"""Record fields loaded into the DataFrame of the vectorized analysis."""
+RECORD_FIELDS = ['timestamp', 'duration'] + sorted({field for conditions in RECORD_RULES.values()
+                                                    for field, _, _ in conditions})
+
+
+def matches_conditions(record, conditions) -> bool:
+    for field, operator, value in conditions:
+        actual = record.get(field)
+        if operator == '==':
+            if actual != value:
+                return False
+        elif not isinstance(actual, str) or value not in actual:
+            return False
+    return True
+
+
+@profiled
+def match_records(records, rules=RECORD_RULES) -> dict:
+    """Returns the first matching record of every rule in a single pass over the records.
+    Stops scanning as soon as all rules have matched."""
+    matches = {}
+    pending = list(rules.items())
+    for record in records:
+        remaining = []
+        for name, conditions in pending:
+            if matches_conditions(record, conditions):
+                matches[name] = record
+            else:
+                remaining.append((name, conditions))
+        pending = remaining
+        if not pending:
+            break
+    return matches
+
 
+def condition_mask(df, field, operator, value):
+    if field not in df.columns:
+        return pd.Series(False, index=df.index)
+    if operator == '==':
+        return df[field] == value
+    return df[field].str.contains(value, regex=False, na=False)
 
-def ft(t) -> str:
-    result = None
-    try:
-        result = datetime.datetime.strptime(t, '%Y-%m-%dT%H:%M:%S.%fZ')
-    except ValueError:
-        result = datetime.datetime.strptime(t, '%Y-%m-%dT%H:%M:%SZ')
-    return result.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def first_matches(df, conditions):
+    """Returns the first matching record per trace (in document order) indexed by trace."""
+    mask = pd.Series(True, index=df.index)
+    for field, operator, value in conditions:
+        mask &= condition_mask(df, field, operator, value)
+    matched = df.loc[mask, ['trace', 'timestamp', 'duration']]
+    return matched.drop_duplicates('trace').set_index('trace')
+
+
+def parse_timestamps(values):
+    """Parses Application Insights timestamps with or without fractional seconds
+    (alike parse_us) in two vectorized passes."""
+    parsed = pd.to_datetime(values, format=ISO_FORMAT, errors='coerce')
+    without_fraction = parsed.isna() & values.notna()
+    if without_fraction.any():
+        parsed[without_fraction] = pd.to_datetime(values[without_fraction],
+                                                  format=ISO_FORMAT_NO_FRACTION)
+    return parsed
 
 
 class AzureTraceAnalyzer:
@@ -21,138 +140,230 @@ class AzureTraceAnalyzer:
     and saves a trace summary into trace_breakdown.csv
     """
 
-    def __init__(self, log_path) -> None:
+    def __init__(self, log_path, incremental=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                 output_format='csv', sketches=False, profile=False, vectorized=False,
+                 critical_path=False) -> None:
+        """
+        Args:
+            log_path: Path to a traces.json file.
+            incremental: Resumes from the checkpoint of a previous analysis and
+                only appends the results of traces added since then.
+            chunk_size: Number of traces analyzed and written per chunk.
+            output_format: csv or parquet (see OUTPUT_FORMATS).
+            sketches: Saves quantile sketches of the latencies per timestamp interval
+                and per critical path category of connected traces (see create_span_graph)
+                into trace_breakdown.sketches.json.
+            profile: Saves the cumulative time per analysis phase and the slowest traces
+                into trace_breakdown.profile.json (see AnalysisProfile).
+            vectorized: Analyzes all traces of a chunk at once with grouped DataFrame filters
+                (see analyze_lines_vectorized). chunk_size=None analyzes the whole run at once.
+            critical_path: Appends the critical path latency in ms per category
+                (see CATEGORIES) of connected traces to the breakdown.
+        """
         self.log_path = log_path
+        self.incremental = incremental
+        self.chunk_size = chunk_size
+        validate_output_format(output_format, incremental)
+        self.output_format = output_format
+        if sketches and incremental:
+            raise Exception('Latency sketches are not supported for incremental analysis.')
+        self.sketches = sketches
+        self.latency_sketches = None
+        self.profile = profile
+        self.analysis_profile = None
+        self.vectorized = vectorized
+        self.critical_path = critical_path
+        self.fields = BREAKDOWN_FIELDS + CATEGORIES if critical_path else BREAKDOWN_FIELDS
+        self.num_skipped_traces = 0
 
     def analyze_traces(self):
+        """Streams traces.json in chunks of lines and appends the results of each chunk
+        to trace_breakdown.csv (or .parquet)."""
         file = Path(self.log_path)
-        breakdown_file = file.parent / 'trace_breakdown.csv'
-        traces_file = file.parent / 'traces.json'
+        traces_file = traces_file_of(file)
+        breakdown_file = breakdown_path(traces_file, self.output_format)
 
-        # Clear traces data
-        open(breakdown_file, 'w').close()
+        self.latency_sketches = LatencySketches() if self.sketches else None
+        self.analysis_profile = AnalysisProfile() if self.profile else None
+        self.num_skipped_traces = 0
+        previous_profile = use_profile(self.analysis_profile)
+        try:
+            with Phase('analyze_traces'):
+                if self.output_format == 'parquet':
+                    schema = breakdown_schema(self.fields, TIMESTAMP_FIELDS,
+                                              duration_fields=CATEGORIES)
+                    count = write_parquet_breakdown(traces_file, schema, self.map_chunks,
+                                                    self.chunk_size)
+                else:
+                    count = write_csv_breakdown(traces_file, self.fields, self.map_chunks,
+                                                self.chunk_size, self.incremental)
+        finally:
+            use_profile(previous_profile)
 
-        # Using readline()
-        file1 = open(traces_file, 'r')
-        count = 0
+        num_valid_traces = count
 
-        results = []
-        while True:
-            # Get next line from file
-            line = file1.readline()
+        logging.info(f"Analyzed {num_valid_traces} valid traces. Written to {breakdown_file.name}.")
+        if self.num_skipped_traces > 0:
+            logging.warning(f"Skipped the critical path of {self.num_skipped_traces} traces"
+                            ' whose spans are not connected into a single tree.')
+        if self.sketches:
+            sketch_file = traces_file.parent / 'trace_breakdown.sketches.json'
+            self.latency_sketches.save(sketch_file)
+            logging.info(f"Saved latency sketches to {sketch_file.name}.")
+        if self.profile:
+            profile_file = breakdown_file.with_name('trace_breakdown.profile.json')
+            self.analysis_profile.save(profile_file)
+            logging.info(f"Saved analysis profile to {profile_file.name}.")
 
-            # if line is empty
-            # end of file is reached
-            if not line:
-                break
+    def map_chunks(self, line_chunks):
+        """Yields the results of analyze_lines for each (lines, offset) chunk in input order
+        together with the offset after the chunk."""
+        analyze_lines = self.analyze_lines_vectorized if self.vectorized else self.analyze_lines
+        for lines, offset in line_chunks:
+            yield analyze_lines(lines), offset
 
-            data = json.loads(line)
-            result = self.analyze_trace(data['traces'], data['trace_id'])
-            results.append(result)
-            count += 1
+    def analyze_lines(self, lines) -> list:
+        """Returns a list of trace summaries for a chunk of traces.json lines."""
+        results = []
+        for line in lines:
+            # Skip blank lines (e.g., trailing newline)
+            if not line.strip():
+                continue
+            start = time.perf_counter()
+            with Phase('decode'):
+                data = json_backend.loads(line)
+            results.append(self.analyze_trace(data['traces'], data['trace_id'],
+                                              self.latency_sketches))
+            if self.analysis_profile is not None:
+                self.analysis_profile.add_trace(data['trace_id'], time.perf_counter() - start)
+        return results
 
-        result_df = pd.DataFrame(results)
-        result_df.to_csv(breakdown_file, sep=',', index=False)
+    @profiled
+    def analyze_lines_vectorized(self, lines) -> list:
+        """Returns a list of trace summaries for a chunk of traces.json lines like analyze_lines.
+        Loads the records of all traces into one DataFrame and finds the first matching record
+        per trace and rule (see RECORD_RULES) with one vectorized filter per rule."""
+        trace_ids = []
+        records = []
+        record_traces = []
+        # Offsets of the records of each trace
+        record_offsets = [0]
+        with Phase('decode'):
+            for line in lines:
+                # Skip blank lines (e.g., trailing newline)
+                if not line.strip():
+                    continue
+                data = json_backend.loads(line)
+                trace_records = json_backend.loads(data['traces'])
+                record_traces.extend([len(trace_ids)] * len(trace_records))
+                trace_ids.append(data['trace_id'])
+                records.extend(trace_records)
+                record_offsets.append(len(records))
+        if not trace_ids:
+            return []
+        traces = range(len(trace_ids))
+        df = pd.DataFrame(records, columns=RECORD_FIELDS)
+        df['trace'] = record_traces
 
-        file1.close()
+        with Phase('match_records'):
+            matches = {name: first_matches(df, conditions)
+                       for name, conditions in RECORD_RULES.items()}
+        self.validate_matches(matches, trace_ids)
 
-        num_valid_traces = count
+        with Phase('parse_timestamps'):
+            timestamps = pd.DataFrame(index=traces)
+            for name, matched in matches.items():
+                if name not in OPTIONAL_RULES:
+                    timestamps[name] = parse_timestamps(matched['timestamp']).reindex(traces)
+            for end, start in END_TIMESTAMPS.items():
+                durations = [duration_us(d) for d in matches[start]['duration'].reindex(traces)]
+                timestamps[end] = timestamps[start] + pd.to_timedelta(durations, unit='us')
+            epochs = {field: (timestamps[field] - EPOCH) // ONE_US for field in TIMESTAMP_FIELDS}
+            if self.output_format == 'parquet':
+                values = {field: [int(us) for us in epochs[field]] for field in TIMESTAMP_FIELDS}
+            else:
+                values = {field: timestamps[field].dt.strftime(OUTPUT_FORMAT).tolist()
+                          for field in TIMESTAMP_FIELDS}
+            cold_starts = timestamps.index.isin(matches['host_initialization'].index)
 
-        logging.info(f"Analyzed {num_valid_traces} valid traces. Written to {breakdown_file.name}.")
+        results = []
+        for trace in traces:
+            output = {'trace_id': trace_ids[trace]}
+            for field in TIMESTAMP_FIELDS:
+                output[field] = values[field][trace]
+            output['f1_cold_start'] = int(cold_starts[trace])
+            output['f2_cold_start'] = int(cold_starts[trace])
+            results.append(output)
+            if self.latency_sketches is not None:
+                add_interval_latencies(self.latency_sketches, {
+                    field: int(epochs[field][trace]) for field in TIMESTAMP_FIELDS})
+            if self.latency_sketches is not None or self.critical_path:
+                trace_records = records[record_offsets[trace]:record_offsets[trace + 1]]
+                self.add_category_latencies(output, self.latency_sketches, trace_records,
+                                            trace_ids[trace])
+        return results
 
-    def time_diff_in_ms(self, start_time, end_time, format):
-
-        start = None
-        if type(start_time) is str:
-            try:
-                start = datetime.datetime.strptime(start_time, format)
-            except ValueError:
-                start = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%SZ")
-
-        end = None
-        if type(end_time) is str:
-            try:
-                end = datetime.datetime.strptime(end_time, format)
-            except ValueError:
-                end = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M:%SZ")
-
-        diff = end - start
-        diff_ms = int(diff.total_seconds() * 1000)
-        return diff_ms
-    
-    def strptime_pro(self, t, format):
-
-        result = None
-        try:
-            result = datetime.datetime.strptime(t, format)
-        except ValueError:
-            result = datetime.datetime.strptime(t, "%Y-%m-%dT%H:%M:%SZ")
+    def validate_matches(self, matches, trace_ids) -> None:
+        """Raises an exception for the first trace without matching record of a required rule."""
+        for trace, id in enumerate(trace_ids):
+            missing = [name for name, matched in matches.items()
+                       if name not in OPTIONAL_RULES and trace not in matched.index]
+            if missing:
+                raise Exception(f"Trace {id} has no matching records for {missing}.")
 
-        return result
+    def add_category_latencies(self, output, sketches, records, id) -> None:
+        """Adds the critical path latency in ms per category of a trace to sketches (if any)
+        and (with critical_path) to its output unless its spans are not connected into a single
+        tree (see create_span_graph). Counts skipped traces in num_skipped_traces."""
+        try:
+            G = calculate_breakdown(create_span_graph(records, id))
+        except Exception as e:
+            logging.debug(f"Skip critical path latencies of trace {id}. {e}")
+            self.num_skipped_traces += 1
+            G = None
+        for category in CATEGORIES:
+            duration = G.graph.get(category) if G is not None else None
+            if duration is not None:
+                duration = round(duration / timedelta(milliseconds=1), 3)
+                if sketches is not None:
+                    sketches.add('categories', category, duration)
+            if self.critical_path:
+                output[category] = duration
 
-    def analyze_trace(self, input_json, id):
-        # Json string to json
-        newjson = json.loads(input_json)
-        df = pd.DataFrame.from_dict(newjson)
+    def format_timestamp(self, us):
+        if self.output_format == 'parquet':
+            return us
+        return format_us(us)
 
-        time_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+    @profiled
+    def analyze_trace(self, input_json, id, sketches=None):
+        # Json string to list of Application Insights records
+        with Phase('parse_traces'):
+            records = json_backend.loads(input_json)
 
         # Interesting time points
-        t1 = df.loc[(df["itemType"]=="request") & (df["name"].str.contains("POST")), "timestamp"].values[0]
-        t2 = df.loc[(df["itemType"]=="request") & (df["name"]=="Upload"), "timestamp"].values[0]
-        t3 = df.loc[(df["name"]=="Upload function execution"), "timestamp"].values[0]
-        t4 = df.loc[(df["itemType"]=="trace") & (df["message"].str.contains("Upload Blob Operation Starts")), "timestamp"].values[0]
-        t5 = df.loc[(df["name"]=="PUT thumbnaistore") & (df["operation_Name"]=="Upload") & (df["resultCode"]== "201"), "timestamp"].values[0]
-        t5_t6 = df.loc[(df["name"]=="PUT thumbnaistore") & (df["operation_Name"]=="Upload") & (df["resultCode"]== "201"), "duration"].values[0]
-        t6 = (self.strptime_pro(t5, time_format) +  datetime.timedelta(milliseconds=t5_t6)).strftime(time_format)
-        t7 = df.loc[(df["itemType"]=="request") & (df["name"]=="Create-Thumbnail"), "timestamp"].values[0]
-        t8 = df.loc[(df["name"]=="CreateThumbnail execution"), "timestamp"].values[0]
-        t9 = df.loc[(df["name"]=="GET thumbnaistore") & (df["operation_Name"]=="Create-Thumbnail"), "timestamp"].values[0]
-        t9_t10 = df.loc[(df["name"]=="GET thumbnaistore") & (df["operation_Name"]=="Create-Thumbnail"), "duration"].values[0]
-        t10 = (self.strptime_pro(t9, time_format) +  datetime.timedelta(milliseconds=t9_t10)).strftime(time_format)
-        t11 = df.loc[(df["itemType"]=="trace") & (df["message"].str.contains("CreateThumbnail PUT Operation Starts")), "timestamp"].values[0]
-        t12 = df.loc[(df["name"]=="PUT thumbnaistore") & (df["operation_Name"]=="Create-Thumbnail") & (df["resultCode"]== "201"), "timestamp"].values[0]
-        t12_t13 = df.loc[(df["name"]=="PUT thumbnaistore") & (df["operation_Name"]=="Create-Thumbnail") & (df["resultCode"]== "201"), "duration"].values[0]
-        t13 = (self.strptime_pro(t12, time_format) +  datetime.timedelta(milliseconds=t12_t13)).strftime(time_format)
-
-        host_initialization = len(df.loc[(df["itemType"]=="trace") & (df["customDimensions"].str.contains("Host initialization"))])
-        f1_cold_start = 0 if (host_initialization == 0) else 1
-        f2_cold_start = 0 if (host_initialization == 0) else 1
-
-    
-        # print(f'id:{id}') 
-        # print(f"t1: {t1}")
-        # print(f"t2: {t2}")
-        # print(f"t3: {t3}")
-        # print(f"t4: {t4}")
-        # print(f"t5: {t5}")
-        # print(f"t6: {t6}")
-        # print(f"t7: {t7}")
-        # print(f"t8: {t8}")
-        # print(f't9: {t9}')
-        # print(f't10: {t10}')
-        # print(f't11: {t11}')
-        # print(f't12: {t12}')
-        # print(f't13: {t13}')
-
-        output = {
-            'trace_id': id,
-            't1': ft(t1),
-            't2': ft(t2),
-            't3': ft(t3),
-            't4': ft(t4),
-            't5': ft(t5),
-            't6': ft(t6),
-            't7': ft(t7),
-            't8': ft(t8),
-            't9': ft(t9),
-            't10': ft(t10),
-            't11': ft(t11),
-            't12': ft(t12),
-            't13': ft(t13),
-            'f1_cold_start': f1_cold_start,
-            'f2_cold_start': f2_cold_start
-        }
+        matches = match_records(records)
+        missing = [name for name in RECORD_RULES
+                   if name not in matches and name not in OPTIONAL_RULES]
+        if missing:
+            raise Exception(f"Trace {id} has no matching records for {missing}.")
+        timestamps = {name: parse_us(record['timestamp']) for name, record in matches.items()}
+        for end, start in END_TIMESTAMPS.items():
+            timestamps[end] = timestamps[start] + duration_us(matches[start]['duration'])
+
+        f1_cold_start = 1 if 'host_initialization' in matches else 0
+        f2_cold_start = f1_cold_start
+
+        if sketches is not None:
+            add_interval_latencies(sketches, {field: timestamps[field]
+                                              for field in TIMESTAMP_FIELDS})
 
+        output = {'trace_id': id}
+        for field in TIMESTAMP_FIELDS:
+            output[field] = self.format_timestamp(timestamps[field])
+        output['f1_cold_start'] = f1_cold_start
+        output['f2_cold_start'] = f2_cold_start
+        if sketches is not None or self.critical_path:
+            self.add_category_latencies(output, sketches, records, id)
         return output
 
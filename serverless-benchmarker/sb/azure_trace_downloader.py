@@ -1,8 +1,50 @@
 import logging
 import json
+import time
+import numpy as np
 import pandas as pd
 import requests
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from sb.trace_storage import validate_compression, traces_file_name, open_traces
+from sb.timestamps import EPOCH, ONE_US, parse_us, duration_us
+
+
+"""Application Insights tables queried for the records of traces."""
+RECORD_TABLES = 'requests,dependencies,traces,customEvents'
+
+"""Duration of the windows in which the batched mode queries all records at once.
+Keeps the results of a single query below the API limits (i.e., 500k rows and 64 MB)."""
+DEFAULT_WINDOW = timedelta(minutes=5)
+
+"""Time after the invoke window in which records still belong to its traces
+(e.g., asynchronously triggered functions)."""
+TRACE_MARGIN = timedelta(minutes=5)
+
+"""Tokens of customDimensions that are looked up as operation ids, which are W3C trace ids
+(i.e., 32 hex digits) in Azure Functions."""
+OPERATION_ID_TOKEN = r'[0-9A-Za-z]+'
+
+"""Time after the end of the Create-Thumbnail request of a trace after which the batched mode
+writes the trace (i.e., once all windows until then are queried). Later records of the trace
+(e.g., delayed trace logs) are not saved."""
+COMPLETION_TIME = timedelta(minutes=1)
+
+API_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+EPOCH_UTC = EPOCH.replace(tzinfo=timezone.utc)
+
+"""Windows with partial query results (e.g., above the API limits) are split into halves
+unless shorter than 2 * MIN_WINDOW."""
+MIN_WINDOW = timedelta(seconds=1)
+
+"""Attempts per window query before its records are skipped (e.g., due to throttling) and
+the delay in seconds before the first retry, which doubles for every further retry."""
+MAX_ATTEMPTS = 4
+RETRY_DELAY = 5
+
+"""Columns of records required to split them into traces (e.g., of skipped windows)."""
+RECORD_COLUMNS = ['timestamp', 'itemType', 'name', 'operation_Id', 'customDimensions',
+                  'duration']
+
 
 class AzureTraceDownloader:
     """Implements get_traces(self) to download Microsoft Azure Insights traces using
@@ -10,8 +52,26 @@ class AzureTraceDownloader:
     TODO(Add doc links to 'best' Azure docs)
     """
 
-    def __init__(self, spec) -> None:
+    def __init__(self, spec, compression=None, batched=False, window=DEFAULT_WINDOW,
+                 completion_time=COMPLETION_TIME) -> None:
+        """
+        Args:
+            spec: Benchmark spec of the invocation.
+            compression: Compresses traces.json while downloading (see trace_storage).
+            batched: Queries the records of all traces in a few windowed queries and splits them
+                by operation locally (see retrieve_traces_batched) instead of sending two
+                queries per operation.
+            window: Duration of the windows queried in batched mode.
+            completion_time: Time after the end of its Create-Thumbnail request after which
+                a trace is complete in batched mode. None saves all traces after the last window
+                without losing late records at the cost of keeping all records in memory.
+        """
+        validate_compression(compression)
         self.spec = spec
+        self.compression = compression
+        self.batched = batched
+        self.window = window
+        self.completion_time = completion_time
 
     def get_traces(self):
         """Retrieves Azure Insights traces from the last invocation.
@@ -21,13 +81,19 @@ class AzureTraceDownloader:
         log_path = self.spec.logs_directory()
 
         trace_ids_file = log_path.joinpath('trace_ids.txt')
-        trace_file = log_path.joinpath('traces.json')
+        trace_file = log_path.joinpath(traces_file_name(self.compression))
 
         start_time = datetime.fromtimestamp(datetime.timestamp(start), tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
         end_time = datetime.fromtimestamp(datetime.timestamp(end), tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
         trace_ids = self.retrieve_trace_ids(start_time, end_time, trace_ids_file)
-        self.retrieve_traces(start_time, trace_ids, trace_file)
+        if self.batched:
+            utc_start = datetime.fromtimestamp(datetime.timestamp(start), tz=timezone.utc)
+            utc_end = datetime.fromtimestamp(datetime.timestamp(end), tz=timezone.utc)
+            self.retrieve_traces_batched(utc_start, utc_end + TRACE_MARGIN, trace_ids,
+                                         trace_file)
+        else:
+            self.retrieve_traces(start_time, trace_ids, trace_file)
 
         num_traces = len(trace_ids)
 
@@ -35,14 +101,16 @@ class AzureTraceDownloader:
         logging.info(f"Downloaded {num_traces} traces for invocations between \
 {start} and {end} into {log_path}.")
 
-    def get_query_result_json(self, ai_api_query):
+    def get_query_result_json(self, ai_api_query, ai_api_time_span='P7D'):
+        """Returns the result of a KQL query within a timespan, which is either an ISO 8601
+        duration before now (e.g., P7D) or an ISO 8601 interval (i.e., start/end)."""
         ai_api_version = 'v1'
         ai_api_app_id = self.spec['application_id']
         ai_api_key = self.spec['api_key']
-        ai_api_time_span = 'P7D'
         api_url = f"https://api.applicationinsights.io/{ai_api_version}/apps/{ai_api_app_id}/query?timespan={ai_api_time_span}&query={ai_api_query}"
         headers =  { "x-api-key" : ai_api_key }
         response = requests.get(api_url, headers=headers)
+        response.raise_for_status()
         data = response.json()
 
         return data
@@ -53,7 +121,7 @@ class AzureTraceDownloader:
                 | where timestamp >= datetime({start}) and timestamp <= datetime({end}) and name == "Upload" and resultCode == "200"
                 | distinct operation_Id
             """
-        data = self.get_query_result_json(ai_api_query)
+        data = self.get_query_result_json(ai_api_query, f"{start}/{end}")
         rows = data['tables'][0]['rows']
 
         trace_ids = []
@@ -66,47 +134,226 @@ class AzureTraceDownloader:
         return trace_ids
 
     def retrieve_traces(self, start_time, trace_ids, trace_file):
-        # Clear traces data
-        open(trace_file, 'w').close()
+        # Clear traces data and keep a single (compressed) stream open for all traces
+        with open_traces(trace_file, 'w') as f:
+            for operation_Id in trace_ids:
+                self.retrieve_trace(start_time, operation_Id, f)
 
-        for operation_Id in trace_ids:
-            try:
-                print(f"> Downloading traces for {operation_Id}")
-                # Get CreateThumbnail and Upload requests data
-                query1 = f"""
-                    union requests
-                    | where timestamp >= datetime({start_time}) and itemType == "request"
-                        and (operation_Id == "{operation_Id}" or customDimensions contains "{operation_Id}")
-                    """
-
-                result_query1 = self.get_query_result_json(query1)
-                columns_query1 = [x['name'] for x in result_query1['tables'][0]['columns']]
-                rows_query1 = result_query1['tables'][0]['rows']
-                df_query1 = pd.DataFrame(rows_query1, columns=columns_query1)
-
-                # Extract CreateThumbnail and Upload timestamp
-                create_thumbnail_timestamp= df_query1.loc[(df_query1["itemType"]=="request") & (df_query1["name"]=="Create-Thumbnail"), "timestamp"].values[0]
-                upload_timestamp= df_query1.loc[(df_query1["itemType"]=="request") & (df_query1["name"]=="Upload"), "timestamp"].values[0]
-
-                # Final query for all relevant data
-                ai_api_query = f"""
-                    union requests,dependencies,traces,customEvents
-                    | where timestamp >=  datetime({start_time}) and ( operation_Id == "{operation_Id}" or customDimensions contains "{operation_Id}"
-                        or (customDimensions contains "Host initialization" and timestamp >=  datetime({upload_timestamp}) and timestamp <= datetime({create_thumbnail_timestamp})) )
-                    """
-                data = self.get_query_result_json(ai_api_query)
-                columns = [x['name'] for x in data['tables'][0]['columns']]
-                rows = data['tables'][0]['rows']
-                df = pd.DataFrame(rows, columns=columns)
-
-                newjson = {}
-                newjson['trace_id'] = operation_Id
-                newjson['traces'] = df.to_json(orient='records')
-
-                with open(trace_file, 'a') as f:
+    def retrieve_trace(self, start_time, operation_Id, f):
+        try:
+            print(f"> Downloading traces for {operation_Id}")
+            # Get CreateThumbnail and Upload requests data
+            query1 = f"""
+                union requests
+                | where timestamp >= datetime({start_time}) and itemType == "request"
+                    and (operation_Id == "{operation_Id}" or customDimensions contains "{operation_Id}")
+                """
+
+            result_query1 = self.get_query_result_json(query1)
+            columns_query1 = [x['name'] for x in result_query1['tables'][0]['columns']]
+            rows_query1 = result_query1['tables'][0]['rows']
+            df_query1 = pd.DataFrame(rows_query1, columns=columns_query1)
+
+            # Extract CreateThumbnail and Upload timestamp
+            create_thumbnail_timestamp= df_query1.loc[(df_query1["itemType"]=="request") & (df_query1["name"]=="Create-Thumbnail"), "timestamp"].values[0]
+            upload_timestamp= df_query1.loc[(df_query1["itemType"]=="request") & (df_query1["name"]=="Upload"), "timestamp"].values[0]
+
+            # Final query for all relevant data
+            ai_api_query = f"""
+                union requests,dependencies,traces,customEvents
+                | where timestamp >=  datetime({start_time}) and ( operation_Id == "{operation_Id}" or customDimensions contains "{operation_Id}"
+                    or (customDimensions contains "Host initialization" and timestamp >=  datetime({upload_timestamp}) and timestamp <= datetime({create_thumbnail_timestamp})) )
+                """
+            data = self.get_query_result_json(ai_api_query)
+            columns = [x['name'] for x in data['tables'][0]['columns']]
+            rows = data['tables'][0]['rows']
+            df = pd.DataFrame(rows, columns=columns)
+
+            newjson = {}
+            newjson['trace_id'] = operation_Id
+            newjson['traces'] = df.to_json(orient='records')
+
+            json.dump(newjson, f)
+            f.write('\n')
+        except:
+            print("Failed to download trace for " + operation_Id)
+
+    def retrieve_traces_batched(self, start, end, trace_ids, trace_file):
+        """Retrieves the records of all traces between the UTC datetimes start and end
+        with one query per window instead of two queries per operation (see retrieve_traces).
+        The records of every trace are split by operation locally (see split_records)
+        and saved in the same format as retrieve_traces.
+        Windows are split and written one at a time such that memory stays bounded: traces are
+        written once the queried windows cover the end of their Create-Thumbnail request plus
+        completion_time and only the records of pending traces are carried over to the next
+        window (see carried_records). Traces without both requests are logged as failed."""
+        trace_ids = list(trace_ids)
+        pending_ids = set(trace_ids)
+        carried = None
+        with open_traces(trace_file, 'w') as f:
+            for window_start, window_end in time_windows(start, end, self.window):
+                records = self.retrieve_records(window_start, window_end)
+                if carried is not None:
+                    records = pd.concat([carried, records], ignore_index=True)
+                timestamps = records['timestamp'].map(parse_us).to_numpy()
+                # Traces are complete if their Create-Thumbnail request ends until then
+                if window_end >= end:
+                    complete_until = float('inf')
+                elif self.completion_time is None:
+                    complete_until = float('-inf')
+                else:
+                    complete_until = (window_end - self.completion_time - EPOCH_UTC) // ONE_US
+                for operation_Id, indices in split_records(records, pending_ids).items():
+                    if create_thumbnail_end_us(records, timestamps, indices) > complete_until:
+                        continue
+                    newjson = {}
+                    newjson['trace_id'] = operation_Id
+                    newjson['traces'] = records.iloc[indices].to_json(orient='records')
                     json.dump(newjson, f)
                     f.write('\n')
+                    pending_ids.remove(operation_Id)
+                carried = carried_records(records, timestamps, pending_ids)
+        for operation_Id in trace_ids:
+            if operation_Id in pending_ids:
+                logging.warning(f"Failed to download trace for {operation_Id}.")
+
+    def retrieve_records(self, start, end):
+        """Returns a DataFrame of all records of RECORD_TABLES within a window between the UTC
+        datetimes start and end with the timespan narrowed to the window.
+        Windows with partial results (e.g., above the API limits) are split into halves down to
+        MIN_WINDOW and windows failing after MAX_ATTEMPTS are skipped such that the traces of
+        other windows are still saved.
+        Records without timestamp cannot be assigned to traces and are dropped."""
+        window_start = start.strftime(API_TIMESTAMP_FORMAT)
+        window_end = end.strftime(API_TIMESTAMP_FORMAT)
+        try:
+            data = self.query_records(window_start, window_end)
+        except Exception as e:
+            logging.error(f"Skipped the records of the window {window_start}/{window_end}. {e}")
+            return pd.DataFrame(columns=RECORD_COLUMNS, dtype=object)
+        error = data.get('error')
+        if error is not None:
+            if end - start >= 2 * MIN_WINDOW:
+                logging.warning(f"Partial result for the window {window_start}/{window_end}"
+                                f" ({error.get('code')}). Splitting it into halves.")
+                middle = start + (end - start) / 2
+                return pd.concat([self.retrieve_records(start, middle),
+                                  self.retrieve_records(middle, end)], ignore_index=True)
+            logging.error(f"Partial result for the window {window_start}/{window_end}"
+                          f" ({error.get('code')}). Some records might be missing.")
+        columns = [x['name'] for x in data['tables'][0]['columns']]
+        # Keeps the JSON types of values independent of the other records in a window
+        records = pd.DataFrame(data['tables'][0]['rows'], columns=columns, dtype=object)
+        valid = records['timestamp'].notna() & (records['timestamp'] != '')
+        if not valid.all():
+            logging.warning(f"Dropped {(~valid).sum()} records without timestamp"
+                            f" until {window_end}.")
+        logging.debug(f"Retrieved {valid.sum()} records until {window_end}.")
+        return records[valid].reset_index(drop=True)
+
+    def query_records(self, window_start, window_end) -> dict:
+        """Returns the query result of all records within a window and retries failed queries
+        (e.g., throttled or without result tables) with exponential backoff."""
+        ai_api_query = f"""
+            union {RECORD_TABLES}
+            | where timestamp >= datetime({window_start}) and timestamp < datetime({window_end})
+            """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                data = self.get_query_result_json(ai_api_query, f"{window_start}/{window_end}")
+                if 'tables' not in data:
+                    raise Exception(f"Query failed: {data.get('error')}")
+                return data
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                delay = RETRY_DELAY * 2 ** (attempt - 1)
+                logging.warning(f"Query for the window {window_start}/{window_end} failed. {e}"
+                                f" Retrying in {delay}s.")
+                time.sleep(delay)
+
+
+def time_windows(start, end, window) -> list:
+    """Returns consecutive (start, end) windows of at most the given duration covering
+    start to end."""
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window, end)))
+        start += window
+    return windows
+
+
+def link_records(records, trace_ids):
+    """Returns the (position, trace_id) pairs of all records in record order whose operation_Id
+    or a token of their customDimensions is one of the trace ids."""
+    ids = pd.Series(list(trace_ids), dtype=object)
+    operation_ids = records['operation_Id']
+    tokens = records['customDimensions'].astype(str).str.findall(OPERATION_ID_TOKEN).explode()
+    links = pd.concat([operation_ids[operation_ids.isin(ids)], tokens[tokens.isin(ids)]])
+    links = links.rename('trace_id').rename_axis('position').reset_index().drop_duplicates()
+    return links.sort_values('position', kind='stable')
+
+
+def is_host_initialization(records):
+    return records['customDimensions'].astype(str).str.contains('Host initialization',
+                                                                regex=False)
+
+
+def split_records(records, trace_ids) -> dict:
+    """Returns the positions of the records of every trace id in record order alike the
+    per-operation queries of retrieve_traces. Records belong to a trace if their operation_Id
+    or a token of their customDimensions is the trace id, or if they are host initialization
+    records between the Upload and Create-Thumbnail requests of the trace.
+    Trace ids without both requests are missing (i.e., failed downloads)."""
+    if len(records) == 0:
+        return {}
+    links = link_records(records, trace_ids)
+
+    # Timestamps of the first Upload and Create-Thumbnail requests of each trace
+    linked = links.assign(itemType=records['itemType'].to_numpy()[links['position']],
+                          name=records['name'].to_numpy()[links['position']],
+                          timestamp=records['timestamp'].to_numpy()[links['position']])
+    linked_requests = linked[linked['itemType'] == 'request']
+    upload = linked_requests[linked_requests['name'] == 'Upload'].drop_duplicates('trace_id')
+    create_thumbnail = linked_requests[linked_requests['name'] == 'Create-Thumbnail'] \
+        .drop_duplicates('trace_id')
+    windows = upload.merge(create_thumbnail, on='trace_id', suffixes=('_upload', '_create'))
+
+    # Host initialization records within each window by binary search over their timestamps
+    host_initialization = is_host_initialization(records)
+    host_timestamps = records.loc[host_initialization, 'timestamp'].map(parse_us).sort_values()
+    host_positions = host_timestamps.index.to_numpy()
+    firsts = np.searchsorted(host_timestamps.to_numpy(),
+                             windows['timestamp_upload'].map(parse_us).to_numpy(), side='left')
+    lasts = np.searchsorted(host_timestamps.to_numpy(),
+                            windows['timestamp_create'].map(parse_us).to_numpy(), side='right')
+    positions = links.groupby('trace_id')['position'].apply(list).to_dict()
+    traces = {}
+    for trace_id, first, last in zip(windows['trace_id'], firsts, lasts):
+        trace_positions = set(positions[trace_id]).union(host_positions[first:last])
+        traces[trace_id] = sorted(trace_positions)
+    return traces
+
+
+def create_thumbnail_end_us(records, timestamps, indices) -> int:
+    """Returns the end in µs since epoch of the first Create-Thumbnail request among the records
+    of a trace (see split_records) given the µs since epoch of all records."""
+    for i in indices:
+        if records['itemType'].iat[i] == 'request' and records['name'].iat[i] == 'Create-Thumbnail':
+            return timestamps[i] + duration_us(records['duration'].iat[i] or 0)
+    raise Exception('Missing Create-Thumbnail request.')
+
 
-                f.close()
-            except:
-                print("Failed to download trace for " + operation_Id)
+def carried_records(records, timestamps, trace_ids):
+    """Returns the records of pending trace ids (i.e., not written yet) in record order, which are
+    the records linked to them and the host initialization records from their first record on
+    that split_records might assign to them once their Create-Thumbnail request arrives.
+    timestamps are the µs since epoch of all records."""
+    positions = link_records(records, trace_ids)['position'].unique()
+    if len(records) == 0 or len(positions) == 0:
+        return records.iloc[:0]
+    carried = np.zeros(len(records), dtype=bool)
+    carried[positions] = True
+    first_timestamp = timestamps[positions].min()
+    carried |= is_host_initialization(records).to_numpy() & (timestamps >= first_timestamp)
+    return records[carried]
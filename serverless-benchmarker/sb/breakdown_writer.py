@@ -0,0 +1,141 @@
+import logging
+import csv
+import os
+from datetime import datetime
+from pathlib import Path
+from sb.analysis_checkpoint import AnalysisCheckpoint, read_line_chunks
+from sb.analysis_profile import Phase
+from sb.trace_storage import open_traces, is_compressed
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+"""Supported output formats of trace analyzers:
+* csv: trace_breakdown.csv with formatted timestamp strings (supports incremental analysis)
+* parquet: trace_breakdown.parquet with native UTC timestamp columns (requires pyarrow)
+"""
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+"""Parquet schema metadata recording whether the timestamps of trace_breakdown.csv are local
+(i.e., datetime.fromtimestamp in the AWS analyzer) or UTC (i.e., the Azure analyzer)
+wall-clock times such that data_importer loads both output formats into the same times."""
+CSV_TIME_METADATA = b'sb.csv_time'
+
+"""Parquet schema metadata recording the timezone of the analyzer for local csv times
+(see local_timezone) because the importer might run on a machine in another timezone."""
+CSV_TIMEZONE_METADATA = b'sb.csv_timezone'
+
+"""Directory prefix of IANA timezone files (e.g., /usr/share/zoneinfo/Europe/Zurich)."""
+ZONEINFO_DIR = 'zoneinfo/'
+
+
+def validate_output_format(output_format, incremental=False) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception(f"Unsupported output format {output_format}. Use one of {OUTPUT_FORMATS}.")
+    if output_format == 'parquet':
+        if pa is None:
+            raise Exception('Parquet output requires pyarrow (pip install pyarrow).')
+        if incremental:
+            raise Exception('Incremental analysis is only supported for csv output.')
+
+
+def breakdown_path(traces_file, output_format) -> Path:
+    return Path(traces_file).parent / f"trace_breakdown.{output_format}"
+
+
+def write_csv_breakdown(traces_file, fields, map_chunks, chunk_size, incremental=False) -> int:
+    """Streams traces.json in chunks of lines through map_chunks and writes the results of
+    each chunk into trace_breakdown.csv before reading further.
+    map_chunks maps (lines, offset) chunks to (results, offset) in input order.
+    With incremental, a checkpoint is saved after every chunk (see AnalysisCheckpoint) and
+    the analysis resumes from the last checkpoint. Full analyses remove outdated checkpoints.
+    Returns the number of traces in trace_breakdown.csv.
+    Compressed traces cannot be analyzed incrementally because their offsets require
+    decompressing from the start of the file."""
+    if incremental and is_compressed(traces_file):
+        raise Exception(f"Incremental analysis is not supported for compressed {traces_file}.")
+    breakdown_file = breakdown_path(traces_file, 'csv')
+    checkpoint = AnalysisCheckpoint(traces_file, breakdown_file, fields)
+    resumed = incremental and checkpoint.resume()
+    if not incremental:
+        checkpoint.remove()
+    num_previous_traces = checkpoint.num_traces
+    num_traces = num_previous_traces
+    with open_traces(traces_file, 'rb') as traces_json, \
+            open(breakdown_file, 'a' if resumed else 'w', newline='') as traces_csv:
+        trace_writer = csv.DictWriter(traces_csv, fieldnames=fields, lineterminator='\n')
+        if not resumed:
+            trace_writer.writeheader()
+        line_chunks = read_line_chunks(traces_json, chunk_size, checkpoint.offset,
+                                       complete_lines=incremental)
+        for results, offset in map_chunks(line_chunks):
+            with Phase('write_csv'):
+                trace_writer.writerows(results)
+                traces_csv.flush()
+            num_traces += len(results)
+            if incremental:
+                with Phase('checkpoint'):
+                    checkpoint.save(offset, traces_csv.tell(), num_traces)
+    if resumed:
+        logging.info(f"Analyzed {num_traces - num_previous_traces} new traces.")
+    return num_traces
+
+
+def breakdown_schema(fields, timestamp_fields, local_csv_time=False, duration_fields=()):
+    """Returns the Arrow schema of a trace breakdown where timestamp_fields are UTC timestamps
+    with µs precision, duration_fields are float milliseconds, trace_id is a string, and all
+    other fields are int8 flags (e.g., cold starts). local_csv_time is recorded as
+    CSV_TIME_METADATA together with the local timezone as CSV_TIMEZONE_METADATA."""
+    columns = []
+    for field in fields:
+        if field == 'trace_id':
+            columns.append((field, pa.string()))
+        elif field in timestamp_fields:
+            columns.append((field, pa.timestamp('us', tz='UTC')))
+        elif field in duration_fields:
+            columns.append((field, pa.float64()))
+        else:
+            columns.append((field, pa.int8()))
+    metadata = {CSV_TIME_METADATA: b'utc'}
+    if local_csv_time:
+        metadata = {CSV_TIME_METADATA: b'local',
+                    CSV_TIMEZONE_METADATA: local_timezone().encode()}
+    return pa.schema(columns, metadata=metadata)
+
+
+def local_timezone() -> str:
+    """Returns the IANA name of the local timezone used by datetime.fromtimestamp
+    (e.g., Europe/Zurich from the TZ variable or /etc/localtime) or otherwise
+    its current UTC offset (e.g., +0100)."""
+    name = os.environ.get('TZ', '').lstrip(':')
+    if not name and os.path.islink('/etc/localtime'):
+        name = os.path.realpath('/etc/localtime')
+    if ZONEINFO_DIR in name:
+        name = name.split(ZONEINFO_DIR, 1)[1]
+    if name and not name.startswith('/'):
+        return name
+    return datetime.now().astimezone().strftime('%z')
+
+
+def write_parquet_breakdown(traces_file, schema, map_chunks, chunk_size) -> int:
+    """Streams traces.json in chunks of lines through map_chunks and writes the results of
+    each chunk as a row group into trace_breakdown.parquet.
+    Timestamps are expected as integer µs since epoch. Only the low-cardinality flags are
+    dictionary-encoded because trace ids and timestamps are (almost) unique per row.
+    Returns the number of traces in trace_breakdown.parquet."""
+    breakdown_file = breakdown_path(traces_file, 'parquet')
+    flags = [field.name for field in schema if pa.types.is_integer(field.type)]
+    num_traces = 0
+    with open_traces(traces_file, 'rb') as traces_json, \
+            pq.ParquetWriter(breakdown_file, schema, use_dictionary=flags) as writer:
+        for results, _ in map_chunks(read_line_chunks(traces_json, chunk_size)):
+            if len(results) > 0:
+                with Phase('write_parquet'):
+                    writer.write_table(pa.Table.from_pylist(results, schema=schema))
+            num_traces += len(results)
+    return num_traces
@@ -0,0 +1,40 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+"""Pluggable JSON decoding for traces.json files.
+Uses the faster orjson parser if installed (e.g., pip install -e .[fast]) and
+falls back to the standard library json module otherwise.
+The environment variable SB_JSON_BACKEND=json enforces the standard library.
+Callers use json_backend.loads(...) such that use_backend applies to them.
+"""
+BACKENDS = ['orjson', 'json']
+
+backend = None
+loads = json.loads
+
+
+def default_backend() -> str:
+    name = os.environ.get('SB_JSON_BACKEND')
+    if name:
+        return name
+    return 'orjson' if orjson is not None else 'json'
+
+
+def use_backend(name) -> None:
+    """Selects the JSON backend for decoding by name (see BACKENDS)."""
+    global backend, loads
+    if name not in BACKENDS:
+        raise Exception(f"Unsupported JSON backend {name}. Use one of {BACKENDS}.")
+    if name == 'orjson' and orjson is None:
+        raise Exception('JSON backend orjson is not installed.')
+    loads = orjson.loads if name == 'orjson' else json.loads
+    backend = name
+
+
+use_backend(default_backend())
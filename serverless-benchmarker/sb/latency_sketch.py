@@ -0,0 +1,202 @@
+import json
+import math
+import os
+from pathlib import Path
+
+
+"""Relative accuracy of quantile estimates (i.e., 1% relative error)."""
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+"""Absolute values below this threshold are counted as zero."""
+MIN_VALUE = 1e-9
+
+DEFAULT_QUANTILES = [0.5, 0.95, 0.99]
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with relative accuracy guarantees based on DDSketch:
+    * Paper: https://www.vldb.org/pvldb/vol12/p2195-masson.pdf
+    * Title: "DDSketch: A Fast and Fully-Mergeable Quantile Sketch with Relative-Error Guarantees"
+    Values are counted in logarithmically sized buckets such that any quantile estimate is within
+    the relative accuracy of the true value. Merging two sketches adds their bucket counts and
+    is therefore exact (i.e., equals the sketch of all values).
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # Bucket index => count for positive values and absolute negative values
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value) -> int:
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def bucket_value(self, index) -> float:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value) -> None:
+        if value > MIN_VALUE:
+            index = self.bucket(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < -MIN_VALUE:
+            index = self.bucket(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other) -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise Exception(f"Cannot merge sketches with relative accuracy"
+                            f" {other.relative_accuracy} into {self.relative_accuracy}.")
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count > 0:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns the estimated q-quantile (0 <= q <= 1) or None for an empty sketch."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        cumulative = 0
+        estimate = self.max
+        for index in sorted(self.negative, reverse=True):
+            cumulative += self.negative[index]
+            if cumulative > rank:
+                estimate = -self.bucket_value(index)
+                break
+        else:
+            cumulative += self.zero_count
+            if cumulative > rank:
+                estimate = 0.0
+            else:
+                for index in sorted(self.positive):
+                    cumulative += self.positive[index]
+                    if cumulative > rank:
+                        estimate = self.bucket_value(index)
+                        break
+        # Exact bounds are known
+        return min(max(estimate, self.min), self.max)
+
+    def to_dict(self) -> dict:
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'zero_count': self.zero_count,
+            'positive': {str(index): count for index, count in self.positive.items()},
+            'negative': {str(index): count for index, count in self.negative.items()}
+        }
+
+    @staticmethod
+    def from_dict(state):
+        sketch = QuantileSketch(state['relative_accuracy'])
+        sketch.count = state['count']
+        sketch.sum = state['sum']
+        sketch.min = state['min']
+        sketch.max = state['max']
+        sketch.zero_count = state['zero_count']
+        sketch.positive = {int(index): count for index, count in state['positive'].items()}
+        sketch.negative = {int(index): count for index, count in state['negative'].items()}
+        return sketch
+
+
+class LatencySketches:
+    """Quantile sketches of latencies in milliseconds by group and name, such as
+    critical path categories (e.g., categories/computation) and
+    intervals between timestamps (e.g., intervals/t1t2)."""
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.groups = {}
+
+    def sketch(self, group, name) -> QuantileSketch:
+        sketches = self.groups.setdefault(group, {})
+        if name not in sketches:
+            sketches[name] = QuantileSketch(self.relative_accuracy)
+        return sketches[name]
+
+    def add(self, group, name, value) -> None:
+        self.sketch(group, name).add(value)
+
+    def merge(self, other) -> None:
+        for group, sketches in other.groups.items():
+            for name, sketch in sketches.items():
+                self.sketch(group, name).merge(sketch)
+
+    def quantiles(self, quantiles=DEFAULT_QUANTILES) -> list:
+        """Returns a list of rows with group, name, count, and the estimated quantiles
+        (e.g., p50, p95, p99), which can be loaded into a pandas DataFrame."""
+        rows = []
+        for group, sketches in self.groups.items():
+            for name, sketch in sketches.items():
+                row = {'group': group, 'name': name, 'count': sketch.count}
+                for q in quantiles:
+                    row[f"p{q * 100:g}"] = sketch.quantile(q)
+                rows.append(row)
+        return rows
+
+    def save(self, path) -> None:
+        state = {
+            'relative_accuracy': self.relative_accuracy,
+            'groups': {group: {name: sketch.to_dict() for name, sketch in sketches.items()}
+                       for group, sketches in self.groups.items()}
+        }
+        tmp_path = Path(path).with_suffix('.tmp')
+        with open(tmp_path, 'w') as sketch_file:
+            json.dump(state, sketch_file)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path) as sketch_file:
+            state = json.load(sketch_file)
+        sketches = LatencySketches(state['relative_accuracy'])
+        for group, group_sketches in state['groups'].items():
+            for name, sketch in group_sketches.items():
+                sketches.groups.setdefault(group, {})[name] = QuantileSketch.from_dict(sketch)
+        return sketches
+
+
+def merge_sketch_files(paths) -> LatencySketches:
+    """Merges the latency sketches of multiple runs (e.g., trace_breakdown.sketches.json files)."""
+    merged = LatencySketches()
+    for path in paths:
+        sketches = LatencySketches.load(path)
+        merged.relative_accuracy = sketches.relative_accuracy
+        merged.merge(sketches)
+    return merged
+
+
+def add_interval_latencies(sketches, timestamps_us) -> None:
+    """Adds the latencies between consecutive timestamps (e.g., t1t2, t2t3) and
+    the total latency between the first and last timestamp.
+    timestamps_us is an ordered dict of timestamp names to µs since epoch or None if missing."""
+    names = list(timestamps_us)
+    for start, end in zip(names, names[1:]):
+        if timestamps_us[start] is not None and timestamps_us[end] is not None:
+            sketches.add('intervals', f"{start}{end}",
+                         (timestamps_us[end] - timestamps_us[start]) / 1000)
+    if len(names) > 1 and timestamps_us[names[0]] is not None and \
+            timestamps_us[names[-1]] is not None:
+        sketches.add('intervals', 'total_duration',
+                     (timestamps_us[names[-1]] - timestamps_us[names[0]]) / 1000)
@@ -14,8 +14,9 @@ from sb.provider import Provider
 from sb.aws_trace_analyzer import AwsTraceAnalyzer
 from sb.aws_trace_downloader import AwsTraceDownloader
 from sb.azure_trace_downloader import AzureTraceDownloader
-from sb.azure_trace_analyzer import AzureTraceAnalyzer
+from sb.azure_trace_analyzer import AzureTraceAnalyzer, DEFAULT_CHUNK_SIZE
 import sb.aws_trace_migrator as aws_trace_migrator
+from sb.trace_storage import find_traces_file
 
 
 SB_IMAGE = 'serverless-benchmarker'
@@ -209,36 +210,90 @@ Use --log_level=DEBUG to get more details.")
             self.bench.invoke(workload_type, **kwargs)
         return self
 
-    def get_traces(self):
+    def get_traces(self, workers=1, k6_trace_ids=False, cache=False, compression=None,
+                   batched=False):
+        """Downloads the traces of the last invocation into traces.json.
+
+        Args:
+            workers: Number of concurrent trace summary and trace requests within
+                adaptive rate limits (AWS only).
+            k6_trace_ids: Retrieves the traces of the X-Ray trace ids tagged by the k6 workload
+                in k6_metrics.csv instead of all traces of the invocation time window (AWS only).
+            cache: Keeps traces in .sb/trace_cache across runs such that repeated downloads
+                only retrieve missing traces, even if traces.json already exists (AWS only).
+            compression: gzip or zstd compresses traces.json while downloading into
+                traces.json.gz or traces.json.zst, which all analyzers read as well.
+            batched: Queries the records of all traces in a few windowed queries instead of
+                two queries per trace (Azure only).
+        """
         self.check_bench_init()
         if(not self.local):
-            self.run_in_docker('get_traces', local=True)
+            self.run_in_docker(f"get_traces --workers={workers} --k6_trace_ids={k6_trace_ids} \
+--cache={cache} --compression={compression} --batched={batched}", local=True)
         else:
             self.bench.chdir()
             self.bench.save_config_to_logs()
             self.bench.save_workload_options_to_logs()
             trace_downloader = None
             if self.bench.spec['provider'] == 'aws':
-                trace_downloader = AwsTraceDownloader(self.bench.spec)
+                trace_downloader = AwsTraceDownloader(self.bench.spec, workers=workers,
+                                                      k6_trace_ids=k6_trace_ids, cache=cache,
+                                                      compression=compression)
             elif self.bench.spec['provider'] == 'azure':
-                trace_downloader = AzureTraceDownloader(self.bench.spec)
+                trace_downloader = AzureTraceDownloader(self.bench.spec, compression=compression,
+                                                        batched=batched)
             else:
                 logging.error('Unsupported provider for trace downloader')
             trace_downloader.get_traces()
             self.bench.fix_permissions()
         return self
 
-    def analyze_traces(self, log_path=None):
+    def analyze_traces(self, log_path=None, workers=1, incremental=False, output_format='csv',
+                       sketches=False, service_map=False, profile=False, vectorized=False,
+                       critical_path=False):
+        """Analyzes downloaded traces into a trace_breakdown.csv.
+
+        Args:
+            log_path: Path to a (compressed) traces.json file. Defaults to the last execution.
+            workers: Number of processes analyzing traces in parallel (AWS only).
+                None uses all available CPUs.
+            incremental: Only analyzes traces appended since the last (possibly interrupted)
+                incremental analysis and appends their results to trace_breakdown.csv.
+            output_format: csv or parquet (trace_breakdown.parquet with native timestamps).
+            sketches: Saves mergeable latency quantile sketches into trace_breakdown.sketches.json.
+            service_map: Saves the calls between services across all traces into
+                service_map.json (AWS only).
+            profile: Saves the time per analysis phase and the slowest traces into
+                trace_breakdown.profile.json.
+            vectorized: Analyzes all traces of the run at once with grouped DataFrame filters
+                instead of one trace at a time (Azure only).
+            critical_path: Appends the critical path latency per category (e.g., trigger)
+                to the trace breakdown (Azure only).
+        """
         # Default to last execution if no log path provided
         if log_path is None:
             self.check_bench_init()
             logs_directory = self.bench.spec.logs_directory()
-            log_path = logs_directory.joinpath('traces.json')
+            log_path = find_traces_file(logs_directory)
         trace_analyzer = None
         if self.bench.spec['provider'] == 'aws':
-            trace_analyzer = AwsTraceAnalyzer(log_path)
+            trace_analyzer = AwsTraceAnalyzer(log_path, workers=workers,
+                                              timestamp_rules=self.bench.spec['trace_timestamps'],
+                                              incremental=incremental,
+                                              output_format=output_format,
+                                              sketches=sketches,
+                                              service_map=service_map,
+                                              profile=profile)
         elif self.bench.spec['provider'] == 'azure':
-            trace_analyzer = AzureTraceAnalyzer(log_path)
+            # Vectorized analysis benefits from analyzing the whole run at once
+            chunk_size = None if vectorized else DEFAULT_CHUNK_SIZE
+            trace_analyzer = AzureTraceAnalyzer(log_path, incremental=incremental,
+                                                chunk_size=chunk_size,
+                                                output_format=output_format,
+                                                sketches=sketches,
+                                                profile=profile,
+                                                vectorized=vectorized,
+                                                critical_path=critical_path)
         else:
             logging.error('Unsupported provider for trace downloader')
         trace_analyzer.analyze_traces()
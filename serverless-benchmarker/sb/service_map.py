@@ -0,0 +1,119 @@
+import json
+import os
+from pathlib import Path
+import networkx as nx
+from sb.latency_sketch import QuantileSketch, DEFAULT_RELATIVE_ACCURACY, DEFAULT_QUANTILES
+
+
+"""Service of the client invoking the root span of a trace (alike the client node in XRay)."""
+CLIENT = ('client', 'client')
+
+
+def span_service(G, node) -> tuple:
+    """Returns the (origin, name) service of a span in a SpanTree.
+    Subsegments without origin (e.g., Invocation or an S3 client call)
+    belong to the service of their closest ancestor with an origin."""
+    while G.origin[node] is None and G.parent[node] != -1:
+        node = G.parent[node]
+    return (G.origin[node], G.name[node])
+
+
+class ServiceMap:
+    """Weighted service graph aggregated across traces alike the XRay service map:
+    * Nodes are services identified by (origin, name) with the number of their spans.
+    * Edges are calls between services with the number of calls split by invocation type
+      (sync, async, or client for trace roots) and a latency sketch of the called spans in ms.
+    Traces are added one at a time via add_trace and only the aggregates are kept in memory.
+    Service maps of multiple chunks or runs are combined via merge.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.num_traces = 0
+        # service => number of spans
+        self.nodes = {}
+        # (source service, target service) => {'calls', 'sync', 'async', 'client', 'latency'}
+        self.edges = {}
+
+    def edge(self, source, target) -> dict:
+        edge = self.edges.get((source, target))
+        if edge is None:
+            edge = {'calls': 0, 'sync': 0, 'async': 0, 'client': 0,
+                    'latency': QuantileSketch(self.relative_accuracy)}
+            self.edges[(source, target)] = edge
+        return edge
+
+    def add_trace(self, G) -> None:
+        """Adds the calls between services of a SpanTree after add_global_stats
+        (i.e., with known invocation types). Spans calling into their own service
+        (e.g., subsegments of a Lambda function) are not counted as calls."""
+        services = [span_service(G, node) for node in range(len(G))]
+        for node, service in enumerate(services):
+            self.nodes[service] = self.nodes.get(service, 0) + 1
+            parent = G.parent[node]
+            source = CLIENT if parent == -1 else services[parent]
+            if source == service:
+                continue
+            edge = self.edge(source, service)
+            edge['calls'] += 1
+            edge[G.invocation_type[node]] += 1
+            edge['latency'].add((G.end_us[node] - G.start_us[node]) / 1000)
+        self.num_traces += 1
+
+    def merge(self, other) -> None:
+        self.num_traces += other.num_traces
+        for service, count in other.nodes.items():
+            self.nodes[service] = self.nodes.get(service, 0) + count
+        for (source, target), other_edge in other.edges.items():
+            edge = self.edge(source, target)
+            for key in ['calls', 'sync', 'async', 'client']:
+                edge[key] += other_edge[key]
+            edge['latency'].merge(other_edge['latency'])
+
+    def to_networkx(self, quantiles=DEFAULT_QUANTILES):
+        """Exports the service map into a networkx graph with (origin, name) nodes.
+        Edges have the call counts and estimated latency quantiles (e.g., p50, p95, p99)."""
+        G = nx.DiGraph(num_traces=self.num_traces)
+        for (origin, name), count in self.nodes.items():
+            G.add_node((origin, name), origin=origin, name=name, spans=count)
+        for (source, target), edge in self.edges.items():
+            attr = {key: edge[key] for key in ['calls', 'sync', 'async', 'client']}
+            for q in quantiles:
+                attr[f"p{q * 100:g}"] = edge['latency'].quantile(q)
+            G.add_edge(source, target, **attr)
+        return G
+
+    def save(self, path) -> None:
+        state = {
+            'relative_accuracy': self.relative_accuracy,
+            'num_traces': self.num_traces,
+            'nodes': [{'origin': origin, 'name': name, 'spans': count}
+                      for (origin, name), count in self.nodes.items()],
+            'edges': [{'source': list(source), 'target': list(target),
+                       'calls': edge['calls'], 'sync': edge['sync'], 'async': edge['async'],
+                       'client': edge['client'], 'latency': edge['latency'].to_dict()}
+                      for (source, target), edge in self.edges.items()]
+        }
+        tmp_path = Path(path).with_suffix('.tmp')
+        with open(tmp_path, 'w') as service_map_file:
+            json.dump(state, service_map_file)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path) as service_map_file:
+            state = json.load(service_map_file)
+        service_map = ServiceMap(state['relative_accuracy'])
+        service_map.num_traces = state['num_traces']
+        for node in state['nodes']:
+            service_map.nodes[(node['origin'], node['name'])] = node['spans']
+        for edge in state['edges']:
+            key = (tuple(edge['source']), tuple(edge['target']))
+            service_map.edges[key] = {
+                'calls': edge['calls'],
+                'sync': edge['sync'],
+                'async': edge['async'],
+                'client': edge['client'],
+                'latency': QuantileSketch.from_dict(edge['latency'])
+            }
+        return service_map
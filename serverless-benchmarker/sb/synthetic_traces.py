@@ -0,0 +1,305 @@
+import json
+import random
+
+
+"""Start time of the first synthetic trace (2022-01-06 10:00:00 UTC)."""
+DEFAULT_START_TIME = 1641463200
+
+"""Seconds between the start times of consecutive synthetic traces (i.e., 10 traces/sec)."""
+DEFAULT_INTERVAL = 0.1
+
+SYNTHETIC_URL = 'https://synthetic.execute-api.us-east-1.amazonaws.com/dev/'
+
+"""Downstream services triggering the next function asynchronously:
+* client: name of the aws client subsegment and its operation
+* origin: origin of the inferred segment representing the service
+* delay: range of seconds until the triggered function starts
+* parent: whether the triggered AWS::Lambda segment is a child of the client subsegment
+  (e.g., S3 notifications) or of the inferred segment (e.g., SNS subscriptions)
+"""
+TRIGGER_SERVICES = {
+    'S3': {'client': 'S3', 'operation': 'PutObject', 'origin': 'AWS::S3::Bucket',
+           'delay': (0.3, 0.9), 'parent': 'client'},
+    'SNS': {'client': 'SNS', 'operation': 'Publish', 'origin': 'AWS::SNS',
+            'delay': (0.05, 0.2), 'parent': 'inferred'}
+}
+
+"""Triggers used in turns by the functions of a trace."""
+DEFAULT_TRIGGERS = ('S3', 'SNS')
+
+
+def ms(epoch) -> float:
+    """Rounds to ms precision alike API Gateway and AWS::Lambda segments."""
+    return round(epoch, 3)
+
+
+def us(epoch) -> float:
+    """Rounds to µs precision alike AWS::Lambda::Function segments."""
+    return round(epoch, 6)
+
+
+class SyntheticTraceGenerator:
+    """Generates synthetic XRay traces in the shape returned by BatchGetTraces
+    (i.e., lines of traces.json with JSON-encoded segment documents) for load testing
+    the trace analyzer and downloader without an AWS account.
+    Every trace starts with an API Gateway stage synchronously invoking a Lambda function.
+    Each function calls fan_out downstream services (see TRIGGER_SERVICES) that asynchronously
+    trigger another function until the chain reaches depth functions.
+    Hence, a trace contains depth functions for fan_out=1 and
+    (fan_out^depth - 1) / (fan_out - 1) functions otherwise.
+    Every function invocation is a cold start (i.e., has an Initialization subsegment)
+    with probability cold_start_ratio. Traces are deterministic given seed and index.
+    """
+
+    def __init__(self, depth=2, fan_out=1, cold_start_ratio=0.1, triggers=DEFAULT_TRIGGERS,
+                 seed=42, start_time=DEFAULT_START_TIME, interval=DEFAULT_INTERVAL) -> None:
+        if depth < 1 or fan_out < 1:
+            raise Exception(f"Invalid depth {depth} or fan_out {fan_out}. Both must be >= 1.")
+        if not 0 <= cold_start_ratio <= 1:
+            raise Exception(f"Invalid cold_start_ratio {cold_start_ratio}. Must be in [0, 1].")
+        for trigger in triggers:
+            if trigger not in TRIGGER_SERVICES:
+                raise Exception(f"Unsupported trigger {trigger}. Use {list(TRIGGER_SERVICES)}.")
+        self.depth = depth
+        self.fan_out = fan_out
+        self.cold_start_ratio = cold_start_ratio
+        self.triggers = list(triggers)
+        self.seed = seed
+        self.start_time = start_time
+        self.interval = interval
+
+    def trace_id(self, index) -> str:
+        """Returns the XRay trace id of the trace with the given index.
+        The index is encoded into the last 16 hex digits."""
+        start = int(self.start_time + index * self.interval)
+        return f"1-{start:08x}-{self.seed % 16 ** 8:08x}{index:016x}"
+
+    def trace_index(self, trace_id) -> int:
+        return int(trace_id[-16:], 16)
+
+    def trace(self, index) -> dict:
+        """Returns the trace with the given index."""
+        builder = TraceBuilder(self, self.trace_id(index), random.Random(f"{self.seed}-{index}"))
+        return builder.build(self.start_time + index * self.interval)
+
+    def traces(self, num_traces):
+        for index in range(num_traces):
+            yield self.trace(index)
+
+    def write_traces(self, path, num_traces) -> None:
+        """Writes num_traces into a traces.json file alike AwsTraceDownloader."""
+        with open(path, 'w') as traces_json:
+            for trace in self.traces(num_traces):
+                traces_json.write(json.dumps(trace) + '\n')
+
+
+class TraceBuilder:
+    """Builds the segment documents of a single synthetic trace."""
+
+    def __init__(self, generator, trace_id, rng) -> None:
+        self.generator = generator
+        self.trace_id = trace_id
+        self.rng = rng
+        self.segments = []
+        self.num_functions = 0
+
+    def new_id(self) -> str:
+        return f"{self.rng.getrandbits(64):016x}"
+
+    def uniform(self, low, high) -> float:
+        return self.rng.uniform(low, high)
+
+    def add_segment(self, doc) -> dict:
+        doc['trace_id'] = self.trace_id
+        self.segments.append(doc)
+        return doc
+
+    def build(self, start) -> dict:
+        # API Gateway synchronously invoking the first function
+        stage = self.add_segment({
+            'id': self.new_id(),
+            'name': 'synthetic-app/dev',
+            'start_time': ms(start),
+            'origin': 'AWS::ApiGateway::Stage',
+            'resource_arn': 'arn:aws:apigateway:us-east-1::/restapis/synthetic/stages/dev',
+            'http': {'request': {'url': SYNTHETIC_URL, 'method': 'POST'},
+                     'response': {'status': 200}}
+        })
+        client = {'id': self.new_id(), 'name': 'Lambda', 'namespace': 'aws',
+                  'start_time': ms(start + self.uniform(0.002, 0.008)),
+                  'aws': {'operation': 'Invoke'}}
+        lambda_end = self.invoke_function(client['id'], client['start_time'], 1, is_async=False)
+        client['end_time'] = ms(lambda_end + 0.001)
+        stage['end_time'] = ms(lambda_end + 0.002)
+        stage['subsegments'] = [client]
+        # Trace duration between earliest start and latest end alike XRay
+        starts = [doc['start_time'] for doc in self.segments]
+        ends = [max([doc['end_time']] + [s['end_time'] for s in doc.get('subsegments', [])])
+                for doc in self.segments]
+        # Segments appear in arbitrary order in BatchGetTraces
+        self.rng.shuffle(self.segments)
+        return {
+            'Id': self.trace_id,
+            'Duration': ms(max(ends) - min(starts)),
+            'LimitExceeded': False,
+            'Segments': [{'Id': doc['id'], 'Document': json.dumps(doc, separators=(',', ':'))}
+                         for doc in self.segments]
+        }
+
+    def invoke_function(self, parent_id, start, level, is_async) -> float:
+        """Adds the AWS::Lambda and AWS::Lambda::Function segments of an invocation
+        and recursively the functions it triggers. Returns the end time of the invocation."""
+        self.num_functions += 1
+        name = f"synthetic-function-{self.num_functions}"
+        arn = f"arn:aws:lambda:us-east-1:123456789012:function:{name}"
+        service = self.add_segment({
+            'id': self.new_id(),
+            'name': name,
+            'start_time': ms(start),
+            'parent_id': parent_id,
+            'origin': 'AWS::Lambda',
+            'resource_arn': arn,
+            'aws': {'request_id': self.new_id()}
+        })
+        if is_async:
+            # Event invocations are queued before the actual attempt
+            dwell = self.uniform(0.02, 0.1)
+            attempt = {'id': self.new_id(), 'name': 'Attempt #1', 'start_time': ms(start + dwell)}
+            service['subsegments'] = [
+                {'id': self.new_id(), 'name': 'Dwell Time', 'start_time': ms(start),
+                 'end_time': ms(start + dwell)},
+                attempt
+            ]
+            function_parent = attempt['id']
+            t = start + dwell + self.uniform(0.002, 0.01)
+        else:
+            function_parent = service['id']
+            t = start + self.uniform(0.002, 0.01)
+        function = {
+            'id': self.new_id(),
+            'name': name,
+            'parent_id': function_parent,
+            'origin': 'AWS::Lambda::Function',
+            'aws': {'account_id': '123456789012', 'function_arn': arn, 'resource_names': [name]}
+        }
+        subsegments = []
+        if self.rng.random() < self.generator.cold_start_ratio:
+            init_end = t + self.uniform(0.15, 0.6)
+            subsegments.append({'id': self.new_id(), 'name': 'Initialization',
+                                'start_time': us(t), 'end_time': us(init_end),
+                                'aws': {'function_arn': arn}})
+            t = init_end + self.uniform(0.0005, 0.002)
+        function['start_time'] = us(t)
+        invocation = {'id': self.new_id(), 'name': 'Invocation', 'start_time': us(t + 0.00005),
+                      'aws': {'function_arn': arn}}
+        t += self.uniform(0.001, 0.02)
+        operations = []
+        for i in range(self.generator.fan_out):
+            trigger = self.generator.triggers[i % len(self.generator.triggers)]
+            operation, t = self.call_service(trigger, t, level, i)
+            operations.append(operation)
+            t += self.uniform(0.0005, 0.005)
+        invocation['end_time'] = us(t)
+        invocation['subsegments'] = operations
+        subsegments.append(invocation)
+        overhead_end = t + self.uniform(0.0001, 0.0005)
+        subsegments.append({'id': self.new_id(), 'name': 'Overhead', 'start_time': us(t + 0.00003),
+                            'end_time': us(overhead_end), 'aws': {'function_arn': arn}})
+        function['end_time'] = us(overhead_end + 0.00002)
+        function['subsegments'] = subsegments
+        self.add_segment(function)
+        if is_async:
+            attempt['end_time'] = ms(function['end_time'] + 0.001)
+            # The AWS::Lambda segment of event invocations ends during the dwell time
+            service['end_time'] = ms(start + 0.6 * dwell)
+            return attempt['end_time']
+        service['end_time'] = ms(function['end_time'] + 0.0005)
+        return service['end_time']
+
+    def call_service(self, trigger, start, level, i):
+        """Returns an operation subsegment calling a downstream service and its end time.
+        Adds the inferred service segment and triggers the next function below depth."""
+        config = TRIGGER_SERVICES[trigger]
+        client_start = start + self.uniform(0.0002, 0.002)
+        client_end = client_start + self.uniform(0.01, 0.08)
+        client = {'id': self.new_id(), 'name': config['client'], 'namespace': 'aws',
+                  'start_time': us(client_start), 'end_time': us(client_end),
+                  'aws': {'operation': config['operation'], 'region': 'us-east-1'}}
+        inferred = self.add_segment({
+            'id': self.new_id(),
+            'name': config['client'],
+            'start_time': client['start_time'],
+            'end_time': client['end_time'],
+            'parent_id': client['id'],
+            'inferred': True,
+            'origin': config['origin'],
+            'aws': client['aws']
+        })
+        if level < self.generator.depth:
+            parent_id = client['id'] if config['parent'] == 'client' else inferred['id']
+            delay = self.uniform(*config['delay'])
+            self.invoke_function(parent_id, client_end + delay, level + 1, is_async=True)
+        end = client_end + self.uniform(0.0001, 0.001)
+        operation = {'id': self.new_id(), 'name': f"{config['client']} Operation {i + 1}",
+                     'start_time': us(start), 'end_time': us(end), 'subsegments': [client]}
+        return operation, end
+
+
+class SyntheticXRayClient:
+    """Minimal offline stand-in for the boto3 XRay client used by AwsTraceDownloader
+    (get_paginator for get_trace_summaries and batch_get_traces) serving num_traces
+    synthetic traces. Traces are generated on demand from their trace ids."""
+
+    def __init__(self, generator, num_traces, page_size=100) -> None:
+        self.generator = generator
+        self.num_traces = num_traces
+        self.page_size = page_size
+
+    def get_paginator(self, operation):
+        if operation == 'get_trace_summaries':
+            return SyntheticPaginator(self.trace_summaries)
+        if operation == 'batch_get_traces':
+            return SyntheticPaginator(self.batch_get_traces)
+        raise Exception(f"Unsupported XRay operation {operation}.")
+
+    def trace_summaries(self, StartTime=None, EndTime=None, **kwargs):
+        """Yields pages of the traces starting within the optional (inclusive) time window
+        given as datetimes. Every page but the last has a NextToken alike XRay."""
+        indices = [index for index in range(self.num_traces)
+                   if self.in_window(self.trace_start(index), StartTime, EndTime)]
+        for page_start in range(0, len(indices), self.page_size):
+            page_indices = indices[page_start:page_start + self.page_size]
+            page = {'TraceSummaries': [{'Id': self.generator.trace_id(index)}
+                                       for index in page_indices]}
+            if page_start + self.page_size < len(indices):
+                page['NextToken'] = str(page_start + self.page_size)
+            yield page
+
+    def trace_start(self, index) -> float:
+        return self.generator.start_time + index * self.generator.interval
+
+    @staticmethod
+    def in_window(epoch, start, end) -> bool:
+        return (start is None or start.timestamp() <= epoch) and \
+            (end is None or epoch <= end.timestamp())
+
+    def batch_get_traces(self, TraceIds, **kwargs):
+        if len(TraceIds) > 5:
+            raise Exception('BatchGetTraces supports at most 5 trace ids per request.')
+        traces = []
+        unprocessed = []
+        for trace_id in TraceIds:
+            index = self.generator.trace_index(trace_id)
+            if trace_id == self.generator.trace_id(index) and index < self.num_traces:
+                traces.append(self.generator.trace(index))
+            else:
+                unprocessed.append(trace_id)
+        yield {'Traces': traces, 'UnprocessedTraceIds': unprocessed}
+
+
+class SyntheticPaginator:
+    def __init__(self, pages) -> None:
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
@@ -0,0 +1,76 @@
+import datetime
+from functools import lru_cache
+
+
+"""
+Timestamps of Azure Application Insights records are UTC ISO-8601 strings
+with or without fractional seconds (e.g., 2022-01-06T09:00:01.929Z or 2022-01-06T09:00:01Z).
+The trace analysis represents them as integer microseconds since epoch and only formats
+them when writing results.
+"""
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+ISO_FORMAT_NO_FRACTION = '%Y-%m-%dT%H:%M:%SZ'
+OUTPUT_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_US = datetime.timedelta(microseconds=1)
+US_PER_SECOND = 1000000
+US_PER_DAY = 86400 * US_PER_SECOND
+
+"""Length of a timestamp without fractional seconds (i.e., YYYY-MM-DDTHH:MM:SSZ)."""
+NO_FRACTION_LENGTH = 20
+
+
+@lru_cache(maxsize=1024)
+def date_us(date) -> int:
+    """Returns the µs since epoch of a YYYY-MM-DD date. Traces of a run span few dates."""
+    return (datetime.datetime.strptime(date, '%Y-%m-%d') - EPOCH) // ONE_US
+
+
+@lru_cache(maxsize=1024)
+def format_date(days) -> str:
+    return (EPOCH + datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def strptime_us(t) -> int:
+    """Parses a timestamp via strptime like the former implementation.
+    Raises a ValueError for invalid timestamps."""
+    try:
+        result = datetime.datetime.strptime(t, ISO_FORMAT)
+    except ValueError:
+        result = datetime.datetime.strptime(t, ISO_FORMAT_NO_FRACTION)
+    return (result - EPOCH) // ONE_US
+
+
+def parse_us(t) -> int:
+    """Returns the µs since epoch of an Application Insights timestamp.
+    Well-formed timestamps are sliced at fixed positions without exceptions
+    (1-6 fractional digits like %f); anything else falls back to strptime_us."""
+    if len(t) < NO_FRACTION_LENGTH or t[-1] != 'Z' or t[10] != 'T' or t[4] != '-' or \
+            t[7] != '-' or t[13] != ':' or t[16] != ':':
+        return strptime_us(t)
+    fraction = '0' if len(t) == NO_FRACTION_LENGTH else t[20:-1]
+    if (len(t) > NO_FRACTION_LENGTH and t[19] != '.') or not 1 <= len(fraction) <= 6:
+        return strptime_us(t)
+    digits = t[11:13] + t[14:16] + t[17:19] + fraction
+    if not (digits.isascii() and digits.isdigit()):
+        return strptime_us(t)
+    hours, minutes, seconds = int(t[11:13]), int(t[14:16]), int(t[17:19])
+    if hours > 23 or minutes > 59 or seconds > 59:
+        return strptime_us(t)
+    return date_us(t[:10]) + (hours * 3600 + minutes * 60 + seconds) * US_PER_SECOND + \
+        int(fraction.ljust(6, '0'))
+
+
+def duration_us(ms) -> int:
+    """Returns a duration in (float) ms as µs rounded like datetime.timedelta."""
+    return datetime.timedelta(milliseconds=ms) // ONE_US
+
+
+def format_us(us) -> str:
+    """Formats µs since epoch as YYYY-MM-DD HH:MM:SS.ffffff (see OUTPUT_FORMAT)."""
+    days, us = divmod(us, US_PER_DAY)
+    seconds, fraction = divmod(us, US_PER_SECOND)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{format_date(days)} {hours:02d}:{minutes:02d}:{seconds:02d}.{fraction:06d}"
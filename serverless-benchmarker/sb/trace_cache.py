@@ -0,0 +1,62 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from sb.trace_storage import open_traces
+
+
+"""Trace cache shared across the runs of a benchmark next to its .sb/config.yml.
+Relative to the benchmark directory (i.e., the working directory of sb get_traces)."""
+DEFAULT_CACHE_DIR = Path('.sb/trace_cache')
+
+"""Trace ids are used as file names and must not contain path separators or dots."""
+TRACE_ID_PATTERN = re.compile(r'[0-9A-Za-z_-]+')
+
+
+class TraceCache:
+    """On-disk store of downloaded traces keyed by trace id such that re-downloads only
+    retrieve missing traces. Every trace is saved as its traces.json line in a file named
+    after its trace id within one of 256 sub-directories (i.e., the last two hex digits).
+    Files are replaced atomically such that concurrent writers never expose partial traces.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR) -> None:
+        self.directory = Path(directory)
+
+    def path(self, trace_id) -> Path:
+        if not TRACE_ID_PATTERN.fullmatch(trace_id):
+            raise Exception(f"Invalid trace id {trace_id!r} for the trace cache.")
+        return self.directory / trace_id[-2:] / f"{trace_id}.json"
+
+    def __contains__(self, trace_id) -> bool:
+        return self.path(trace_id).is_file()
+
+    def get(self, trace_id):
+        """Returns the traces.json line (without newline) of a trace or None if not cached."""
+        try:
+            with open(self.path(trace_id)) as trace_file:
+                return trace_file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, trace_id, line) -> None:
+        """Saves the traces.json line (without newline) of a trace."""
+        path = self.path(trace_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w') as trace_file:
+            trace_file.write(line)
+        os.replace(tmp_path, path)
+
+    def add_traces_file(self, traces_file) -> int:
+        """Caches all traces of an existing (compressed) traces.json and returns their number."""
+        num_traces = 0
+        with open_traces(traces_file) as traces_json:
+            for line in traces_json:
+                line = line.rstrip('\n')
+                if not line.strip():
+                    continue
+                self.put(json.loads(line)['Id'], line)
+                num_traces += 1
+        return num_traces
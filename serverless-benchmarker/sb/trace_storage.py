@@ -0,0 +1,94 @@
+import gzip
+import io
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+"""Compressed storage of traces.json files detected by their file extension.
+Traces are stored line by line (i.e., one JSON-formatted trace per line) in a single
+compressed stream such that downloaders and analyzers stream them without decompressing
+to disk first. Repeated (double-encoded) JSON of traces typically compresses by 10x or more.
+* gzip: traces.json.gz using the standard library
+* zstd: traces.json.zst (faster, requires zstandard, e.g., pip install -e .[zstd])
+"""
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+TRACES_FILE = 'traces.json'
+TRACES_FILE_NAMES = [TRACES_FILE] + [TRACES_FILE + extension for extension in COMPRESSIONS.values()]
+
+"""Trades compression ratio for speed because traces are compressed while downloading."""
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def validate_compression(compression) -> None:
+    if compression is not None and compression not in COMPRESSIONS:
+        raise Exception(f"Unsupported compression {compression}. Use one of {list(COMPRESSIONS)}.")
+    if compression == 'zstd' and zstandard is None:
+        raise Exception('Zstandard compression requires zstandard (pip install zstandard).')
+
+
+def traces_file_name(compression=None) -> str:
+    """Returns the traces.json file name with the extension of the compression (None for plain)."""
+    return TRACES_FILE + COMPRESSIONS.get(compression, '')
+
+
+def compression_of(path):
+    """Returns the compression of a file by its extension or None for uncompressed files."""
+    suffix = Path(path).suffix
+    for compression, extension in COMPRESSIONS.items():
+        if suffix == extension:
+            return compression
+    return None
+
+
+def is_compressed(path) -> bool:
+    return compression_of(path) is not None
+
+
+def find_traces_file(directory) -> Path:
+    """Returns the existing (possibly compressed) traces.json file within a directory.
+    Defaults to the plain traces.json if none exists (e.g., before downloading)."""
+    directory = Path(directory)
+    for name in TRACES_FILE_NAMES:
+        path = directory / name
+        if path.is_file():
+            return path
+    return directory / TRACES_FILE
+
+
+def traces_file_of(log_path) -> Path:
+    """Returns the traces file of a log path, which is either a (compressed) traces file
+    or another file within the directory of the traces (e.g., trace_breakdown.csv)."""
+    log_path = Path(log_path)
+    if log_path.name in TRACES_FILE_NAMES:
+        return log_path
+    return find_traces_file(log_path.parent)
+
+
+def open_traces(path, mode='r'):
+    """Opens a plain or compressed traces file like open(path, mode) detected by its extension.
+    Supports text and binary reading ('r', 'rb'), writing ('w', 'wb'), and appending
+    ('a', 'ab'), which adds a new compressed frame (i.e., gzip member) to compressed files.
+    Binary reads return the uncompressed bytes line by line. Seeking is emulated by
+    decompressing for gzip and unsupported for zstd."""
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, mode)
+    validate_compression(compression)
+    if 'b' not in mode and 't' not in mode:
+        mode += 't'
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    if 'r' in mode:
+        if 'b' in mode:
+            # The raw decompression reader cannot be iterated line by line
+            return io.BufferedReader(zstandard.open(path, mode))
+        return zstandard.open(path, mode)
+    return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL))
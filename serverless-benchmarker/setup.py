@@ -30,6 +30,18 @@ setup(
         'dev': [
             'pytest>=6.1.1,<7',
             'flake8>=3.8.4,<4'
+        ],
+        # Faster JSON decoding for trace analysis
+        'fast': [
+            'orjson>=3.6.0,<4'
+        ],
+        # Parquet output of trace analysis
+        'parquet': [
+            'pyarrow>=7.0.0'
+        ],
+        # Zstandard compression of traces.json.zst
+        'zstd': [
+            'zstandard>=0.15.0'
         ]
     },
     entry_points='''
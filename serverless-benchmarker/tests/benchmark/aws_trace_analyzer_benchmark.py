@@ -0,0 +1,185 @@
+"""Throughput benchmark of the AWS trace analyzer.
+
+Replicates the traces of the aws_trace_analyzer test fixtures (or generates synthetic traces
+with --synthetic) into a traces.json with the requested number of traces and
+measures for each scale:
+* phases: cumulative time and traces/sec of JSON decoding, create_span_graph,
+  calculate_breakdown, and extract_trace_breakdown
+* analyze_traces: end-to-end AwsTraceAnalyzer throughput including writing trace_breakdown.csv
+* peak_rss_mb: peak resident memory of the process benchmarking this scale
+
+Usage (from serverless-benchmarker):
+  python tests/benchmark/aws_trace_analyzer_benchmark.py run --scales=10000,100000
+  python tests/benchmark/aws_trace_analyzer_benchmark.py run --synthetic --depth=3 --fan_out=2
+  python tests/benchmark/aws_trace_analyzer_benchmark.py compare benchmark.json baseline.json
+"""
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import fire
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+from sb import json_backend  # noqa: E402
+from sb.aws_trace_analyzer import AwsTraceAnalyzer, create_span_graph, calculate_breakdown, \
+    extract_trace_breakdown  # noqa: E402
+from sb.synthetic_traces import SyntheticTraceGenerator  # noqa: E402
+
+
+FIXTURES_DIR = Path(__file__).parent.parent / 'fixtures/aws_trace_analyzer'
+
+DEFAULT_SCALES = [10000]
+
+"""Phases whose throughput is compared against a baseline."""
+PHASES = ['decode', 'create_span_graph', 'calculate_breakdown', 'extract_trace_breakdown',
+          'analyze_traces']
+
+"""Placeholder for the trace id of replicated traces."""
+ID_PLACEHOLDER = '__SB_TRACE_ID__'
+
+
+def load_fixture_traces(apps=None) -> list:
+    """Returns the traces of the given fixture apps (defaults to all).
+    Fixtures contain either one trace per line or a single pretty-printed trace."""
+    if apps is None:
+        apps = sorted(path.name for path in FIXTURES_DIR.iterdir()
+                      if (path / 'traces.json').is_file())
+    traces = []
+    for app in apps:
+        with open(FIXTURES_DIR / app / 'traces.json') as traces_json:
+            content = traces_json.read()
+        try:
+            traces.append(json.loads(content))
+        except json.JSONDecodeError:
+            traces.extend(json.loads(line) for line in content.splitlines() if line.strip())
+    return traces
+
+
+def write_replicated_traces(path, traces, num_traces) -> None:
+    """Writes num_traces lines into traces.json by cycling through the given traces.
+    Every replica gets a unique trace id."""
+    templates = [json.dumps({**trace, 'Id': ID_PLACEHOLDER}) for trace in traces]
+    with open(path, 'w') as traces_json:
+        for i in range(num_traces):
+            trace_id = f"1-{i // 16 ** 8:08x}-{i:024x}"
+            traces_json.write(templates[i % len(templates)].replace(ID_PLACEHOLDER, trace_id))
+            traces_json.write('\n')
+
+
+def rate(num_traces, seconds) -> dict:
+    return {'seconds': round(seconds, 4),
+            'traces_per_second': round(num_traces / seconds, 1) if seconds > 0 else None}
+
+
+def benchmark_phases(traces_file) -> dict:
+    """Streams traces.json and times every phase per trace.
+    Invalid traces (i.e., create_span_graph fails) are counted but skip later phases."""
+    elapsed = {phase: 0.0 for phase in PHASES[:-1]}
+    counts = {phase: 0 for phase in PHASES[:-1]}
+    num_invalid = 0
+    with open(traces_file, 'rb') as traces_json:
+        for line in traces_json:
+            start = time.perf_counter()
+            trace = json_backend.loads(line)
+            elapsed['decode'] += time.perf_counter() - start
+            counts['decode'] += 1
+            start = time.perf_counter()
+            try:
+                G = create_span_graph(trace)
+            except Exception:
+                num_invalid += 1
+                continue
+            elapsed['create_span_graph'] += time.perf_counter() - start
+            counts['create_span_graph'] += 1
+            start = time.perf_counter()
+            calculate_breakdown(G)
+            elapsed['calculate_breakdown'] += time.perf_counter() - start
+            counts['calculate_breakdown'] += 1
+            start = time.perf_counter()
+            extract_trace_breakdown(trace)
+            elapsed['extract_trace_breakdown'] += time.perf_counter() - start
+            counts['extract_trace_breakdown'] += 1
+    results = {phase: {'traces': counts[phase], **rate(counts[phase], elapsed[phase])}
+               for phase in elapsed}
+    results['invalid_traces'] = num_invalid
+    return results
+
+
+def benchmark_scale(num_traces, apps=None, workers=1, synthetic=None) -> dict:
+    """Benchmarks a single scale. Runs in a fresh process to measure its peak memory.
+    synthetic are optional SyntheticTraceGenerator arguments replacing the fixture traces."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        traces_file = Path(tmp_dir) / 'traces.json'
+        result = {'traces': num_traces}
+        if synthetic is not None:
+            SyntheticTraceGenerator(**synthetic).write_traces(traces_file, num_traces)
+            result['synthetic'] = synthetic
+        else:
+            traces = load_fixture_traces(apps)
+            write_replicated_traces(traces_file, traces, num_traces)
+            result['fixture_traces'] = len(traces)
+        result['traces_json_mb'] = round(traces_file.stat().st_size / 2 ** 20, 1)
+        result['phases'] = benchmark_phases(traces_file)
+        start = time.perf_counter()
+        AwsTraceAnalyzer(traces_file, workers=workers).analyze_traces()
+        result['phases']['analyze_traces'] = {'traces': num_traces,
+                                              'workers': workers,
+                                              **rate(num_traces, time.perf_counter() - start)}
+    # ru_maxrss is in KiB on Linux. Worker processes are not included.
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+def run(scales=DEFAULT_SCALES, apps=None, workers=1, output='benchmark.json',
+        synthetic=False, depth=2, fan_out=1, cold_start_ratio=0.1) -> None:
+    """Benchmarks the analyzer for every scale (number of traces) and
+    saves the results into the output JSON file.
+    Synthetic traces are configured by depth, fan_out, and cold_start_ratio."""
+    if isinstance(scales, int):
+        scales = [scales]
+    synthetic_args = None
+    if synthetic:
+        synthetic_args = {'depth': depth, 'fan_out': fan_out,
+                          'cold_start_ratio': cold_start_ratio}
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'json_backend': json_backend.backend,
+        'scales': []
+    }
+    for num_traces in scales:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(benchmark_scale, num_traces, apps, workers,
+                                     synthetic_args).result()
+        report['scales'].append(result)
+        phases = result['phases']
+        rates = ', '.join(f"{phase} {phases[phase]['traces_per_second']}/s" for phase in PHASES)
+        print(f"{num_traces} traces: {rates}, peak RSS {result['peak_rss_mb']} MB")
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+
+def compare(results, baseline, tolerance=0.2) -> None:
+    """Raises an exception if the throughput of any phase in results is more than
+    tolerance (e.g., 20%) below the baseline at the same scale."""
+    with open(results) as results_file, open(baseline) as baseline_file:
+        current = {r['traces']: r['phases'] for r in json.load(results_file)['scales']}
+        previous = {r['traces']: r['phases'] for r in json.load(baseline_file)['scales']}
+    regressions = []
+    for num_traces in sorted(current.keys() & previous.keys()):
+        for phase in PHASES:
+            new = current[num_traces][phase]['traces_per_second']
+            old = previous[num_traces][phase]['traces_per_second']
+            if new is not None and old is not None and new < old * (1 - tolerance):
+                regressions.append(f"{phase} at {num_traces} traces: {new}/s < {old}/s")
+    if regressions:
+        raise Exception(f"Throughput regressions: {'; '.join(regressions)}")
+    print('No throughput regressions.')
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run, 'compare': compare})
@@ -0,0 +1,78 @@
+import io
+import json
+from pathlib import Path
+
+from sb.analysis_checkpoint import AnalysisCheckpoint, read_line_chunks
+from sb.aws_trace_analyzer import AwsTraceAnalyzer
+
+
+def thumbnail_benchmark_lines():
+    tests_path = Path(__file__).parent.parent
+    traces_path = tests_path / 'fixtures/aws_trace_analyzer/thumbnail_benchmark/traces.json'
+    with open(traces_path, 'rb') as traces_json:
+        return traces_json.readlines()
+
+
+def analyze(log_dir, lines, **kwargs):
+    """Writes the given lines into log_dir/traces.json, analyzes them,
+    and returns the lines of the resulting trace_breakdown.csv."""
+    log_dir.mkdir(exist_ok=True)
+    log_path = log_dir / 'traces.json'
+    with open(log_path, 'wb') as traces_json:
+        traces_json.writelines(lines)
+    AwsTraceAnalyzer(log_path, chunk_size=2, **kwargs).analyze_traces()
+    with open(log_dir / 'trace_breakdown.csv') as breakdown_file:
+        return breakdown_file.read().splitlines()
+
+
+def test_read_line_chunks():
+    file = io.BytesIO(b'a\nbb\nccc\ndddd')
+    assert list(read_line_chunks(file, 2)) == [([b'a\n', b'bb\n'], 5), ([b'ccc\n', b'dddd'], 13)]
+    assert list(read_line_chunks(file, 2, offset=5, complete_lines=True)) == [([b'ccc\n'], 9)]
+
+
+def test_incremental_appends_new_traces(tmp_path):
+    lines = thumbnail_benchmark_lines()
+    expected = analyze(tmp_path / 'full', lines)
+    analyze(tmp_path / 'incremental', lines[:3], incremental=True)
+    assert analyze(tmp_path / 'incremental', lines, incremental=True) == expected
+    # Nothing new to analyze
+    assert analyze(tmp_path / 'incremental', lines, incremental=True) == expected
+
+
+def test_incremental_resumes_after_interruption(tmp_path):
+    lines = thumbnail_benchmark_lines()
+    expected = analyze(tmp_path / 'full', lines)
+    analyze(tmp_path / 'interrupted', lines[:4], incremental=True)
+    # Results written after the last checkpoint are discarded
+    with open(tmp_path / 'interrupted' / 'trace_breakdown.csv', 'a') as breakdown_file:
+        breakdown_file.write('1-partial,2022-01-06')
+    assert analyze(tmp_path / 'interrupted', lines, incremental=True) == expected
+
+
+def test_full_analysis_without_checkpoint(tmp_path):
+    lines = thumbnail_benchmark_lines()
+    analyze(tmp_path, lines[:4], incremental=True)
+    assert (tmp_path / 'trace_breakdown.checkpoint.json').exists()
+    analyze(tmp_path, lines)
+    assert not (tmp_path / 'trace_breakdown.checkpoint.json').exists()
+
+
+def test_incremental_skips_incomplete_last_line(tmp_path):
+    lines = thumbnail_benchmark_lines()
+    incomplete_line = lines[4][:100]
+    result = analyze(tmp_path, lines[:4] + [incomplete_line], incremental=True)
+    assert len(result) == 1 + 4
+    checkpoint = AnalysisCheckpoint(tmp_path / 'traces.json',
+                                    tmp_path / 'trace_breakdown.csv', result[0].split(','))
+    assert checkpoint.resume()
+    assert checkpoint.offset == sum(map(len, lines[:4]))
+
+
+def test_incremental_restarts_for_new_traces_file(tmp_path):
+    lines = thumbnail_benchmark_lines()
+    analyze(tmp_path, lines[:4], incremental=True)
+    # A new download rewrites traces.json with different traces
+    result = analyze(tmp_path, lines[3:], incremental=True)
+    trace_ids = [json.loads(line)['Id'] for line in lines[3:]]
+    assert [row.split(',')[0] for row in result[1:]] == trace_ids
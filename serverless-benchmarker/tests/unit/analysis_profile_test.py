@@ -0,0 +1,68 @@
+import json
+import shutil
+from pathlib import Path
+
+from sb import analysis_profile
+from sb.analysis_profile import AnalysisProfile, Phase, profiled, use_profile
+from sb.aws_trace_analyzer import AwsTraceAnalyzer
+
+
+@profiled
+def square(x):
+    return x * x
+
+
+def test_phases_only_measure_active_profile():
+    profile = AnalysisProfile()
+    assert square(3) == 9
+    with Phase('disabled'):
+        pass
+    previous = use_profile(profile)
+    try:
+        square(2)
+        square(3)
+        with Phase('block'):
+            pass
+    finally:
+        use_profile(previous)
+    assert analysis_profile.active is previous
+    assert profile.phases['square'][0] == 2
+    assert profile.phases['block'][0] == 1
+    assert 'disabled' not in profile.phases
+
+
+def test_merge_keeps_slowest_traces():
+    profiles = [AnalysisProfile(num_outliers=3), AnalysisProfile(num_outliers=3)]
+    for i in range(10):
+        profiles[i % 2].add_trace(f"trace-{i}", i / 10)
+        profiles[i % 2].add('decode', 0.5, 0.25)
+    merged = AnalysisProfile(num_outliers=3)
+    for profile in profiles:
+        merged.merge(profile)
+    report = merged.report()
+    assert [t['trace_id'] for t in report['slowest_traces']] == ['trace-9', 'trace-8', 'trace-7']
+    assert report['phases']['decode'] == {'calls': 10, 'wall_seconds': 5.0,
+                                          'cpu_seconds': 2.5, 'wall_us_per_call': 500000.0}
+
+
+def test_analyze_traces_profile(tmp_path):
+    tests_path = Path(__file__).parent.parent
+    traces_path = tests_path / 'fixtures/aws_trace_analyzer/thumbnail_benchmark/traces.json'
+    log_path = tmp_path / 'traces.json'
+    shutil.copy(traces_path, log_path)
+    AwsTraceAnalyzer(log_path, workers=2, chunk_size=3, sketches=True,
+                     profile=True).analyze_traces()
+    with open(tmp_path / 'trace_breakdown.profile.json') as profile_file:
+        report = json.load(profile_file)
+    with open(traces_path) as traces_json:
+        trace_ids = [json.loads(line)['Id'] for line in traces_json]
+    phases = report['phases']
+    for phase in ['decode', 'extract_timestamps', 'create_span_graph', 'add_global_stats',
+                  'longest_path', 'calculate_breakdown']:
+        assert phases[phase]['calls'] == len(trace_ids)
+    assert phases['write_csv']['calls'] == 3
+    assert phases['analyze_traces']['calls'] == 1
+    slowest = report['slowest_traces']
+    assert sorted(t['trace_id'] for t in slowest) == sorted(trace_ids)
+    assert slowest[0]['seconds'] >= slowest[-1]['seconds']
+    assert analysis_profile.active is None
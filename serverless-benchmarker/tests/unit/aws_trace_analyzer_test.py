@@ -1,16 +1,32 @@
 import json
 import csv
+import gzip
 import sys
+import shutil
 from pathlib import Path
 import datetime
 import pytest
 import networkx as nx
+from sb import aws_trace_analyzer
+from sb.latency_sketch import LatencySketches
+from sb.breakdown_writer import local_timezone
 
-from sb.aws_trace_analyzer import CSV_FIELDS, extract_trace_breakdown, longest_path, create_span_graph, duration, get_sorted_children, is_async_call, call_stack  # noqa: E501
+from sb.aws_trace_analyzer import CSV_FIELDS, BREAKDOWN_FIELDS, AwsTraceAnalyzer, SpanTree, extract_trace_breakdown, longest_path, create_span_graph, get_sorted_children, is_async_call, call_stack, epoch_us, timediff_us, compile_timestamp_rules  # noqa: E501
+
+
+def span_tree(segments, edges):
+    """Returns a SpanTree for a list of (id, start_time, end_time) segments
+    and a list of (parent_id, child_id) edges."""
+    G = SpanTree()
+    for (id, start_time, end_time) in segments:
+        G.add_span({'id': id, 'start_time': start_time, 'end_time': end_time})
+    for (parent_id, child_id) in edges:
+        G.add_edge(G.index[parent_id], G.index[child_id])
+    G.sort_children()
+    return G
 
 
 def test_get_sorted_children():
-    G = nx.DiGraph()
     # Example inspired from the matrix multiplication app
     # where two spans (sub1, sub2) have the same end_time (end) but
     # sub1 just starts 1ms earlier (start1). Timeline: start1<end1=start2=end2
@@ -20,17 +36,24 @@ def test_get_sorted_children():
     root_id = 'root_id'
     sub1_id = 'sub1'
     sub2_id = 'sub2'
-    G.add_node(root_id)
-    # Adding sub2 first
-    G.add_node('sub2', **{'doc': {'start_time': start2, 'end_time': end}})
-    G.add_edge(root_id, sub2_id)
-    # Adding sub1 second
-    G.add_node('sub1', **{'doc': {'start_time': start1, 'end_time': end}})
-    G.add_edge(root_id, sub1_id)
-    succ_ids = list(G.successors(root_id))
-    # Should have wrong order by default
-    assert succ_ids == [sub2_id, sub1_id]
-    assert get_sorted_children(G, root_id) == ['sub1', 'sub2']
+    # Adding sub2 first and sub1 second
+    segments = [
+        (root_id, start1, end),
+        (sub2_id, start2, end),
+        (sub1_id, start1, end)
+    ]
+    G = span_tree(segments, [(root_id, sub2_id), (root_id, sub1_id)])
+    root = G.index[root_id]
+    sorted_ids = [G.ids[child] for child in get_sorted_children(G, root)]
+    assert sorted_ids == ['sub1', 'sub2']
+
+
+def test_epoch_us():
+    """Integer microseconds round like datetime.fromtimestamp for ms- and µs-based timestamps"""
+    assert epoch_us(1624353531.865) == 1624353531865000
+    assert epoch_us(1624353531.8654525) == 1624353531865453
+    assert epoch_us(1.6414621187861485E9) == 1641462118786149
+    assert timediff_us(1624353531.865, 1624353531.8654525) == 453
 
 
 def test_is_async_call_async():
@@ -242,19 +265,13 @@ def test_longest_path_sync():
         ('s3', s3_start, s3_end)
     ]
 
-    G = nx.DiGraph()
+    G = span_tree(segments, [('s1', 's2'), ('s2', 'a'), ('s1', 's3')])
     G.graph['start'] = 's1'
     G.graph['end'] = 's1'
-    for (id, start_time, end_time) in segments:
-        s1 = {'id': id, 'start_time': start_time, 'end_time': end_time}
-        node_attr = {'doc': s1, 'duration': duration(s1)}
-        G.add_node(s1['id'], **node_attr)
-    G.add_edge('s1', 's2')
-    G.add_edge('s2', 'a')
-    G.add_edge('s1', 's3')
 
-    G.graph['call_stack'] = call_stack(G, 's1')
-    assert ['s1', 's2', 's3'] == longest_path(G, 's1')
+    G.graph['call_stack'] = call_stack(G, G.index['s1'])
+    path = longest_path(G, G.index['s1'])
+    assert ['s1', 's2', 's3'] == [G.ids[node] for node in path]
 
 
 def test_longest_path_async():
@@ -276,17 +293,11 @@ def test_longest_path_async():
         ('s3', s3_start, s3_end)
     ]
 
-    G = nx.DiGraph()
-    for (id, start_time, end_time) in segments:
-        s1 = {'id': id, 'start_time': start_time, 'end_time': end_time}
-        node_attr = {'doc': s1, 'duration': duration(s1)}
-        G.add_node(s1['id'], **node_attr)
-    G.add_edge('s1', 's2')
-    G.add_edge('s1', 's')
-    G.add_edge('s2', 's3')
+    G = span_tree(segments, [('s1', 's2'), ('s1', 's'), ('s2', 's3')])
 
-    G.graph['call_stack'] = call_stack(G, 's3')
-    assert ['s1', 's2', 's3'] == longest_path(G, 's1')
+    G.graph['call_stack'] = call_stack(G, G.index['s3'])
+    path = longest_path(G, G.index['s1'])
+    assert ['s1', 's2', 's3'] == [G.ids[node] for node in path]
 
 
 def test_longest_path_event_processing_app():
@@ -308,6 +319,42 @@ def test_longest_path_event_processing_app():
         assert G.graph['longest_path'] == expected_path
 
 
+def test_span_tree_to_networkx():
+    """The networkx export resembles the span graph for debugging."""
+    tp = traces_path('event_processing_app')
+    with open(tp) as json_file:
+        trace = json.load(json_file)
+        G = create_span_graph(trace)
+        nx_graph = G.to_networkx()
+        assert nx.is_tree(nx_graph)
+        assert nx_graph.number_of_nodes() == len(G)
+        assert nx_graph.graph['longest_path'] == G.graph['longest_path']
+        root_id = G.graph['start']
+        assert nx_graph.nodes[root_id]['invocation_type'] == 'client'
+        assert nx_graph.nodes[root_id]['doc']['id'] == root_id
+
+
+def test_index_spans_thumbnail_app():
+    """Cold start Initialization children and categories are precomputed per span."""
+    tp = traces_path('thumbnail_app')
+    with open(tp) as json_file:
+        trace = json.load(json_file)
+        G = create_span_graph(trace)
+        init_nodes = [n for n in range(len(G)) if G.name[n] == 'Initialization']
+        assert len(init_nodes) == 2
+        for init_node in init_nodes:
+            assert G.init_child[G.parent[init_node]] == init_node
+            assert G.category[init_node] == 'runtime_initialization'
+        functions = [n for n in range(len(G)) if G.origin[n] == 'AWS::Lambda::Function']
+        assert [G.category[n] for n in functions] == ['computation'] * len(functions)
+        # Subsegments without origin inherit the category of their parent
+        attempt = G.name.index('Attempt #1')
+        assert G.category[attempt] == G.category[G.parent[attempt]] == 'orchestration'
+        # Unknown Lambda function subsegments remain unclassified
+        s3_calls = [n for n in range(len(G)) if G.name[n] == 'S3' and G.origin[n] is None]
+        assert [G.category[n] for n in s3_calls] == ['unclassified'] * 4
+
+
 def test_extract_trace_event_processing_app():
     """Reproduces a trace with a validation error on the trace duration:
     "Trace duration 0:00:00.125000 does not match latency breakdown 0:00:00.047000
@@ -344,9 +391,187 @@ def test_extract_trace_image_processing_app_error():
     assert_trace_breakdown(tp, expected_breakdown)
 
 
+def analyze_thumbnail_benchmark(log_dir, **kwargs):
+    """Analyzes a copy of the thumbnail_benchmark traces in log_dir
+    and returns the lines of the resulting trace_breakdown.csv."""
+    log_dir.mkdir(exist_ok=True)
+    log_path = log_dir / 'traces.json'
+    shutil.copy(traces_path('thumbnail_benchmark'), log_path)
+    AwsTraceAnalyzer(log_path, **kwargs).analyze_traces()
+    with open(log_dir / 'trace_breakdown.csv') as breakdown_file:
+        return breakdown_file.read().splitlines()
+
+
+def test_analyze_traces_thumbnail_benchmark(tmp_path):
+    """Analyzes thumbnail benchmark traces (3 cold starts) from data/AWS/2022-01-06_10-38-44"""
+    lines = analyze_thumbnail_benchmark(tmp_path)
+    assert lines[0] == ','.join(BREAKDOWN_FIELDS)
+    with open(traces_path('thumbnail_benchmark')) as json_file:
+        trace_ids = [json.loads(line)['Id'] for line in json_file]
+    assert [line.split(',')[0] for line in lines[1:]] == trace_ids
+    cold_starts = [line.split(',')[-2:] for line in lines[1:]]
+    assert cold_starts.count(['1', '1']) == 2
+    assert cold_starts.count(['0', '1']) == 1
+
+
+def test_analyze_traces_parallel(tmp_path):
+    """Parallel analysis in small chunks preserves the sequential output order."""
+    sequential = analyze_thumbnail_benchmark(tmp_path / 'sequential')
+    parallel = analyze_thumbnail_benchmark(tmp_path / 'parallel', workers=2, chunk_size=2)
+    assert parallel == sequential
+
+
+def test_analyze_traces_custom_timestamp_rules(tmp_path):
+    """Custom timestamp rules (e.g., from BENCHMARK_CONFIG) define the output columns."""
+    timestamp_rules = {
+        'api_start': {'path': [{'origin': 'AWS::ApiGateway::Stage'}]},
+        'upload_end': {'path': [{'origin': 'AWS::Lambda', 'name': 'thumbnail-upload'}],
+                       'value': 'end_time'},
+        'upload_init': {'path': [{'name': 'thumbnail-upload'}, {'name': 'Initialization'}],
+                        'value': 'exists'},
+        'missing': {'path': [{'name': 'unknown'}]}
+    }
+    lines = analyze_thumbnail_benchmark(tmp_path, timestamp_rules=timestamp_rules)
+    default_lines = analyze_thumbnail_benchmark(tmp_path / 'default')
+    assert lines[0] == 'trace_id,api_start,upload_end,upload_init,missing'
+    for line, default_line in zip(lines[1:], default_lines[1:]):
+        trace_id, api_start, upload_end, upload_init, missing = line.split(',')
+        default_values = default_line.split(',')
+        assert api_start == default_values[1]
+        assert upload_end > default_values[2]
+        assert upload_init == default_values[-2]
+        assert missing == ''
+
+
+def test_analyze_traces_gzip(tmp_path):
+    """Gzip-compressed traces are streamed into the same breakdown as plain traces.json."""
+    lines = analyze_thumbnail_benchmark(tmp_path / 'plain')
+    log_dir = tmp_path / 'gzip'
+    log_dir.mkdir()
+    with open(traces_path('thumbnail_benchmark'), 'rb') as traces_json, \
+            gzip.open(log_dir / 'traces.json.gz', 'wb') as traces_gz:
+        shutil.copyfileobj(traces_json, traces_gz)
+    AwsTraceAnalyzer(log_dir / 'trace_breakdown.csv', workers=1, chunk_size=2).analyze_traces()
+    with open(log_dir / 'trace_breakdown.csv') as breakdown_file:
+        assert breakdown_file.read().splitlines() == lines
+    assert not (log_dir / 'trace_breakdown.checkpoint.json').exists()
+    with pytest.raises(Exception, match='Incremental analysis is not supported'):
+        AwsTraceAnalyzer(log_dir / 'traces.json.gz', incremental=True).analyze_traces()
+
+
+def test_analyze_traces_zstd(tmp_path):
+    """Zstandard-compressed traces are streamed into the same csv and parquet breakdowns."""
+    zstandard = pytest.importorskip('zstandard')
+    pq = pytest.importorskip('pyarrow.parquet')
+    lines = analyze_thumbnail_benchmark(tmp_path / 'plain')
+    AwsTraceAnalyzer(tmp_path / 'plain' / 'traces.json', output_format='parquet').analyze_traces()
+    log_dir = tmp_path / 'zstd'
+    log_dir.mkdir()
+    with open(traces_path('thumbnail_benchmark'), 'rb') as traces_json, \
+            zstandard.open(log_dir / 'traces.json.zst', 'wb') as traces_zst:
+        shutil.copyfileobj(traces_json, traces_zst)
+    AwsTraceAnalyzer(log_dir / 'traces.json.zst', workers=1, chunk_size=2).analyze_traces()
+    with open(log_dir / 'trace_breakdown.csv') as breakdown_file:
+        assert breakdown_file.read().splitlines() == lines
+    AwsTraceAnalyzer(log_dir / 'traces.json.zst', output_format='parquet').analyze_traces()
+    expected = pq.read_table(tmp_path / 'plain' / 'trace_breakdown.parquet')
+    assert pq.read_table(log_dir / 'trace_breakdown.parquet').equals(expected)
+
+
+def test_analyze_traces_parquet(tmp_path):
+    """Parquet output contains the same timestamps as native UTC timestamp columns."""
+    pq = pytest.importorskip('pyarrow.parquet')
+    csv_lines = analyze_thumbnail_benchmark(tmp_path)
+    AwsTraceAnalyzer(tmp_path / 'traces.json', output_format='parquet').analyze_traces()
+    table = pq.read_table(tmp_path / 'trace_breakdown.parquet')
+    assert table.column_names == BREAKDOWN_FIELDS
+    assert str(table.schema.field('t1').type) == 'timestamp[us, tz=UTC]'
+    # The csv contains local times and only flags are dictionary-encoded
+    assert table.schema.metadata[b'sb.csv_time'] == b'local'
+    assert table.schema.metadata[b'sb.csv_timezone'] == local_timezone().encode()
+    row_group = pq.ParquetFile(tmp_path / 'trace_breakdown.parquet').metadata.row_group(0)
+    assert 'RLE_DICTIONARY' not in row_group.column(0).encodings
+    assert 'RLE_DICTIONARY' in row_group.column(len(BREAKDOWN_FIELDS) - 1).encodings
+    rows = table.to_pylist()
+    assert len(rows) == len(csv_lines) - 1
+    for row, line in zip(rows, csv_lines[1:]):
+        values = dict(zip(BREAKDOWN_FIELDS, line.split(',')))
+        assert row['trace_id'] == values['trace_id']
+        assert row['f1_cold_start'] == int(values['f1_cold_start'])
+        # The csv contains local times
+        local_time = datetime.datetime.strptime(values['t5'], '%Y-%m-%d %H:%M:%S.%f')
+        assert row['t5'] == local_time.astimezone(datetime.timezone.utc)
+
+
+def test_analyze_traces_sketches(tmp_path):
+    """Latency sketches cover critical path categories and timestamp intervals."""
+    analyze_thumbnail_benchmark(tmp_path, sketches=True, workers=2, chunk_size=3)
+    sketches = LatencySketches.load(tmp_path / 'trace_breakdown.sketches.json')
+    with open(traces_path('thumbnail_benchmark')) as json_file:
+        traces = [json.loads(line) for line in json_file]
+    computation = [extract_trace_breakdown(trace)[CSV_FIELDS.index('computation')]
+                   for trace in traces]
+    computation_sketch = sketches.groups['categories']['computation']
+    assert computation_sketch.count == len(traces)
+    assert computation_sketch.max == max(computation) / datetime.timedelta(milliseconds=1)
+    assert sketches.groups['intervals']['t1t2'].count == len(traces)
+    assert sketches.groups['intervals']['total_duration'].count == len(traces)
+
+
+def test_analyze_chunk_decodes_segments_once(monkeypatch):
+    """Timestamps and span graphs (e.g., for sketches and the service map) share the segments."""
+    decoded = []
+
+    def parse_segment_json(segment_wrapper):
+        decoded.append(segment_wrapper['Id'])
+        return json.loads(segment_wrapper['Document'])
+    monkeypatch.setattr(aws_trace_analyzer, 'parse_segment_json', parse_segment_json)
+    with open(traces_path('thumbnail_benchmark')) as json_file:
+        lines = json_file.readlines()
+    analyzer = AwsTraceAnalyzer('traces.json', sketches=True, service_map=True)
+    results, sketches, service_map, _ = analyzer.analyze_chunk(lines)
+    assert len(results) == len(lines)
+    assert sketches.groups['categories']['computation'].count == len(lines)
+    num_segments = sum(len(json.loads(line)['Segments']) for line in lines)
+    assert len(decoded) == num_segments
+
+
+def test_compile_timestamp_rules_invalid_value():
+    with pytest.raises(Exception, match='unsupported value duration'):
+        compile_timestamp_rules({'t1': {'path': [{'name': 'S3'}], 'value': 'duration'}})
+
+
 # def test_extract_tmp_visualizer():
 #     """Just a tmp case for creating visualizer data
 #     """
 #     expected_breakdown = []  # noqa: E501
 #     tp = traces_path('long_trigger1')
 #     assert_trace_breakdown(tp, expected_breakdown)
+
+
+def test_extract_trace_deeply_nested_chain():
+    """Analyzes a synchronous chain of segments deeper than the recursion limit."""
+    depth = sys.getrecursionlimit() + 1000
+    start_time = 1619760991.000
+    segments = []
+    for i in range(depth):
+        doc = {
+            'id': f"s{i}",
+            'name': f"function-{i}",
+            'origin': 'AWS::Lambda::Function',
+            'start_time': round(start_time + i * 0.001, 3),
+            'end_time': round(start_time + 2 * depth * 0.001 - i * 0.001, 3)
+        }
+        if i > 0:
+            doc['parent_id'] = f"s{i - 1}"
+        segments.append({'Id': doc['id'], 'Document': json.dumps(doc)})
+    trace = {
+        'Id': '1-deep',
+        'Duration': 2 * depth * 0.001,
+        'LimitExceeded': False,
+        'Segments': segments
+    }
+    G = create_span_graph(trace)
+    assert G.graph['longest_path'] == [f"s{i}" for i in range(depth)]
+    trace_breakdown = dict(zip(CSV_FIELDS, extract_trace_breakdown(trace)))
+    assert trace_breakdown['computation'] == datetime.timedelta(milliseconds=2 * depth)
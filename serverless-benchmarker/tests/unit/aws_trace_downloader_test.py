@@ -0,0 +1,358 @@
+import gzip
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.exceptions import ClientError
+
+from sb.aws_trace_downloader import AwsTraceDownloader, AdaptiveRateLimiter, TraceIdBatcher, \
+    MAX_ATTEMPTS, is_throttling_error, split_window, xray_trace_id
+from sb.trace_cache import TraceCache
+from sb.synthetic_traces import SyntheticTraceGenerator, SyntheticXRayClient, SyntheticPaginator
+
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                       'BatchGetTraces')
+
+
+class ThrottlingXRayClient(SyntheticXRayClient):
+    """Throttles every BatchGetTraces request whose number is a multiple of throttle_every."""
+
+    def __init__(self, generator, num_traces, throttle_every) -> None:
+        super().__init__(generator, num_traces)
+        self.throttle_every = throttle_every
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        if operation == 'batch_get_traces':
+            return SyntheticPaginator(self.throttled_batch_get_traces)
+        return super().get_paginator(operation)
+
+    def throttled_batch_get_traces(self, TraceIds, **kwargs):
+        with self.lock:
+            self.num_requests += 1
+            throttle = self.num_requests % self.throttle_every == 0
+        if throttle:
+            raise throttling_error()
+        return self.batch_get_traces(TraceIds)
+
+
+def downloader(client):
+    downloader = AwsTraceDownloader.__new__(AwsTraceDownloader)
+    downloader.client = client
+    return downloader
+
+
+def fast_rate_limiter():
+    return AdaptiveRateLimiter(rate=1000, max_rate=10000, sleep=lambda seconds: None)
+
+
+def test_retrieve_traces_concurrently(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(53)]
+    sequential = downloader(SyntheticXRayClient(generator, 53))
+    assert sequential.retrieve_traces(trace_ids, tmp_path / 'sequential.json') == []
+    concurrent = downloader(SyntheticXRayClient(generator, 53))
+    assert concurrent.retrieve_traces(trace_ids, tmp_path / 'concurrent.json', workers=4,
+                                      rate_limiter=fast_rate_limiter()) == []
+    with open(tmp_path / 'sequential.json') as expected, \
+            open(tmp_path / 'concurrent.json') as result:
+        assert result.read() == expected.read()
+
+
+def test_retrieve_traces_throttled(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(40)]
+    rate_limiter = fast_rate_limiter()
+    client = ThrottlingXRayClient(generator, 40, throttle_every=3)
+    traces_file = tmp_path / 'traces.json'
+    assert downloader(client).retrieve_traces(trace_ids, traces_file, workers=3,
+                                              rate_limiter=rate_limiter) == []
+    with open(traces_file) as traces_json:
+        assert len(traces_json.readlines()) == 40
+    # 8 batches plus retries of every third request
+    assert client.num_requests > 8
+    assert rate_limiter.rate < 1000
+
+
+def test_retrieve_traces_unprocessed_after_max_attempts(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(7)]
+    client = ThrottlingXRayClient(generator, 7, throttle_every=1)
+    unprocessed_ids = downloader(client).retrieve_traces(trace_ids, tmp_path / 'traces.json',
+                                                         workers=2,
+                                                         rate_limiter=fast_rate_limiter())
+    assert sorted(unprocessed_ids) == sorted(trace_ids)
+    assert client.num_requests == 2 * MAX_ATTEMPTS
+
+
+def test_retrieve_traces_other_errors(tmp_path):
+    class FailingXRayClient(SyntheticXRayClient):
+        def batch_get_traces(self, TraceIds, **kwargs):
+            raise Exception('Access denied')
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(7)]
+    with pytest.raises(Exception, match='Access denied'):
+        downloader(FailingXRayClient(generator, 7)).retrieve_traces(
+            trace_ids, tmp_path / 'traces.json', workers=2, rate_limiter=fast_rate_limiter())
+
+
+class PagedBatchXRayClient(SyntheticXRayClient):
+    """Returns every trace of a BatchGetTraces request on its own page."""
+
+    def batch_get_traces(self, TraceIds, **kwargs):
+        pages = [{'Traces': [trace], 'UnprocessedTraceIds': [], 'NextToken': 'next'}
+                 for page in super().batch_get_traces(TraceIds) for trace in page['Traces']]
+        pages[-1].pop('NextToken')
+        yield from pages
+
+
+class CountingRateLimiter:
+    def __init__(self) -> None:
+        self.num_acquired = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            self.num_acquired += 1
+
+    def succeeded(self) -> None:
+        pass
+
+
+def test_retrieve_traces_rate_limits_pages(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(12)]
+    rate_limiter = CountingRateLimiter()
+    assert downloader(PagedBatchXRayClient(generator, 12)).retrieve_traces(
+        trace_ids, tmp_path / 'traces.json', workers=2, rate_limiter=rate_limiter) == []
+    with open(tmp_path / 'traces.json') as traces_json:
+        assert len(traces_json.readlines()) == 12
+    # One request per page instead of one per batch of 5 trace ids
+    assert rate_limiter.num_acquired == 12
+
+
+class BlockingSummariesXRayClient(SyntheticXRayClient):
+    """Only serves the last trace summary page after the first trace has been requested."""
+
+    def __init__(self, generator, num_traces) -> None:
+        super().__init__(generator, num_traces, page_size=10)
+        self.requested = threading.Event()
+
+    def trace_summaries(self, **kwargs):
+        pages = list(super().trace_summaries(**kwargs))
+        yield from pages[:-1]
+        assert self.requested.wait(timeout=10), 'Traces are not retrieved before the last page.'
+        yield pages[-1]
+
+    def batch_get_traces(self, TraceIds, **kwargs):
+        self.requested.set()
+        return super().batch_get_traces(TraceIds, **kwargs)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_prefetch_trace_ids_pipelined(tmp_path, workers):
+    generator = SyntheticTraceGenerator(depth=2)
+    client = BlockingSummariesXRayClient(generator, 42)
+    trace_ids = downloader(client).prefetch_trace_ids(None, None, tmp_path / 'trace_ids.txt')
+    batcher = TraceIdBatcher()
+    assert downloader(client).retrieve_traces(trace_ids, tmp_path / 'traces.json', workers,
+                                              fast_rate_limiter(), batcher) == []
+    assert batcher.num_unique == 42
+    with open(tmp_path / 'traces.json') as traces_json:
+        assert len(traces_json.readlines()) == 42
+    with open(tmp_path / 'trace_ids.txt') as trace_ids_file:
+        assert len(trace_ids_file.readlines()) == 42
+
+
+def test_prefetch_trace_ids_error(tmp_path):
+    class FailingXRayClient(SyntheticXRayClient):
+        def trace_summaries(self, **kwargs):
+            yield {'TraceSummaries': [{'Id': '1-1'}]}
+            raise Exception('Access denied')
+    trace_ids = downloader(FailingXRayClient(None, 0)).prefetch_trace_ids(
+        None, None, tmp_path / 'trace_ids.txt')
+    assert next(trace_ids) == '1-1'
+    with pytest.raises(Exception, match='Access denied'):
+        next(trace_ids)
+
+
+class CountingSummariesXRayClient(SyntheticXRayClient):
+    """Counts trace summary windows and throttles the first request of every throttle_every."""
+
+    def __init__(self, generator, num_traces, page_size, throttle_every=None) -> None:
+        super().__init__(generator, num_traces, page_size=page_size)
+        self.windows = []
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+
+    def trace_summaries(self, StartTime=None, EndTime=None, **kwargs):
+        with self.lock:
+            self.windows.append((StartTime, EndTime))
+            throttle = self.throttle_every and len(self.windows) % self.throttle_every == 0
+        if throttle:
+            raise throttling_error()
+        yield from super().trace_summaries(StartTime=StartTime, EndTime=EndTime)
+
+
+def invoke_timespan(generator, num_traces):
+    start = datetime.fromtimestamp(generator.start_time, tz=timezone.utc)
+    return start, start + timedelta(seconds=num_traces * generator.interval)
+
+
+@pytest.mark.parametrize('throttle_every', [None, 4])
+def test_sharded_trace_summaries(throttle_every):
+    # 600 traces within 60 seconds
+    generator = SyntheticTraceGenerator(depth=2)
+    client = CountingSummariesXRayClient(generator, 600, page_size=40,
+                                         throttle_every=throttle_every)
+    start, end = invoke_timespan(generator, 600)
+    pages = downloader(client).sharded_trace_summaries(start, end, 3, fast_rate_limiter())
+    trace_ids = [summary['Id'] for page in pages for summary in page['TraceSummaries']]
+    assert set(trace_ids) == {generator.trace_id(index) for index in range(600)}
+    # Dense 20 seconds windows are split into 10 seconds windows
+    sizes = {end - start for start, end in client.windows}
+    assert sizes == {timedelta(seconds=20), timedelta(seconds=10)}
+
+
+def test_sharded_trace_summaries_sparse():
+    generator = SyntheticTraceGenerator(depth=2)
+    client = CountingSummariesXRayClient(generator, 600, page_size=1000)
+    start, end = invoke_timespan(generator, 600)
+    pages = list(downloader(client).sharded_trace_summaries(start, end, 4, fast_rate_limiter()))
+    assert len(pages) == 4
+    assert len(client.windows) == 4
+
+
+def test_prefetch_trace_ids_sharded(tmp_path):
+    generator = SyntheticTraceGenerator(depth=1)
+    # Two sparse 15 seconds windows with a single page each
+    client = CountingSummariesXRayClient(generator, 300, page_size=200)
+    start, end = invoke_timespan(generator, 300)
+    trace_ids = downloader(client).prefetch_trace_ids(start, end, tmp_path / 'trace_ids.txt',
+                                                      workers=2)
+    batcher = TraceIdBatcher()
+    assert downloader(client).retrieve_traces(trace_ids, tmp_path / 'traces.json', 3,
+                                              fast_rate_limiter(), batcher) == []
+    assert len(client.windows) == 2
+    assert batcher.num_unique == 300
+    with open(tmp_path / 'traces.json') as traces_json:
+        assert len(traces_json.readlines()) == 300
+
+
+def test_split_window():
+    start = datetime(2022, 1, 6, 10, tzinfo=timezone.utc)
+    windows = split_window(start, start + timedelta(seconds=10), 3)
+    assert len(windows) == 3
+    assert windows[0][0] == start
+    assert windows[-1][1] == start + timedelta(seconds=10)
+    assert all(previous[1] == next[0] for previous, next in zip(windows, windows[1:]))
+
+
+K6_METRICS = """metric_name,timestamp,metric_value,check,error,error_code,expected_response,group,method,name,proto,scenario,service,status,subproto,tls_version,url,extra_tags
+vus,1641461928,20.000000,,,,,,,,,,,,,,,
+http_reqs,1641461929,1.000000,,,,true,,POST,{url},HTTP/2.0,constant,,200,,tls1.3,{url},xray_header=Root=1-61d6b8a7-91ec5752c45d80fc8fa85c5c
+http_req_duration,1641461929,1884.096100,,,,true,,POST,{url},HTTP/2.0,constant,,200,,tls1.3,{url},xray_header=Root=1-61d6b8a7-91ec5752c45d80fc8fa85c5c
+http_reqs,1641461930,1.000000,,,,true,,POST,{url},HTTP/2.0,constant,,502,,tls1.3,{url},xray_header=Root=1-61d6b8a8-0b0c9d1e2f3a4b5c6d7e8f90
+http_reqs,1641461930,1.000000,,,,true,,POST,{url},HTTP/2.0,constant,,200,,tls1.3,{url},
+"""  # noqa: E501
+
+
+def test_read_k6_trace_ids(tmp_path):
+    k6_metrics_file = tmp_path / 'k6_metrics.csv'
+    k6_metrics_file.write_text(K6_METRICS.format(url='https://example.com/dev/upload'))
+    trace_ids = downloader(None).read_k6_trace_ids(k6_metrics_file, tmp_path / 'trace_ids.txt')
+    expected = ['1-61d6b8a7-91ec5752c45d80fc8fa85c5c', '1-61d6b8a8-0b0c9d1e2f3a4b5c6d7e8f90']
+    assert list(trace_ids) == expected
+    assert (tmp_path / 'trace_ids.txt').read_text().split() == expected
+
+
+def test_read_k6_trace_ids_missing_file(tmp_path):
+    with pytest.raises(Exception, match='Missing .*k6_metrics.csv'):
+        next(downloader(None).read_k6_trace_ids(tmp_path / 'k6_metrics.csv',
+                                                tmp_path / 'trace_ids.txt'))
+
+
+def test_xray_trace_id():
+    assert xray_trace_id('xray_header=Root=1-61d6b8a7-91ec5752c45d80fc8fa85c5c') == \
+        '1-61d6b8a7-91ec5752c45d80fc8fa85c5c'
+    assert xray_trace_id('vu=1&xray_header=Root=1-61d6b8a7-91ec;Parent=53995c3f;Sampled=1') == \
+        '1-61d6b8a7-91ec'
+    assert xray_trace_id('vu=1') is None
+    assert xray_trace_id('') is None
+
+
+def test_trace_id_batcher():
+    batcher = TraceIdBatcher(size=2)
+    batches = list(batcher.batches(['a', 'b', 'a', 'c', 'b', 'd', 'e']))
+    assert batches == [['a', 'b'], ['c', 'd'], ['e']]
+    assert batcher.num_unique == 5
+    assert batcher.num_duplicates == 2
+
+
+def test_trace_id_batcher_cache(tmp_path):
+    cache = TraceCache(tmp_path)
+    cache.put('b', '{"Id": "b"}')
+    batcher = TraceIdBatcher(size=2, cache=cache)
+    assert list(batcher.batches(['a', 'b', 'c', 'b'])) == [['a', 'c']]
+    assert batcher.cached_ids == ['b']
+    assert batcher.num_unique == 3
+
+
+def test_retrieve_traces_cached(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(20)]
+    cache = TraceCache(tmp_path / 'cache')
+    client = ThrottlingXRayClient(generator, 20, throttle_every=1000)
+    assert downloader(client).retrieve_traces(trace_ids[:10], tmp_path / 'first.json',
+                                              cache=cache) == []
+    assert client.num_requests == 2
+    # Only the 10 missing traces are retrieved in 2 more batches
+    assert downloader(client).retrieve_traces(trace_ids, tmp_path / 'traces.json',
+                                              cache=cache) == []
+    assert client.num_requests == 4
+    with open(tmp_path / 'traces.json') as traces_json:
+        lines = traces_json.readlines()
+    assert len(lines) == 20
+    with open(tmp_path / 'first.json') as first_json:
+        assert set(first_json.readlines()) <= set(lines)
+
+
+def test_retrieve_traces_gzip(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2)
+    trace_ids = [generator.trace_id(index) for index in range(7)]
+    client = SyntheticXRayClient(generator, 7)
+    assert downloader(client).retrieve_traces(trace_ids, tmp_path / 'traces.json') == []
+    assert downloader(client).retrieve_traces(trace_ids, tmp_path / 'traces.json.gz') == []
+    with open(tmp_path / 'traces.json', 'rb') as traces_json, \
+            gzip.open(tmp_path / 'traces.json.gz') as traces_gz:
+        assert traces_gz.read() == traces_json.read()
+
+
+def test_is_throttling_error():
+    assert is_throttling_error(throttling_error())
+    assert not is_throttling_error(Exception('Rate exceeded'))
+
+
+def test_adaptive_rate_limiter():
+    now = [100.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+    rate_limiter = AdaptiveRateLimiter(rate=4, max_rate=5, min_rate=1, increase=0.5,
+                                       clock=lambda: now[0], sleep=sleep)
+    for _ in range(3):
+        rate_limiter.acquire()
+    assert sleeps == [0.25, 0.25]
+    rate_limiter.throttled()
+    assert rate_limiter.rate == 2
+    rate_limiter.throttled()
+    rate_limiter.throttled()
+    assert rate_limiter.rate == 1
+    for _ in range(10):
+        rate_limiter.succeeded()
+    assert rate_limiter.rate == 5
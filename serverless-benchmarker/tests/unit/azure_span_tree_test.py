@@ -0,0 +1,128 @@
+import json
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from sb.aws_trace_analyzer import calculate_breakdown
+from sb.azure_span_tree import create_span_graph
+from sb.azure_trace_analyzer import AzureTraceAnalyzer
+from sb.latency_sketch import LatencySketches
+
+
+def connected_records():
+    """Upload function writing a blob that asynchronously triggers the CreateThumbnail function.
+    Records are in arbitrary order and include a trace log without duration."""
+    return [
+        {'itemType': 'dependency', 'id': 'd', 'operation_ParentId': 'c', 'type': 'Azure blob',
+         'name': 'GET thumbnaistore', 'timestamp': '2022-01-06T09:00:00.160Z', 'duration': 10},
+        {'itemType': 'request', 'id': 'a', 'operation_ParentId': 'op', 'name': 'Upload',
+         'timestamp': '2022-01-06T09:00:00Z', 'duration': 100},
+        {'itemType': 'trace', 'id': 't', 'operation_ParentId': 'a',
+         'message': 'Upload Blob Operation Starts', 'timestamp': '2022-01-06T09:00:00.030Z'},
+        {'itemType': 'dependency', 'id': 'b', 'operation_ParentId': 'a', 'type': 'Azure blob',
+         'name': 'PUT thumbnaistore', 'timestamp': '2022-01-06T09:00:00.040Z', 'duration': 20},
+        {'itemType': 'request', 'id': 'c', 'operation_ParentId': 'b', 'name': 'Create-Thumbnail',
+         'timestamp': '2022-01-06T09:00:00.150Z', 'duration': 50}
+    ]
+
+
+def test_create_span_graph():
+    G = create_span_graph(connected_records(), 'op')
+    assert G.ids == ['d', 'a', 'b', 'c']
+    assert G.graph['start'] == 'a'
+    assert G.graph['duration'] == timedelta(milliseconds=200)
+    assert G.graph['longest_path'] == ['a', 'b', 'c', 'd']
+    assert [G.invocation_type[G.index[id]] for id in 'abcd'] == ['client', 'sync', 'async', 'sync']
+
+
+def test_calculate_breakdown():
+    G = calculate_breakdown(create_span_graph(connected_records(), 'op'))
+    assert G.graph['computation'] == timedelta(milliseconds=80)
+    assert G.graph['external_service'] == timedelta(milliseconds=30)
+    assert G.graph['trigger'] == timedelta(milliseconds=90)
+    assert G.graph['unclassified'] == timedelta(0)
+
+
+def triggered_records():
+    """Connected records whose CreateThumbnail invocation starts a new operation that refers to
+    the trace only in its customDimensions."""
+    records = connected_records()
+    for record in records:
+        record['operation_Id'] = 'op'
+    records[4].update(operation_Id='op2', operation_ParentId='op2',
+                      customDimensions='{"TriggerReason": "New blob detected: upload-op.jpg"}')
+    records[0]['operation_Id'] = 'op2'
+    return records
+
+
+def test_create_span_graph_triggered():
+    G = create_span_graph(triggered_records(), 'op')
+    assert G.graph['start'] == 'a'
+    assert G.graph['longest_path'] == ['a', 'b', 'c', 'd']
+    assert calculate_breakdown(G).graph['trigger'] == timedelta(milliseconds=90)
+
+
+def test_create_span_graph_parallel_triggers():
+    """Parallel triggered invocations are not chained into a single critical path."""
+    records = triggered_records()
+    records.append({**records[4], 'id': 'e', 'timestamp': '2022-01-06T09:00:00.250Z'})
+    G = create_span_graph(records, 'op')
+    assert G.parent[G.index['e']] == G.index['b']
+    assert G.parent[G.index['c']] == G.index['b']
+
+
+def test_create_span_graph_without_trigger():
+    """Requests without parent span are only linked if triggered by the trace."""
+    records = triggered_records()
+    records[4]['customDimensions'] = None
+    with pytest.raises(Exception, match='Trace op has 2 root spans'):
+        create_span_graph(records, 'op')
+
+
+def test_create_span_graph_cyclic_parents():
+    records = connected_records()
+    records[1]['operation_ParentId'] = 'd'
+    with pytest.raises(Exception, match='Trace op has 0 root spans'):
+        create_span_graph(records, 'op')
+
+
+def test_create_span_graph_unreachable_cycle():
+    records = connected_records()[1:2] + [
+        {'itemType': 'request', 'id': 'x', 'operation_ParentId': 'y', 'name': 'X',
+         'timestamp': '2022-01-06T09:00:00.010Z', 'duration': 10},
+        {'itemType': 'request', 'id': 'y', 'operation_ParentId': 'x', 'name': 'Y',
+         'timestamp': '2022-01-06T09:00:00.020Z', 'duration': 10}
+    ]
+    with pytest.raises(Exception, match='Trace op has 2 spans unreachable from its root span'):
+        create_span_graph(records, 'op')
+
+
+def test_create_span_graph_thumbnail_app():
+    """Traces of the thumbnail app fixture with the links of downloaded traces."""
+    fixture = Path(__file__).parent.parent / 'fixtures/azure_trace_analyzer/thumbnail_app_linked'
+    with open(fixture / 'traces.json') as traces_json:
+        traces = [json.loads(line) for line in traces_json]
+    for trace in traces[:4] + traces[5:]:
+        G = calculate_breakdown(create_span_graph(json.loads(trace['traces']), trace['trace_id']))
+        path = [G.name[G.index[id]] for id in G.graph['longest_path']]
+        assert path[:3] == ['POST /api/upload', 'Upload', 'PUT thumbnaistore']
+        assert path[-3:] == ['Create-Thumbnail', 'GET thumbnaistore', 'PUT thumbnaistore']
+    assert G.graph['trigger'] == timedelta(microseconds=999941)
+    # The Upload request of the fifth trace starts before its parent request
+    with pytest.raises(Exception, match='does not match the earliest time'):
+        create_span_graph(json.loads(traces[4]['traces']), traces[4]['trace_id'])
+
+
+def test_add_category_latencies():
+    analyzer = AzureTraceAnalyzer('traces.json', critical_path=True)
+    sketches = LatencySketches()
+    output = {}
+    analyzer.add_category_latencies(output, sketches, connected_records(), 'op')
+    assert output['trigger'] == 90
+    assert output['orchestration'] is None
+    analyzer.add_category_latencies(output, sketches, [], 'empty')
+    assert output['trigger'] is None
+    assert analyzer.num_skipped_traces == 1
+    assert sketches.groups['categories']['trigger'].count == 1
+    assert sketches.groups['categories']['trigger'].sum == 90
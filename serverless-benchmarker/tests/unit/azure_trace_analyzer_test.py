@@ -0,0 +1,93 @@
+import csv
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+from sb.azure_trace_analyzer import AzureTraceAnalyzer, BREAKDOWN_FIELDS, match_records
+
+
+def fixture_path(app):
+    tests_path = Path(__file__).parent.parent
+    return tests_path / f"fixtures/azure_trace_analyzer/{app}"
+
+
+def test_analyze_traces_thumbnail_app(tmp_path):
+    """Synthetic Application Insights records of the thumbnail app including cold starts,
+    failed uploads (resultCode 409), timestamps without fractional seconds, and
+    records in arbitrary order. The expected breakdown stems from the former
+    DataFrame-based implementation."""
+    log_path = tmp_path / 'traces.json'
+    shutil.copy(fixture_path('thumbnail_app') / 'traces.json', log_path)
+    AzureTraceAnalyzer(log_path).analyze_traces()
+    with open(tmp_path / 'trace_breakdown.csv') as breakdown_file:
+        result = breakdown_file.read()
+    with open(fixture_path('thumbnail_app') / 'trace_breakdown.csv') as expected_file:
+        assert result == expected_file.read()
+
+
+@pytest.mark.parametrize('chunk_size', [None, 4])
+def test_analyze_traces_vectorized(tmp_path, chunk_size):
+    log_path = tmp_path / 'traces.json'
+    shutil.copy(fixture_path('thumbnail_app') / 'traces.json', log_path)
+    AzureTraceAnalyzer(log_path, chunk_size=chunk_size, vectorized=True).analyze_traces()
+    with open(tmp_path / 'trace_breakdown.csv') as breakdown_file:
+        result = breakdown_file.read()
+    with open(fixture_path('thumbnail_app') / 'trace_breakdown.csv') as expected_file:
+        assert result == expected_file.read()
+
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_analyze_traces_critical_path(tmp_path, caplog, vectorized):
+    """The thumbnail app fixture with the links of downloaded traces (e.g., operation_ParentId)
+    has the same breakdown and a critical path except for the fifth trace (clock skew)."""
+    log_path = tmp_path / 'traces.json'
+    shutil.copy(fixture_path('thumbnail_app_linked') / 'traces.json', log_path)
+    AzureTraceAnalyzer(log_path, vectorized=vectorized, critical_path=True).analyze_traces()
+    with open(tmp_path / 'trace_breakdown.csv') as breakdown_file:
+        rows = list(csv.DictReader(breakdown_file))
+    with open(fixture_path('thumbnail_app') / 'trace_breakdown.csv') as expected_file:
+        expected_rows = list(csv.DictReader(expected_file))
+    assert [{field: row[field] for field in BREAKDOWN_FIELDS} for row in rows] == expected_rows
+    assert [row['trigger'] == '' for row in rows] == [False] * 4 + [True, False]
+    assert rows[-1]['trigger'] == '999.941'
+    assert rows[-1]['computation'] == '250.327'
+    assert rows[-1]['orchestration'] == ''
+    assert 'Skipped the critical path of 1 traces' in caplog.text
+
+
+def test_analyze_lines_vectorized_missing_record():
+    with open(fixture_path('thumbnail_app') / 'traces.json') as traces_json:
+        lines = traces_json.readlines()
+    data = json.loads(lines[1])
+    records = [r for r in json.loads(data['traces']) if r['name'] != 'CreateThumbnail execution']
+    lines[1] = json.dumps({**data, 'traces': json.dumps(records)})
+    analyzer = AzureTraceAnalyzer(fixture_path('thumbnail_app') / 'traces.json', vectorized=True)
+    with pytest.raises(Exception, match=f"Trace {data['trace_id']} has no matching records"):
+        analyzer.analyze_lines_vectorized(lines)
+
+
+def test_match_records_first_match():
+    records = [
+        {'itemType': 'trace', 'message': None, 'name': 'Upload'},
+        {'itemType': 'request', 'name': 'Upload', 'timestamp': 'first'},
+        {'itemType': 'request', 'name': 'Upload', 'timestamp': 'second'},
+        {'itemType': 'trace', 'customDimensions': '{"msg": "Host initialization: 1"}'}
+    ]
+    rules = {
+        'upload': [('itemType', '==', 'request'), ('name', '==', 'Upload')],
+        'init': [('itemType', '==', 'trace'), ('customDimensions', 'contains', 'Host init')],
+        'missing': [('message', 'contains', 'Upload')]
+    }
+    matches = match_records(records, rules)
+    assert matches == {'upload': records[1], 'init': records[3]}
+
+
+def test_analyze_trace_missing_record():
+    with open(fixture_path('thumbnail_app') / 'traces.json') as traces_json:
+        data = json.loads(traces_json.readline())
+    records = [r for r in json.loads(data['traces']) if r['name'] != 'CreateThumbnail execution']
+    analyzer = AzureTraceAnalyzer(fixture_path('thumbnail_app') / 'traces.json')
+    with pytest.raises(Exception, match="no matching records for \\['t8'\\]"):
+        analyzer.analyze_trace(json.dumps(records), data['trace_id'])
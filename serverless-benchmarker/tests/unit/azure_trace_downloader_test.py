@@ -0,0 +1,184 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import requests
+
+from sb import azure_trace_downloader
+from sb.azure_trace_downloader import AzureTraceDownloader, DEFAULT_WINDOW, MAX_ATTEMPTS, \
+    split_records, time_windows
+
+A = 'a' * 32
+B = 'b' * 32
+C = 'c' * 32
+
+COLUMNS = ['timestamp', 'itemType', 'name', 'operation_Id', 'customDimensions', 'duration']
+
+RECORDS = [
+    ['2022-01-06T09:00:00.1Z', 'request', 'Upload', A, None, 50],
+    ['2022-01-06T09:00:00.2Z', 'trace', None, A, '{"Category": "Function.Upload"}', None],
+    ['2022-01-06T09:00:01Z', 'trace', None, 'x', '{"Message": "Host initialization"}', None],
+    ['2022-01-06T09:00:02Z', 'request', 'Create-Thumbnail', 'y',
+     f'{{"TriggerReason": "New blob detected: images/upload-{A}.jpg"}}', 75],
+    ['2022-01-06T09:00:03Z', 'trace', None, 'z', '{"Message": "Host initialization"}', None],
+    ['2022-01-06T09:06:00Z', 'request', 'Upload', B, None, 40],
+    ['2022-01-06T09:06:01Z', 'request', 'Create-Thumbnail', B, None, 60],
+    ['2022-01-06T09:07:00Z', 'request', 'Upload', C, None, 30]
+]
+
+
+class FakeAzureTraceDownloader(AzureTraceDownloader):
+    """Answers the windowed queries of the batched mode from RECORDS.
+    Results with more than max_rows rows are partial and the queries of the windows in
+    failures fail the given number of times (e.g., due to throttling)."""
+
+    def __init__(self, records=RECORDS, window=DEFAULT_WINDOW, max_rows=None,
+                 failures=None, **kwargs) -> None:
+        super().__init__(spec=None, batched=True, window=window, **kwargs)
+        self.records = records
+        self.max_rows = max_rows
+        self.failures = failures or {}
+        self.timespans = []
+
+    def get_query_result_json(self, ai_api_query, ai_api_time_span='P7D'):
+        self.timespans.append(ai_api_time_span)
+        if self.failures.get(ai_api_time_span, 0) > 0:
+            self.failures[ai_api_time_span] -= 1
+            raise requests.HTTPError('429 Client Error: Too Many Requests')
+        start, end = [pd.Timestamp(t) for t in ai_api_time_span.split('/')]
+        # Records without timestamp are returned with the first window
+        rows = [row for row in self.records
+                if start <= pd.Timestamp(row[0] or start) < end]
+        result = {'tables': [{'columns': [{'name': c} for c in COLUMNS], 'rows': rows}]}
+        if self.max_rows is not None and len(rows) > self.max_rows:
+            result['tables'][0]['rows'] = rows[:self.max_rows]
+            result['error'] = {'code': 'PartialError', 'message': 'Result set too large'}
+        return result
+
+
+def test_time_windows():
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    windows = time_windows(start, start + timedelta(minutes=12), timedelta(minutes=5))
+    assert [(s.minute, e.minute) for s, e in windows] == [(0, 5), (5, 10), (10, 12)]
+
+
+def test_split_records():
+    records = pd.DataFrame(RECORDS, columns=COLUMNS)
+    traces = split_records(records, [A, B, C])
+    assert traces == {A: [0, 1, 2, 3], B: [5, 6]}
+
+
+def test_retrieve_traces_batched(tmp_path):
+    downloader = FakeAzureTraceDownloader()
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    downloader.retrieve_traces_batched(start, start + timedelta(minutes=10), [A, B, C],
+                                       tmp_path / 'traces.json')
+    assert downloader.timespans == [
+        '2022-01-06T09:00:00.000000Z/2022-01-06T09:05:00.000000Z',
+        '2022-01-06T09:05:00.000000Z/2022-01-06T09:10:00.000000Z'
+    ]
+    with open(tmp_path / 'traces.json') as traces_json:
+        traces = [json.loads(line) for line in traces_json]
+    assert [trace['trace_id'] for trace in traces] == [A, B]
+    records = json.loads(traces[0]['traces'])
+    assert [r['name'] for r in records] == ['Upload', None, None, 'Create-Thumbnail']
+    assert records[2]['customDimensions'] == '{"Message": "Host initialization"}'
+
+
+def read_traces(trace_file):
+    with open(trace_file) as traces_json:
+        return [json.loads(line) for line in traces_json]
+
+
+def test_retrieve_traces_batched_small_windows(tmp_path):
+    """Records of traces spanning several windows are carried over until the traces are idle."""
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    end = start + timedelta(minutes=6, seconds=30)
+    FakeAzureTraceDownloader().retrieve_traces_batched(start, end, [A, B, C],
+                                                       tmp_path / 'expected.json')
+    # The Upload and Create-Thumbnail requests of A are in different windows
+    downloader = FakeAzureTraceDownloader(window=timedelta(seconds=2))
+    downloader.retrieve_traces_batched(start, end, [A, B, C], tmp_path / 'traces.json')
+    assert len(downloader.timespans) == 195
+    assert read_traces(tmp_path / 'traces.json') == read_traces(tmp_path / 'expected.json')
+
+
+def test_retrieve_traces_batched_missing_timestamps(tmp_path, caplog):
+    records = RECORDS + [
+        [None, 'trace', None, A, '{"Message": "Host initialization"}', None],
+        ['', 'request', 'Upload', C, None, 30]
+    ]
+    downloader = FakeAzureTraceDownloader(records)
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    downloader.retrieve_traces_batched(start, start + timedelta(minutes=10), [A, B, C],
+                                       tmp_path / 'traces.json')
+    assert 'Dropped 2 records without timestamp' in caplog.text
+    traces = read_traces(tmp_path / 'traces.json')
+    assert [trace['trace_id'] for trace in traces] == [A, B]
+    assert len(json.loads(traces[0]['traces'])) == 4
+
+
+def test_retrieve_traces_batched_late_records(tmp_path, caplog):
+    """Records until completion_time after the end of the Create-Thumbnail request are saved
+    even if they arrive in later windows."""
+    processed = f'{{"Message": "Processed images/upload-{A}.jpg"}}'
+    records = RECORDS + [
+        ['2022-01-06T09:00:30Z', 'trace', None, 'y', processed, None],
+        ['2022-01-06T09:01:30Z', 'trace', None, 'y', processed, None]
+    ]
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    end = start + timedelta(minutes=6, seconds=30)
+    downloader = FakeAzureTraceDownloader(records, window=timedelta(seconds=20))
+    downloader.retrieve_traces_batched(start, end, [A, B, C], tmp_path / 'traces.json')
+    traces = read_traces(tmp_path / 'traces.json')
+    assert [trace['trace_id'] for trace in traces] == [A, B]
+    timestamps = [r['timestamp'] for r in json.loads(traces[0]['traces'])]
+    assert '2022-01-06T09:00:30Z' in timestamps
+    assert '2022-01-06T09:01:30Z' not in timestamps
+    assert f"Failed to download trace for {C}" in caplog.text
+    downloader = FakeAzureTraceDownloader(records, window=timedelta(seconds=20),
+                                          completion_time=None)
+    downloader.retrieve_traces_batched(start, end, [A, B, C], tmp_path / 'traces.json')
+    timestamps = [r['timestamp'] for r in json.loads(read_traces(tmp_path / 'traces.json')[0]
+                                                     ['traces'])]
+    assert '2022-01-06T09:01:30Z' in timestamps
+
+
+FIRST_WINDOW = '2022-01-06T09:00:00.000000Z/2022-01-06T09:05:00.000000Z'
+
+
+def test_retrieve_traces_batched_throttled(tmp_path, monkeypatch):
+    monkeypatch.setattr(azure_trace_downloader, 'RETRY_DELAY', 0)
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    FakeAzureTraceDownloader().retrieve_traces_batched(
+        start, start + timedelta(minutes=10), [A, B, C], tmp_path / 'expected.json')
+    downloader = FakeAzureTraceDownloader(failures={FIRST_WINDOW: 2})
+    downloader.retrieve_traces_batched(start, start + timedelta(minutes=10), [A, B, C],
+                                       tmp_path / 'traces.json')
+    assert downloader.timespans.count(FIRST_WINDOW) == 3
+    assert read_traces(tmp_path / 'traces.json') == read_traces(tmp_path / 'expected.json')
+
+
+def test_retrieve_traces_batched_failed_window(tmp_path, monkeypatch, caplog):
+    """Windows failing after all attempts are skipped without losing the other traces."""
+    monkeypatch.setattr(azure_trace_downloader, 'RETRY_DELAY', 0)
+    downloader = FakeAzureTraceDownloader(failures={FIRST_WINDOW: MAX_ATTEMPTS})
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    downloader.retrieve_traces_batched(start, start + timedelta(minutes=10), [A, B, C],
+                                       tmp_path / 'traces.json')
+    assert f"Skipped the records of the window {FIRST_WINDOW}" in caplog.text
+    assert f"Failed to download trace for {A}" in caplog.text
+    assert [trace['trace_id'] for trace in read_traces(tmp_path / 'traces.json')] == [B]
+
+
+def test_retrieve_traces_batched_partial_results(tmp_path, caplog):
+    """Windows with partial results are split into halves until complete."""
+    start = datetime(2022, 1, 6, 9, tzinfo=timezone.utc)
+    FakeAzureTraceDownloader().retrieve_traces_batched(
+        start, start + timedelta(minutes=10), [A, B, C], tmp_path / 'expected.json')
+    downloader = FakeAzureTraceDownloader(max_rows=3)
+    downloader.retrieve_traces_batched(start, start + timedelta(minutes=10), [A, B, C],
+                                       tmp_path / 'traces.json')
+    assert f"Partial result for the window {FIRST_WINDOW}" in caplog.text
+    assert len(downloader.timespans) > 2
+    assert read_traces(tmp_path / 'traces.json') == read_traces(tmp_path / 'expected.json')
@@ -0,0 +1,15 @@
+import re
+
+from sb.breakdown_writer import local_timezone
+
+
+def test_local_timezone_name(monkeypatch):
+    monkeypatch.setenv('TZ', 'Europe/Zurich')
+    assert local_timezone() == 'Europe/Zurich'
+    monkeypatch.setenv('TZ', ':/usr/share/zoneinfo/America/New_York')
+    assert local_timezone() == 'America/New_York'
+
+
+def test_local_timezone_offset(monkeypatch):
+    monkeypatch.setenv('TZ', ':/etc/custom_localtime')
+    assert re.fullmatch(r'[+-]\d{4}', local_timezone())
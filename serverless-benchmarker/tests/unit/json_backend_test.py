@@ -0,0 +1,39 @@
+import pytest
+from pathlib import Path
+
+from sb import json_backend
+from sb.aws_trace_analyzer import extract_trace_breakdown
+
+
+@pytest.fixture
+def restore_backend():
+    backend = json_backend.backend
+    yield
+    json_backend.use_backend(backend)
+
+
+def test_use_backend_unsupported(restore_backend):
+    with pytest.raises(Exception, match='Unsupported JSON backend simplejson'):
+        json_backend.use_backend('simplejson')
+
+
+def test_use_backend_missing_orjson(restore_backend, monkeypatch):
+    monkeypatch.setattr(json_backend, 'orjson', None)
+    monkeypatch.delenv('SB_JSON_BACKEND', raising=False)
+    assert json_backend.default_backend() == 'json'
+    with pytest.raises(Exception, match='orjson is not installed'):
+        json_backend.use_backend('orjson')
+
+
+def test_backends_decode_identical_breakdown(restore_backend):
+    """All available backends yield the same breakdown for double JSON-encoded XRay traces."""
+    pytest.importorskip('orjson')
+    tests_path = Path(__file__).parent.parent
+    traces_path = tests_path / 'fixtures/aws_trace_analyzer/thumbnail_benchmark/traces.json'
+    breakdowns = {}
+    for backend in json_backend.BACKENDS:
+        json_backend.use_backend(backend)
+        with open(traces_path, 'rb') as traces_json:
+            traces = [json_backend.loads(line) for line in traces_json]
+        breakdowns[backend] = [extract_trace_breakdown(trace) for trace in traces]
+    assert breakdowns['orjson'] == breakdowns['json']
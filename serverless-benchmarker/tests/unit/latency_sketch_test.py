@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+from sb.latency_sketch import QuantileSketch, LatencySketches, merge_sketch_files
+from sb.latency_sketch import add_interval_latencies
+
+
+def exact_quantile(values, q):
+    """Lower nearest-rank quantile matching the rank definition of the sketch."""
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+def test_quantile_relative_accuracy():
+    rng = random.Random(42)
+    values = [rng.lognormvariate(5, 1.5) for _ in range(10000)] + [0.0, -3.5]
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+    for q in [0, 0.1, 0.5, 0.95, 0.99, 1]:
+        exact = exact_quantile(values, q)
+        assert sketch.quantile(q) == pytest.approx(exact, rel=0.01)
+    assert sketch.count == len(values)
+    assert sketch.min == -3.5
+    assert sketch.quantile(1) == max(values)
+
+
+def test_merge_equals_single_sketch():
+    rng = random.Random(7)
+    values = [rng.uniform(-10, 1000) for _ in range(5000)]
+    single = QuantileSketch()
+    parts = [QuantileSketch() for _ in range(3)]
+    for i, value in enumerate(values):
+        single.add(value)
+        parts[i % 3].add(value)
+    merged = QuantileSketch()
+    for part in parts:
+        merged.merge(part)
+    assert merged.positive == single.positive
+    assert merged.negative == single.negative
+    assert [merged.quantile(q) for q in [0.5, 0.99]] == [single.quantile(q) for q in [0.5, 0.99]]
+
+
+def test_merge_different_accuracy():
+    with pytest.raises(Exception, match='Cannot merge'):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_empty_quantile():
+    assert QuantileSketch().quantile(0.5) is None
+
+
+def test_save_load_merge_files(tmp_path):
+    paths = []
+    for run in range(2):
+        sketches = LatencySketches()
+        for value in range(1, 101):
+            sketches.add('categories', 'computation', value + run * 100)
+        path = tmp_path / f"run{run}.sketches.json"
+        sketches.save(path)
+        paths.append(path)
+    merged = merge_sketch_files(paths)
+    [row] = merged.quantiles()
+    assert row['group'] == 'categories'
+    assert row['name'] == 'computation'
+    assert row['count'] == 200
+    assert row['p50'] == pytest.approx(100, rel=0.01)
+    assert row['p99'] == pytest.approx(198, rel=0.01)
+
+
+def test_add_interval_latencies():
+    sketches = LatencySketches()
+    add_interval_latencies(sketches, {'t1': 1000, 't2': 3000, 't3': None, 't4': 9000})
+    intervals = sketches.groups['intervals']
+    assert sorted(intervals) == ['t1t2', 'total_duration']
+    assert intervals['t1t2'].sum == 2
+    assert intervals['total_duration'].sum == 8
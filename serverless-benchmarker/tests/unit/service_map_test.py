@@ -0,0 +1,86 @@
+import json
+import shutil
+from pathlib import Path
+
+from sb.aws_trace_analyzer import AwsTraceAnalyzer, create_span_graph
+from sb.service_map import CLIENT, ServiceMap, span_service
+
+
+def traces_path():
+    tests_path = Path(__file__).parent.parent
+    return tests_path / 'fixtures/aws_trace_analyzer/thumbnail_benchmark/traces.json'
+
+
+def valid_span_graphs():
+    graphs = []
+    with open(traces_path()) as traces_json:
+        for line in traces_json:
+            try:
+                graphs.append(create_span_graph(json.loads(line)))
+            except Exception:
+                pass
+    return graphs
+
+
+API = ('AWS::ApiGateway::Stage', 'thumbnail-generator/dev')
+UPLOAD = ('AWS::Lambda::Function', 'thumbnail-upload')
+CREATE = ('AWS::Lambda', 'thumbnail-create-thumbnail')
+S3 = ('AWS::S3::Bucket', 'S3')
+
+
+def test_span_service_inherits_origin():
+    G = valid_span_graphs()[0]
+    invocation = next(n for n in range(len(G))
+                      if G.name[n] == 'Invocation' and G.name[G.parent[n]] == 'thumbnail-upload')
+    assert G.origin[invocation] is None
+    assert span_service(G, invocation) == UPLOAD
+
+
+def test_add_trace():
+    graphs = valid_span_graphs()
+    service_map = ServiceMap()
+    for G in graphs:
+        service_map.add_trace(G)
+    num_traces = len(graphs)
+    assert service_map.num_traces == num_traces
+    client = service_map.edges[(CLIENT, API)]
+    assert (client['calls'], client['client']) == (num_traces, num_traces)
+    # Asynchronous trigger of the second function via S3
+    trigger = service_map.edges[(UPLOAD, CREATE)]
+    assert (trigger['calls'], trigger['sync'], trigger['async']) == (num_traces, 0, num_traces)
+    put = service_map.edges[(UPLOAD, S3)]
+    assert (put['calls'], put['sync']) == (num_traces, num_traces)
+    assert put['latency'].count == num_traces
+    # Calls within a service (e.g., Invocation subsegments) are no edges
+    assert all(source != target for source, target in service_map.edges)
+
+
+def test_merge_save_load(tmp_path):
+    graphs = valid_span_graphs()
+    expected = ServiceMap()
+    parts = [ServiceMap(), ServiceMap()]
+    for i, G in enumerate(graphs):
+        expected.add_trace(G)
+        parts[i % 2].add_trace(G)
+    for i, part in enumerate(parts):
+        part.save(tmp_path / f"service_map{i}.json")
+    merged = ServiceMap()
+    for i in range(len(parts)):
+        merged.merge(ServiceMap.load(tmp_path / f"service_map{i}.json"))
+    assert merged.num_traces == expected.num_traces
+    assert merged.nodes == expected.nodes
+    for key, edge in expected.edges.items():
+        assert merged.edges[key]['calls'] == edge['calls']
+        assert merged.edges[key]['latency'].positive == edge['latency'].positive
+    G = merged.to_networkx()
+    assert G.edges[CLIENT, API]['calls'] == len(graphs)
+    assert G.edges[UPLOAD, S3]['p50'] > 0
+
+
+def test_analyze_traces_service_map(tmp_path):
+    log_path = tmp_path / 'traces.json'
+    shutil.copy(traces_path(), log_path)
+    AwsTraceAnalyzer(log_path, workers=2, chunk_size=3, service_map=True).analyze_traces()
+    service_map = ServiceMap.load(tmp_path / 'service_map.json')
+    assert service_map.num_traces == len(valid_span_graphs())
+    assert service_map.edges[(UPLOAD, CREATE)]['async'] == service_map.num_traces
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from sb.aws_trace_analyzer import CSV_FIELDS, AwsTraceAnalyzer, extract_trace_breakdown, \
+    parse_trace_segments
+from sb.aws_trace_downloader import AwsTraceDownloader
+from sb.synthetic_traces import SyntheticTraceGenerator, SyntheticXRayClient
+
+
+def breakdown(trace) -> dict:
+    return dict(zip(CSV_FIELDS, extract_trace_breakdown(trace)))
+
+
+def function_docs(trace) -> list:
+    return [doc for doc in parse_trace_segments(trace)
+            if doc.get('origin') == 'AWS::Lambda::Function']
+
+
+@pytest.mark.parametrize('depth,fan_out', [(1, 1), (2, 1), (3, 2), (4, 3)])
+def test_generated_traces_are_valid(depth, fan_out):
+    generator = SyntheticTraceGenerator(depth=depth, fan_out=fan_out, cold_start_ratio=0.5)
+    for trace in generator.traces(20):
+        result = breakdown(trace)
+        assert result['trace_id'] == trace['Id']
+        num_functions = sum(fan_out ** level for level in range(depth))
+        assert len(function_docs(trace)) == num_functions
+        # Every function except the first is triggered asynchronously
+        assert result['longest_path_names'].count('Dwell Time') == depth - 1
+
+
+def test_cold_start_ratio():
+    warm = SyntheticTraceGenerator(depth=3, fan_out=2, cold_start_ratio=0)
+    cold = SyntheticTraceGenerator(depth=3, fan_out=2, cold_start_ratio=1)
+    assert breakdown(warm.trace(0))['num_cold_starts'] == 0
+    # The critical path includes one function per level
+    assert breakdown(cold.trace(0))['num_cold_starts'] == 3
+    for doc in function_docs(cold.trace(0)):
+        assert 'Initialization' in [s['name'] for s in doc['subsegments']]
+
+
+def test_timestamp_precision():
+    trace = SyntheticTraceGenerator(cold_start_ratio=0).trace(0)
+    for doc in parse_trace_segments(trace):
+        if doc['origin'] in ['AWS::ApiGateway::Stage', 'AWS::Lambda']:
+            assert doc['start_time'] == round(doc['start_time'], 3)
+    assert any(doc['start_time'] != round(doc['start_time'], 3)
+               for doc in function_docs(trace))
+
+
+def test_deterministic_traces():
+    generator = SyntheticTraceGenerator(depth=3, fan_out=2)
+    assert generator.trace(7) == SyntheticTraceGenerator(depth=3, fan_out=2).trace(7)
+    assert generator.trace(7) != generator.trace(8)
+    assert generator.trace_index(generator.trace_id(7)) == 7
+
+
+def test_invalid_configuration():
+    with pytest.raises(Exception, match='Unsupported trigger'):
+        SyntheticTraceGenerator(triggers=['SQS'])
+    with pytest.raises(Exception, match='Invalid depth'):
+        SyntheticTraceGenerator(depth=0)
+
+
+def test_download_and_analyze_offline(tmp_path):
+    generator = SyntheticTraceGenerator(depth=2, fan_out=2)
+    downloader = AwsTraceDownloader.__new__(AwsTraceDownloader)
+    downloader.client = SyntheticXRayClient(generator, 23, page_size=10)
+    trace_ids = downloader.retrieve_trace_ids(None, None, tmp_path / 'trace_ids.txt')
+    assert len(set(trace_ids)) == 23
+    traces_file = tmp_path / 'traces.json'
+    assert downloader.retrieve_traces(trace_ids, traces_file) == []
+    with open(traces_file) as traces_json:
+        traces = [json.loads(line) for line in traces_json]
+    assert traces == [generator.trace(generator.trace_index(id)) for id in trace_ids]
+    AwsTraceAnalyzer(traces_file, timestamp_rules={
+        't1': {'path': [{'origin': 'AWS::ApiGateway::Stage'}], 'value': 'start_time'},
+        'f1_cold_start': {'path': [{'origin': 'AWS::Lambda::Function'},
+                                   {'name': 'Initialization'}], 'value': 'exists'}
+    }).analyze_traces()
+    with open(tmp_path / 'trace_breakdown.csv') as breakdown_file:
+        assert len(breakdown_file.readlines()) == 1 + 23
@@ -0,0 +1,47 @@
+import pytest
+
+from sb.timestamps import parse_us, strptime_us, duration_us, format_us
+
+
+def test_parse_us():
+    assert parse_us('2022-01-06T09:00:01.929Z') == 1641459601929000
+    assert parse_us('2022-01-06T09:00:01Z') == 1641459601000000
+    assert parse_us('2022-01-06T09:00:01.5Z') == 1641459601500000
+    assert parse_us('2022-01-06T09:00:01.123456Z') == 1641459601123456
+
+
+@pytest.mark.parametrize('t', [
+    '1970-01-01T00:00:00Z',
+    '2020-02-29T23:59:59.999999Z',
+    '2022-01-06T09:00:01.02Z',
+    # Non-padded fields are only supported by strptime
+    '2022-1-6T9:0:1Z'
+])
+def test_parse_us_equals_strptime(t):
+    assert parse_us(t) == strptime_us(t)
+
+
+@pytest.mark.parametrize('t', [
+    '2022-01-06T09:00:60Z',
+    '2022-02-30T09:00:00Z',
+    '2022-01-06T09:00:01.Z',
+    '2022-01-06T09:00:01.1234567Z',
+    '2022-01-06 09:00:01Z',
+    '2022-01-06T09:00:01.12a4Z'
+])
+def test_parse_us_invalid(t):
+    with pytest.raises(ValueError):
+        parse_us(t)
+
+
+def test_duration_us():
+    assert duration_us(1) == 1000
+    assert duration_us(136.0541) == 136054
+    assert duration_us(0.0005) == 0
+    assert duration_us(0.0015) == 2
+
+
+def test_format_us():
+    assert format_us(0) == '1970-01-01 00:00:00.000000'
+    assert format_us(1641459601929000) == '2022-01-06 09:00:01.929000'
+    assert format_us(parse_us('2020-02-29T23:59:59.999999Z')) == '2020-02-29 23:59:59.999999'
@@ -0,0 +1,28 @@
+import pytest
+
+from sb.trace_cache import TraceCache
+
+
+def test_put_get(tmp_path):
+    cache = TraceCache(tmp_path / 'cache')
+    assert cache.get('1-61d6b8a7-91ec') is None
+    assert '1-61d6b8a7-91ec' not in cache
+    cache.put('1-61d6b8a7-91ec', '{"Id": "1-61d6b8a7-91ec"}')
+    assert '1-61d6b8a7-91ec' in cache
+    assert cache.get('1-61d6b8a7-91ec') == '{"Id": "1-61d6b8a7-91ec"}'
+    assert cache.path('1-61d6b8a7-91ec') == tmp_path / 'cache' / 'ec' / '1-61d6b8a7-91ec.json'
+    assert list(cache.path('1-61d6b8a7-91ec').parent.glob('*.tmp')) == []
+
+
+def test_add_traces_file(tmp_path):
+    traces_file = tmp_path / 'traces.json'
+    traces_file.write_text('{"Id": "1-a"}\n\n{"Id": "1-b", "Duration": 1.5}\n')
+    cache = TraceCache(tmp_path / 'cache')
+    assert cache.add_traces_file(traces_file) == 2
+    assert cache.get('1-b') == '{"Id": "1-b", "Duration": 1.5}'
+
+
+@pytest.mark.parametrize('trace_id', ['../1-a', '1-a/b', '', '..'])
+def test_invalid_trace_id(tmp_path, trace_id):
+    with pytest.raises(Exception, match='Invalid trace id'):
+        TraceCache(tmp_path).get(trace_id)
@@ -0,0 +1,59 @@
+import gzip
+
+import pytest
+
+from sb.trace_storage import open_traces, compression_of, find_traces_file, traces_file_of, \
+    traces_file_name, validate_compression
+from sb.aws_trace_migrator import migrate_traces
+
+
+def test_open_traces_gzip(tmp_path):
+    path = tmp_path / 'traces.json.gz'
+    with open_traces(path, 'w') as traces_file:
+        traces_file.write('{"Id": "1-a"}\n')
+    with open_traces(path, 'a') as traces_file:
+        traces_file.write('{"Id": "1-b"}\n')
+    with gzip.open(path, 'rt') as traces_file:
+        assert traces_file.read() == '{"Id": "1-a"}\n{"Id": "1-b"}\n'
+    with open_traces(path, 'rb') as traces_file:
+        traces_file.seek(14)
+        assert list(traces_file) == [b'{"Id": "1-b"}\n']
+
+
+def test_open_traces_plain(tmp_path):
+    path = tmp_path / 'traces.json'
+    with open_traces(path, 'w') as traces_file:
+        traces_file.write('{"Id": "1-a"}\n')
+    assert path.read_text() == '{"Id": "1-a"}\n'
+
+
+def test_compression_of():
+    assert compression_of('logs/traces.json') is None
+    assert compression_of('logs/traces.json.gz') == 'gzip'
+    assert compression_of('logs/traces.json.zst') == 'zstd'
+    assert traces_file_name() == 'traces.json'
+    assert traces_file_name('gzip') == 'traces.json.gz'
+
+
+def test_validate_compression():
+    validate_compression(None)
+    validate_compression('gzip')
+    with pytest.raises(Exception, match='Unsupported compression'):
+        validate_compression('bz2')
+
+
+def test_find_traces_file(tmp_path):
+    assert find_traces_file(tmp_path) == tmp_path / 'traces.json'
+    (tmp_path / 'traces.json.gz').touch()
+    assert find_traces_file(tmp_path) == tmp_path / 'traces.json.gz'
+    assert traces_file_of(tmp_path / 'trace_breakdown.csv') == tmp_path / 'traces.json.gz'
+    assert traces_file_of(tmp_path / 'traces.json') == tmp_path / 'traces.json'
+
+
+def test_migrate_traces_gzip(tmp_path):
+    path = tmp_path / 'traces.json.gz'
+    with gzip.open(path, 'wt') as traces_file:
+        traces_file.write('{"1-a": {"Id": "1-a"}, "1-b": {"Id": "1-b"}}')
+    migrate_traces(path, replace=True)
+    with gzip.open(path, 'rt') as traces_file:
+        assert traces_file.read() == '{"Id": "1-a"}\n{"Id": "1-b"}\n'